@@ -0,0 +1,15 @@
+"""
+Benchmark suite for the upc_sw stages, using seeded synthetic city data.
+
+Run from the repository root:
+    python -m benchmarks run --scales 1 2 --output results.json
+    python -m benchmarks compare base.json results.json
+"""
+
+import os
+import sys
+
+# Make the upc_sw package importable without installing it.
+_src = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+if _src not in sys.path:
+    sys.path.append(_src)
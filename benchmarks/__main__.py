@@ -0,0 +1,63 @@
+"""
+Benchmark the upc_sw stages on synthetic data.
+
+Usage:
+    python -m benchmarks run [--stages ...] [--scales 1 2] [--output FILE]
+    python -m benchmarks compare BASE NEW [--threshold 0.1]
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.compare import compare_results, format_comparison
+from benchmarks.runner import run_benchmarks
+from benchmarks.stages import STAGES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description=__doc__.splitlines()[1])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='Run the benchmarks.')
+    run.add_argument('--stages', nargs='+', choices=list(STAGES.keys()))
+    run.add_argument('--scales', type=float, nargs='+', default=[1.])
+    run.add_argument('--sizes', type=int, nargs='+')
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='JSON file to write the results to.')
+
+    compare = sub.add_parser('compare', help='Compare two results files.')
+    compare.add_argument('base')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='Relative time increase flagged as regression.')
+    compare.add_argument('--memory-threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(args.stages, args.scales, args.sizes,
+                                 args.repeat, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare_results(base, new, args.threshold, args.memory_threshold)
+    print(format_comparison(rows))
+    n_regressions = sum(r['time_regression'] or r['memory_regression']
+                        for r in rows)
+    if n_regressions:
+        print(f'{n_regressions} regression(s) found.')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+Compare two benchmark results files and flag regressions.
+"""
+
+
+def _index(results):
+    return {(r['stage'], r['size']): r for r in results['results']
+            if 'error' not in r}
+
+
+def compare_results(base, new, time_threshold=0.1, memory_threshold=0.1,
+                    min_time=0.005):
+    """
+    Compare benchmark results per stage and size.
+
+    Parameters
+    ----------
+    base, new : dict
+        Benchmark results, as written by `run_benchmarks`.
+    time_threshold : float (default: 0.1)
+        Relative increase in time that is flagged as a regression.
+    memory_threshold : float (default: 0.1)
+        Relative increase in peak memory that is flagged as a regression.
+    min_time : float (default: 0.005)
+        Times below this (in seconds) are too noisy and never flagged.
+
+    Returns
+    -------
+    A list of dicts with the time and memory ratios (new / base) and the
+    regression flags, for each stage and size in both results.
+    """
+    base_index = _index(base)
+    new_index = _index(new)
+    rows = []
+    for key in sorted(set(base_index).intersection(new_index)):
+        b, n = base_index[key], new_index[key]
+        time_ratio = n['time'] / max(b['time'], 1e-12)
+        memory_ratio = n['peak_memory'] / max(b['peak_memory'], 1)
+        rows.append({
+            'stage': key[0], 'size': key[1],
+            'base_time': b['time'], 'new_time': n['time'],
+            'time_ratio': time_ratio,
+            'base_memory': b['peak_memory'], 'new_memory': n['peak_memory'],
+            'memory_ratio': memory_ratio,
+            'time_regression': (time_ratio > 1 + time_threshold
+                                and max(b['time'], n['time']) >= min_time),
+            'memory_regression': memory_ratio > 1 + memory_threshold})
+    return rows
+
+
+def format_comparison(rows):
+    lines = [f'{"stage":>20} {"size":>10} {"base":>9} {"new":>9} '
+             + f'{"time":>7} {"memory":>7}']
+    for r in rows:
+        flags = ' '.join(name for name in ('time', 'memory')
+                         if r[f'{name}_regression'])
+        lines.append(f'{r["stage"]:>20} {r["size"]:>10} '
+                     + f'{r["base_time"]:>8.3f}s {r["new_time"]:>8.3f}s '
+                     + f'{r["time_ratio"]:>6.2f}x {r["memory_ratio"]:>6.2f}x'
+                     + (f'  REGRESSION ({flags})' if flags else ''))
+    return '\n'.join(lines)
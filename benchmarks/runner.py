@@ -0,0 +1,115 @@
+"""
+Run the benchmark stages and write the results to JSON.
+"""
+
+import datetime
+import gc
+import platform
+import time
+import traceback
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.stages import STAGES
+
+
+def measure(func, repeat=3):
+    """
+    Measure a function: the wall time of `repeat` runs, and the peak memory
+    allocated by Python and NumPy during a separate run with tracemalloc
+    (memory allocated by GEOS is not included).
+
+    Returns
+    -------
+    A dict with 'times' (list of seconds), 'time' (the minimum) and
+    'peak_memory' (bytes).
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'times': times, 'time': min(times), 'peak_memory': peak}
+
+
+def environment():
+    """Versions and platform information, stored with the results."""
+    import scipy
+    import shapely
+    import pandas
+    import geopandas
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'shapely': shapely.__version__,
+            'pandas': pandas.__version__,
+            'geopandas': geopandas.__version__}
+
+
+def run_benchmarks(stages=None, scales=(1,), sizes=None, repeat=3, seed=0,
+                   log=print):
+    """
+    Run benchmark stages over increasing sizes.
+
+    Parameters
+    ----------
+    stages : list of str (optional)
+        The stages to run, defaults to all stages.
+    scales : list of float (default: (1,))
+        Multipliers for the default sizes of each stage.
+    sizes : list of int (optional)
+        Sizes to use for all stages, instead of the scaled defaults.
+    repeat : int (default: 3)
+        Number of timed runs per size.
+    seed : int (default: 0)
+        Seed for the synthetic data.
+    log : callable (default: print)
+        Function used to report progress.
+
+    Returns
+    -------
+    A dict with 'meta' and 'results', a list with a record per stage and
+    size. Stages that fail are recorded with their error.
+    """
+    if stages is None:
+        stages = list(STAGES.keys())
+    unknown = set(stages).difference(STAGES.keys())
+    if unknown:
+        raise ValueError(f'Unknown stages: {sorted(unknown)}.')
+
+    results = []
+    for stage in stages:
+        setup, default_sizes = STAGES[stage]
+        stage_sizes = (sizes if sizes is not None
+                       else sorted({int(s * scale) for s in default_sizes
+                                    for scale in scales}))
+        for size in stage_sizes:
+            record = {'stage': stage, 'size': size}
+            try:
+                start = time.perf_counter()
+                func = setup(size, seed)
+                record['setup_time'] = time.perf_counter() - start
+                record.update(measure(func, repeat))
+                log(f'{stage:>20} {size:>10} {record["time"]:>10.3f}s '
+                    + f'{record["peak_memory"] / 2**20:>9.1f}MB')
+            except Exception as e:
+                record['error'] = f'{type(e).__name__}: {e}'
+                record['traceback'] = traceback.format_exc()
+                log(f'{stage:>20} {size:>10} failed: {record["error"]}')
+            results.append(record)
+
+    meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seed': seed, 'repeat': repeat, **environment()}
+    return {'meta': meta, 'results': results}
@@ -0,0 +1,132 @@
+"""
+Benchmark stages. Each stage has a setup function that takes a size and a
+seed, and returns a function without arguments that runs the stage.
+Only the returned function is measured. The upc_sw modules are imported in
+the setup functions, such that a stage with missing dependencies fails on its
+own.
+"""
+
+import numpy as np
+import geopandas as gpd
+
+from benchmarks.synthetic import SyntheticCity, make_cluster
+
+
+def _n_tiles(size, per_tile):
+    return max(1, int(round(np.sqrt(size / per_tile))))
+
+
+def setup_sidewalk_clip(size, seed):
+    """size: number of points in a single tile."""
+    from upc_sw import sw_utils
+    city = SyntheticCity(seed=seed)
+    polygons = city.sidewalk_polygons()
+    polygons.sindex
+    points = city.point_cloud(size, polygons=polygons)
+    return lambda: sw_utils.sidewalk_clip(points, city.tilecode, polygons)
+
+
+def setup_cluster2polygon(size, seed):
+    """size: number of obstacle points."""
+    from upc_sw.cluster2polygon import Cluster2Polygon
+    city = SyntheticCity(seed=seed)
+    points = city.obstacle_points(size, max(1, size // 2000))
+    c2p = Cluster2Polygon(min_component_size=100, grid_size=0.05,
+                          use_concave=True, concave_min_area=0.1, alpha=2.)
+    return lambda: c2p.get_obstacle_polygons(points)
+
+
+def setup_cluster2polygon_grid(size, seed):
+    """size: number of obstacle points."""
+    from upc_sw.cluster2polygon import Cluster2Polygon
+    city = SyntheticCity(seed=seed)
+    points = city.obstacle_points(size, max(1, size // 2000))
+    c2p = Cluster2Polygon(min_component_size=100, grid_size=0.05,
+                          engine='grid')
+    return lambda: c2p.get_obstacle_polygons(points)
+
+
+def _setup_alpha_shape(engine):
+    def setup(size, seed):
+        """size: number of points in the cluster."""
+        from upc_sw import alpha_shape
+        points = make_cluster(size, seed=seed)
+        func = getattr(alpha_shape, engine)
+        return lambda: func(points, 10.)
+    return setup
+
+
+def setup_get_avg_width(size, seed):
+    """size: approximate number of centerline segments."""
+    from upc_sw import poly_utils
+    city = SyntheticCity(seed=seed, n_tiles=_n_tiles(size, 40))
+    polygons = city.sidewalk_polygons().geometry.values
+    networks = city.centerline_network(spurs_per_block=0, segment_length=2.)
+    segments = [list(network.geoms) for network in networks]
+
+    def run():
+        return [poly_utils.get_avg_width(poly, segs, 1, 2)
+                for poly, segs in zip(polygons, segments)]
+    return run
+
+
+def setup_shorten_linestrings(size, seed):
+    """size: approximate number of centerline pieces."""
+    from upc_sw import poly_utils
+    city = SyntheticCity(seed=seed, n_tiles=_n_tiles(size, 60))
+    df = city.centerline_df()
+    return lambda: poly_utils.shorten_linestrings(df, 10)
+
+
+def setup_remove_short_lines(size, seed):
+    """size: approximate number of centerline parts."""
+    from upc_sw import poly_utils
+    city = SyntheticCity(seed=seed, n_tiles=_n_tiles(size, 80))
+    networks = city.centerline_network(spurs_per_block=8, segment_length=2.)
+    return lambda: [poly_utils.remove_short_lines(network, 5)
+                    for network in networks]
+
+
+def setup_partitioned_union(size, seed):
+    """size: approximate number of sidewalk polygons."""
+    from upc_sw import partition_utils
+    city = SyntheticCity(seed=seed, n_tiles=_n_tiles(size, 2.5))
+    polygons = city.sidewalk_polygons().geometry
+    # Widened across the streets, such that all sidewalks form one network
+    # that spans every cell.
+    network = list(polygons.buffer(city.street_width / 2 + 0.5, join_style=2))
+    return lambda: partition_utils.partitioned_union(network, cell_tiles=1,
+                                                     n_workers=4)
+
+
+def setup_width_index(size, seed):
+    """size: number of batched bbox queries."""
+    from upc_sw.width_index import WidthIndex
+    city = SyntheticCity(seed=seed, n_tiles=4)
+    networks = city.centerline_network(spurs_per_block=0, segment_length=2.)
+    segments = [seg for network in networks for seg in network.geoms]
+    rng = np.random.default_rng(seed)
+    gdf = gpd.GeoDataFrame({'min_width': rng.uniform(0.5, 3., len(segments))},
+                           geometry=segments)
+    index = WidthIndex.from_gdf(gdf)
+    x_min, y_min, x_max, y_max = city.bounds
+    corners = rng.uniform((x_min, y_min), (x_max, y_max), (size, 2))
+    boxes = np.hstack((corners, corners + rng.uniform(5., 50., (size, 2))))
+    return lambda: index.query_bboxes(boxes)
+
+
+# Stage name -> (setup function, default sizes).
+STAGES = {
+    'sidewalk_clip': (setup_sidewalk_clip, [100000, 1000000, 4000000]),
+    'cluster2polygon': (setup_cluster2polygon, [10000, 100000, 400000]),
+    'cluster2polygon_grid': (setup_cluster2polygon_grid,
+                             [10000, 100000, 400000]),
+    'alpha_shape': (_setup_alpha_shape('alpha_shape'), [1000, 10000, 50000]),
+    'alpha_shape_fast': (_setup_alpha_shape('alpha_shape_fast'),
+                         [1000, 10000, 50000]),
+    'get_avg_width': (setup_get_avg_width, [100, 1000, 5000]),
+    'shorten_linestrings': (setup_shorten_linestrings, [100, 1000, 10000]),
+    'remove_short_lines': (setup_remove_short_lines, [100, 1000, 5000]),
+    'partitioned_union': (setup_partitioned_union, [100, 1000, 4000]),
+    'width_index': (setup_width_index, [100, 1000, 10000]),
+}
@@ -0,0 +1,219 @@
+"""
+Seeded generator for synthetic city data: sidewalk polygons with holes,
+point clouds with obstacle blobs, and centerline networks.
+
+The city is a grid of building blocks, each surrounded by a sidewalk. All
+data lies within the bounds of a single 50m tile, or a square of tiles for
+larger scales.
+"""
+
+import numpy as np
+import geopandas as gpd
+import shapely.geometry as sg
+import shapely.ops as so
+
+CRS = 'epsg:28992'
+TILE_SIZE = 50
+
+
+def make_cluster(n_points, seed=0):
+    """A ring-shaped blob with some noise, similar to an obstacle cluster."""
+    rng = np.random.default_rng(seed)
+    angle = rng.uniform(0, 2 * np.pi, n_points)
+    radius = np.sqrt(rng.uniform(0.25, 1, n_points))
+    return np.c_[radius * np.cos(angle), radius * np.sin(angle)]
+
+
+class SyntheticCity:
+    """
+    Synthetic city on a grid of blocks.
+
+    Parameters
+    ----------
+    seed : int (default: 0)
+        Seed for the random number generator.
+    tilecode : str (default: '2386_9702')
+        Tile of the lower-left corner of the city.
+    n_tiles : int (default: 1)
+        Size of the city in tiles, in both directions.
+    block_size : float (default: 20.)
+        Size of a building block in meters.
+    street_width : float (default: 5.)
+        Width of the streets between the sidewalks.
+    sidewalk_width : float (default: 2.5)
+        Width of the sidewalks.
+    """
+
+    def __init__(self, seed=0, tilecode='2386_9702', n_tiles=1,
+                 block_size=20., street_width=5., sidewalk_width=2.5):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        tile_x, tile_y = (int(c) for c in tilecode.split('_'))
+        self.tilecode = tilecode
+        self.origin = np.array([tile_x * TILE_SIZE, tile_y * TILE_SIZE],
+                               dtype=float)
+        self.size = n_tiles * TILE_SIZE
+        self.block_size = block_size
+        self.street_width = street_width
+        self.sidewalk_width = sidewalk_width
+
+    @property
+    def bounds(self):
+        return (self.origin[0], self.origin[1],
+                self.origin[0] + self.size, self.origin[1] + self.size)
+
+    def tilecodes(self):
+        n_tiles = int(self.size // TILE_SIZE)
+        tile_x, tile_y = (int(c) for c in self.tilecode.split('_'))
+        return [f'{tile_x + i}_{tile_y + j}'
+                for i in range(n_tiles) for j in range(n_tiles)]
+
+    def _block_corners(self):
+        pitch = self.block_size + 2 * self.sidewalk_width + self.street_width
+        n_blocks = max(1, int(self.size // pitch))
+        offset = (self.size - n_blocks * pitch + self.street_width) / 2
+        ij = np.stack(np.meshgrid(np.arange(n_blocks), np.arange(n_blocks),
+                                  indexing='ij'), axis=-1).reshape(-1, 2)
+        return self.origin + offset + self.sidewalk_width + ij * pitch
+
+    def sidewalk_polygons(self, holes_per_block=4, hole_size=1.):
+        """
+        Sidewalks around each block, with the block itself as interior and
+        small holes (e.g. tree pits) in the sidewalk.
+
+        Returns
+        -------
+        A GeoDataFrame with the sidewalk polygons and column 'ogc_fid'.
+        """
+        polygons = []
+        bs, sw = self.block_size, self.sidewalk_width
+        for (x, y) in self._block_corners():
+            block = sg.box(x, y, x + bs, y + bs)
+            outer = sg.box(x - sw, y - sw, x + bs + sw, y + bs + sw)
+            # Holes along the sidewalk band, clear of its edges.
+            pos = self.rng.uniform(0, 4 * (bs + sw), holes_per_block)
+            holes = []
+            for p in np.sort(pos):
+                side, t = divmod(p, bs + sw)
+                c = sw / 2
+                centre = [(x - c + t, y - c), (x + bs + c, y - c + t),
+                          (x + bs + c - t, y + bs + c),
+                          (x - c, y + bs + c - t)][int(side)]
+                hole = sg.Point(centre).buffer(hole_size * sw / 5,
+                                               resolution=4)
+                if all(hole.disjoint(h) for h in holes):
+                    holes.append(hole)
+            polygons.append(sg.Polygon(
+                        outer.exterior.coords,
+                        [block.exterior.coords]
+                        + [h.exterior.coords for h in holes]))
+        return gpd.GeoDataFrame({'ogc_fid': np.arange(len(polygons))},
+                                geometry=polygons, crs=CRS)
+
+    def obstacle_points(self, n_points, n_obstacles, polygons=None):
+        """
+        Points of obstacle blobs (poles, bins, benches) on the sidewalks.
+
+        Returns
+        -------
+        An array of shape (n_points, 3).
+        """
+        if polygons is None:
+            polygons = self.sidewalk_polygons()
+        poly_ids = self.rng.integers(0, len(polygons), n_obstacles)
+        centres = np.array([self._random_point_in(polygons.geometry.iloc[i])
+                            for i in poly_ids]).reshape(-1, 2)
+        sizes = self.rng.uniform(0.2, 0.8, (n_obstacles, 2))
+        heights = self.rng.uniform(0.5, 2., n_obstacles)
+        blob = self.rng.integers(0, n_obstacles, n_points)
+        xy = centres[blob] + (self.rng.uniform(-0.5, 0.5, (n_points, 2))
+                              * sizes[blob])
+        z = self.rng.uniform(0, 1, n_points) * heights[blob]
+        return np.c_[xy, z]
+
+    def point_cloud(self, n_points, obstacle_fraction=0.2, n_obstacles=None,
+                    polygons=None):
+        """
+        Point cloud of the city: ground points everywhere, plus obstacle blobs
+        on the sidewalks.
+
+        Returns
+        -------
+        An array of shape (n_points, 3).
+        """
+        if n_obstacles is None:
+            n_obstacles = max(1, n_points // 5000)
+        n_obst = int(n_points * obstacle_fraction)
+        n_ground = n_points - n_obst
+        x_min, y_min, x_max, y_max = self.bounds
+        ground = np.c_[self.rng.uniform(x_min, x_max, n_ground),
+                       self.rng.uniform(y_min, y_max, n_ground),
+                       self.rng.normal(0, 0.02, n_ground)]
+        obstacles = self.obstacle_points(n_obst, n_obstacles, polygons)
+        points = np.vstack((ground, obstacles))
+        return points[self.rng.permutation(len(points))]
+
+    def _random_point_in(self, polygon):
+        x_min, y_min, x_max, y_max = polygon.bounds
+        while True:
+            p = self.rng.uniform((x_min, y_min), (x_max, y_max))
+            if polygon.contains(sg.Point(p)):
+                return p
+
+    def centerline_network(self, spur_length=(1., 8.), spurs_per_block=4,
+                           segment_length=5.):
+        """
+        Centerlines along the middle of each sidewalk, cut into segments of
+        about `segment_length`, plus some dead-end spurs starting at the
+        segment nodes.
+
+        Returns
+        -------
+        A list with a MultiLineString for each sidewalk.
+        """
+        networks = []
+        bs, c = self.block_size, self.sidewalk_width / 2
+        for (x, y) in self._block_corners():
+            ring = sg.box(x - c, y - c, x + bs + c, y + bs + c).exterior
+            n_seg = max(1, int(round(ring.length / segment_length)))
+            dist = np.linspace(0, ring.length, n_seg + 1)
+            nodes = [ring.interpolate(d) for d in dist]
+            lines = [sg.LineString([a, b])
+                     for a, b in zip(nodes[:-1], nodes[1:])]
+            for k in self.rng.integers(0, n_seg, spurs_per_block):
+                p = nodes[k]
+                angle = self.rng.uniform(0, 2 * np.pi)
+                length = self.rng.uniform(*spur_length)
+                lines.append(sg.LineString(
+                    [p, (p.x + length * np.cos(angle),
+                         p.y + length * np.sin(angle))]))
+            networks.append(sg.MultiLineString(lines))
+        return networks
+
+    def centerline_df(self, long_fraction=0.3, long_length=(10., 40.)):
+        """
+        Centerline pieces along the sidewalks in the format used by
+        `poly_utils.shorten_linestrings`, with a fraction of long pieces.
+        """
+        bs, c = self.block_size, self.sidewalk_width / 2
+        lines = []
+        sw_ids = []
+        for sw_id, (x, y) in enumerate(self._block_corners()):
+            ring = sg.LineString(
+                    sg.box(x - c, y - c, x + bs + c, y + bs + c).exterior)
+            start = 0.
+            while start < ring.length:
+                if self.rng.uniform() < long_fraction:
+                    length = self.rng.uniform(*long_length)
+                else:
+                    length = self.rng.uniform(1., 10.)
+                end = min(start + length, ring.length)
+                lines.append(so.substring(ring, start, end))
+                sw_ids.append(sw_id)
+                start = end
+        df = gpd.GeoDataFrame({'index': np.arange(len(lines)),
+                               'sidewalk_id': sw_ids,
+                               'centerlines': lines},
+                              geometry='centerlines', crs=CRS)
+        df['length'] = df['centerlines'].length
+        return df
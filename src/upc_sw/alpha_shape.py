@@ -1,11 +1,36 @@
 # Code from https://gist.github.com/dwyerk/10561690
 
 from shapely.ops import unary_union, polygonize
+from shapely.prepared import prep
 import shapely.geometry as geometry
 from scipy.spatial import Delaunay
 import numpy as np
 
 
+def _alpha_triangles(points, alpha):
+    """
+    Compute the Delaunay triangles of a set of points that pass the alpha
+    (circumradius) filter.
+
+    Returns
+    -------
+    An array of shape (n_triangles, 3) with point indices.
+    """
+    tri = Delaunay(points)
+    triangles = points[tri.simplices]
+    a = np.sqrt((triangles[:, 0, 0] - triangles[:, 1, 0]) ** 2
+                + (triangles[:, 0, 1] - triangles[:, 1, 1]) ** 2)
+    b = np.sqrt((triangles[:, 1, 0] - triangles[:, 2, 0]) ** 2
+                + (triangles[:, 1, 1] - triangles[:, 2, 1]) ** 2)
+    c = np.sqrt((triangles[:, 2, 0] - triangles[:, 0, 0]) ** 2
+                + (triangles[:, 2, 1] - triangles[:, 0, 1]) ** 2)
+    s = (a + b + c) / 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        areas = np.sqrt(s * (s - a) * (s - b) * (s - c))
+        circums = a * b * c / (4.0 * areas)
+    return tri.simplices[circums < (1.0 / alpha)]
+
+
 def alpha_shape(points, alpha):
     """
     Compute the alpha shape (concave hull) of a set
@@ -19,23 +44,9 @@ def alpha_shape(points, alpha):
     if len(points) < 4:
         # When you have a triangle, there is no sense
         # in computing an alpha shape.
-        return geometry.MultiPoint(list(points)).convex_hull
+        return geometry.MultiPoint(list(points)).convex_hull, []
 
-    # coords = np.array([point.coords[0] for point in points])
-    # tri = Delaunay(coords)
-    # triangles = coords[tri.vertices]
-    tri = Delaunay(points)
-    triangles = points[tri.vertices]
-    a = np.sqrt((triangles[:, 0, 0] - triangles[:, 1, 0]) ** 2
-                + (triangles[:, 0, 1] - triangles[:, 1, 1]) ** 2)
-    b = np.sqrt((triangles[:, 1, 0] - triangles[:, 2, 0]) ** 2
-                + (triangles[:, 1, 1] - triangles[:, 2, 1]) ** 2)
-    c = np.sqrt((triangles[:, 2, 0] - triangles[:, 0, 0]) ** 2
-                + (triangles[:, 2, 1] - triangles[:, 0, 1]) ** 2)
-    s = (a + b + c) / 2.0
-    areas = np.sqrt(s * (s - a) * (s - b) * (s - c))
-    circums = a * b * c / (4.0 * areas)
-    filtered = triangles[circums < (1.0 / alpha)]
+    filtered = points[_alpha_triangles(points, alpha)]
     edge1 = filtered[:, (0, 1)]
     edge2 = filtered[:, (1, 2)]
     edge3 = filtered[:, (2, 0)]
@@ -45,3 +56,192 @@ def alpha_shape(points, alpha):
     m = geometry.MultiLineString(edge_points)
     triangles = list(polygonize(m))
     return unary_union(triangles), edge_points
+
+
+def boundary_edges(points, simplices):
+    """
+    Find the boundary edges of a set of triangles: the edges that occur in
+    only one triangle. Edges are directed such that the interior lies to the
+    left.
+
+    Returns
+    -------
+    Two arrays (src, dst) with the point indices of each directed edge.
+    """
+    simplices = simplices.copy()
+    p = points[simplices]
+    signed_area = ((p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1])
+                   - (p[:, 2, 0] - p[:, 0, 0]) * (p[:, 1, 1] - p[:, 0, 1]))
+    # Orient all triangles counter-clockwise.
+    cw = signed_area < 0
+    simplices[cw] = simplices[cw][:, (0, 2, 1)]
+
+    src = simplices.ravel()
+    dst = simplices[:, (1, 2, 0)].ravel()
+    key = (np.minimum(src, dst).astype(np.int64) * len(points)
+           + np.maximum(src, dst))
+    _, inverse, counts = np.unique(key, return_inverse=True,
+                                   return_counts=True)
+    once = counts[inverse] == 1
+    return src[once], dst[once]
+
+
+def _split_walk(walk):
+    """Split a closed walk at repeated vertices into simple loops."""
+    loops = []
+    path = []
+    position = {}
+    for vertex in walk:
+        if vertex in position:
+            start = position[vertex]
+            loop = path[start:]
+            for v in loop[1:]:
+                del position[v]
+            del path[start + 1:]
+            loops.append(loop)
+        else:
+            position[vertex] = len(path)
+            path.append(vertex)
+    loops.append(path)
+    return [np.array(loop) for loop in loops if len(loop) >= 3]
+
+
+def rings_from_edges(coords, src, dst, merge=False):
+    """
+    Chain directed boundary edges (interior to the left) into closed rings.
+
+    At vertices with multiple outgoing edges, either the first edge clockwise
+    (merge=False) or counter-clockwise (merge=True) from the incoming edge is
+    taken. The first traces the boundaries of the interior regions, the
+    second those of the exterior regions. The resulting walks are split at
+    repeated vertices into simple rings.
+
+    Returns
+    -------
+    A list of arrays with the point indices of each ring (not closed).
+    """
+    n_edges = len(src)
+    if n_edges == 0:
+        return []
+    order = np.argsort(src, kind='stable')
+    src_sorted = src[order]
+    first = np.searchsorted(src_sorted, dst, side='left')
+    n_out = np.searchsorted(src_sorted, dst, side='right') - first
+    next_edge = order[np.minimum(first, n_edges - 1)]
+    next_edge[n_out == 0] = -1
+
+    for e in np.flatnonzero(n_out > 1):
+        options = order[first[e]:first[e] + n_out[e]]
+        vertex = coords[dst[e]]
+        back = coords[src[e]] - vertex
+        out = coords[dst[options]] - vertex
+        angle = np.mod(np.arctan2(back[1], back[0])
+                       - np.arctan2(out[:, 1], out[:, 0]), 2 * np.pi)
+        if merge:
+            angle = np.mod(-angle, 2 * np.pi)
+        angle[angle == 0] = 2 * np.pi
+        next_edge[e] = options[np.argmin(angle)]
+
+    rings = []
+    visited = np.zeros((n_edges,), dtype=bool)
+    for start in range(n_edges):
+        if visited[start]:
+            continue
+        walk = []
+        e = start
+        while e != -1 and not visited[e]:
+            visited[e] = True
+            walk.append(src[e])
+            e = next_edge[e]
+        if e == start:
+            rings.extend(_split_walk(walk))
+    return rings
+
+
+def _signed_area(ring_coords):
+    x = ring_coords[:, 0]
+    y = ring_coords[:, 1]
+    return (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+
+def polygons_from_rings(coords, rings, keep_holes=True):
+    """
+    Build (Multi)Polygon geometry from rings, with counter-clockwise rings as
+    shells and clockwise rings as holes. Holes are assigned to the smallest
+    shell that covers them. Shells inside another shell (islands in a hole)
+    are kept as separate polygons when `keep_holes` is True, and dropped
+    otherwise.
+    """
+    shells = []
+    holes = []
+    for ring in rings:
+        ring_coords = coords[ring]
+        area = _signed_area(ring_coords)
+        if area > 0:
+            shells.append((area, geometry.Polygon(ring_coords)))
+        elif area < 0:
+            holes.append(geometry.Polygon(ring_coords))
+    if len(shells) == 0:
+        return geometry.GeometryCollection()
+
+    # Largest shells first.
+    shells.sort(key=lambda x: -x[0])
+    shell_polys = [poly for _, poly in shells]
+
+    if keep_holes:
+        # Assign each hole to the smallest shell that covers it.
+        shell_holes = [[] for _ in shell_polys]
+        for hole in holes:
+            for j in range(len(shell_polys) - 1, -1, -1):
+                if shell_polys[j].covers(hole):
+                    shell_holes[j].append(hole.exterior.coords)
+                    break
+        polygons = [geometry.Polygon(poly.exterior.coords, hole_list)
+                    for poly, hole_list in zip(shell_polys, shell_holes)]
+    else:
+        # Drop shells that are covered by a larger shell.
+        prepared = []
+        polygons = []
+        for poly in shell_polys:
+            if not any(p.covers(poly) for p in prepared):
+                prepared.append(prep(poly))
+                polygons.append(poly)
+
+    if len(polygons) == 1:
+        return polygons[0]
+    return geometry.MultiPolygon(polygons)
+
+
+def alpha_shape_fast(points, alpha, keep_holes=False):
+    """
+    Compute the alpha shape (concave hull) of a set of points by tracing the
+    boundary edges of the alpha triangles directly, instead of polygonizing
+    and merging all triangles.
+
+    With keep_holes=False (default) the result is geometrically equal to
+    `alpha_shape`, which fills all holes since `polygonize` also returns the
+    faces enclosed by the triangles. With keep_holes=True the holes are kept.
+
+    Parameters
+    ----------
+    points : array of shape (n_points, 2)
+    alpha : float
+        See `alpha_shape`.
+    keep_holes : bool (default: False)
+        Whether to keep the holes of the alpha shape.
+
+    Returns
+    -------
+    The alpha shape geometry, and a list with the boundary edges.
+    """
+    if len(points) < 4:
+        return geometry.MultiPoint(list(points)).convex_hull, []
+
+    points = np.asarray(points)[:, :2]
+    simplices = _alpha_triangles(points, alpha)
+    if len(simplices) == 0:
+        return geometry.GeometryCollection(), []
+    src, dst = boundary_edges(points, simplices)
+    rings = rings_from_edges(points, src, dst, merge=not keep_holes)
+    edge_points = np.stack((points[src], points[dst]), axis=1).tolist()
+    return polygons_from_rings(points, rings, keep_holes), edge_points
@@ -0,0 +1,514 @@
+"""
+Centerline (skeleton) engines for sidewalk polygons.
+
+Two engines are available:
+
+- 'centerline': the `centerline` library, which densifies the boundary with a
+  fixed interpolation distance and keeps the Voronoi ridges within the
+  polygon using a Shapely test per ridge.
+- 'voronoi': an in-package implementation. The boundary is densified with a
+  spacing that depends on the local width of the polygon, the Voronoi ridges
+  are derived from a Delaunay triangulation and pruned using NumPy arrays,
+  and large polygons are processed in overlapping windows.
+
+Use `compute_centerline` to run an engine with time and size budgets; it
+returns a `CenterlineResult` that describes failures instead of raising. A
+time budget is enforced by running the engine in a worker process, which is
+re-used for all polygons, and terminated and replaced when the budget is
+exceeded.
+"""
+
+import os
+import time
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+import shapely.geometry as sg
+from scipy.spatial import Delaunay, cKDTree
+from shapely.affinity import translate
+from centerline.geometry import Centerline
+
+from upcp.utils import clip_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+CenterlineResult = namedtuple('CenterlineResult',
+                              ['geometry', 'status', 'error', 'n_segments',
+                               'duration'])
+CenterlineResult.__doc__ = """
+Result of `compute_centerline`. The status is one of 'ok', 'empty' (no
+centerline found), 'too_large' (size budget exceeded), 'timeout' (time budget
+exceeded) or 'failed' (any other error, see `error`). The geometry is None
+unless the status is 'ok'.
+"""
+
+
+class CenterlineBudgetError(Exception):
+    """Raised by an engine when a polygon exceeds its time or size budget."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _polygon_parts(poly):
+    if poly.type == 'MultiPolygon':
+        return list(poly.geoms)
+    if poly.type == 'Polygon':
+        return [poly]
+    return []
+
+
+def _rings(poly):
+    """The exterior and interior rings of a (Multi)Polygon as arrays."""
+    rings = []
+    for part in _polygon_parts(poly):
+        for ring in [part.exterior] + list(part.interiors):
+            coords = np.asarray(ring.coords)[:, :2]
+            if len(coords) > 3:
+                rings.append(coords)
+    return rings
+
+
+def _subdivide(starts, ends, n_parts):
+    """
+    Split segments (starts[i], ends[i]) into n_parts[i] equal pieces and
+    return the start point of each piece.
+    """
+    seg_ids = np.repeat(np.arange(len(starts)), n_parts)
+    part_nr = np.arange(len(seg_ids)) - np.repeat(
+                                    np.cumsum(n_parts) - n_parts, n_parts)
+    t = (part_nr / n_parts[seg_ids])[:, None]
+    return starts[seg_ids] + t * (ends[seg_ids] - starts[seg_ids]), seg_ids
+
+
+def local_width(points, ring_ids, arc_pos, ring_lengths, max_width, k=16):
+    """
+    Estimate the local width of a polygon at boundary sample points, as the
+    distance to the nearest sample on the "opposite" side: a sample on
+    another ring, or on the same ring but further away along the ring than
+    in a straight line.
+    """
+    k = min(k, len(points))
+    dist, nn = cKDTree(points).query(points, k=k)
+    dist = dist.reshape(len(points), -1)
+    nn = nn.reshape(len(points), -1)
+    gap = np.abs(arc_pos[nn] - arc_pos[:, None])
+    gap = np.minimum(gap, ring_lengths[ring_ids][:, None] - gap)
+    opposite = ((ring_ids[nn] != ring_ids[:, None])
+                | (gap > 1.5 * dist + 1e-9))
+    width = np.where(opposite, dist, np.inf).min(axis=1)
+    return np.minimum(width, max_width)
+
+
+def densify_boundary(poly, min_spacing=0.25, max_spacing=2.,
+                     width_ratio=0.25):
+    """
+    Sample the boundary of a polygon with a spacing tied to the local width:
+    `width_ratio` times the local width, clipped to [min_spacing,
+    max_spacing]. All original vertices are kept.
+
+    Returns
+    -------
+    A tuple (points, spacing) with the sample points of shape (n, 2), and for
+    each point the largest spacing of its two adjacent intervals.
+    """
+    rings = _rings(poly)
+    if len(rings) == 0:
+        return np.empty((0, 2)), np.empty((0,))
+
+    # Coarse samples, at most max_spacing apart, including all vertices.
+    starts = np.vstack([r[:-1] for r in rings])
+    ends = np.vstack([r[1:] for r in rings])
+    edge_ring = np.repeat(np.arange(len(rings)), [len(r) - 1 for r in rings])
+    edge_len = np.hypot(*(ends - starts).T)
+    coarse, coarse_edge = _subdivide(
+                starts, ends,
+                np.maximum(np.ceil(edge_len / max_spacing), 1).astype(int))
+    coarse_ring = edge_ring[coarse_edge]
+    ring_start = np.searchsorted(coarse_ring, np.arange(len(rings)))
+    ring_count = np.bincount(coarse_ring, minlength=len(rings))
+    # Next coarse sample along the ring (cyclic).
+    next_ids = np.arange(1, len(coarse) + 1)
+    ring_last = ring_start + ring_count - 1
+    next_ids[ring_last] = ring_start
+    interval_len = np.hypot(*(coarse[next_ids] - coarse).T)
+    arc_pos = np.cumsum(interval_len) - interval_len
+    arc_pos -= arc_pos[ring_start][coarse_ring]
+    ring_lengths = np.bincount(coarse_ring, weights=interval_len,
+                               minlength=len(rings))
+
+    width = local_width(coarse, coarse_ring, arc_pos, ring_lengths,
+                        max_width=max_spacing / width_ratio)
+    # Spacing per interval, smoothed with the neighbouring intervals.
+    prev_ids = np.empty_like(next_ids)
+    prev_ids[next_ids] = np.arange(len(coarse))
+    width = np.minimum.reduce([width, width[next_ids], width[prev_ids],
+                               width[next_ids[next_ids]]])
+    spacing = np.clip(width * width_ratio, min_spacing, max_spacing)
+
+    n_parts = np.maximum(np.ceil(interval_len / spacing), 1).astype(int)
+    points, interval_ids = _subdivide(coarse, coarse[next_ids], n_parts)
+    point_spacing = (interval_len / n_parts)[interval_ids]
+    # Also take the spacing of the previous interval into account.
+    first = np.concatenate(([True], interval_ids[1:] != interval_ids[:-1]))
+    prev_spacing = (interval_len / n_parts)[prev_ids][interval_ids]
+    point_spacing[first] = np.maximum(point_spacing[first],
+                                      prev_spacing[first])
+    return points, point_spacing
+
+
+def _inside(points, poly):
+    """Mask of the points that lie inside the (Multi)Polygon."""
+    mask = np.zeros((len(points),), dtype=bool)
+    for part in _polygon_parts(poly):
+        part_mask = clip_utils.poly_clip(points,
+                                         sg.Polygon(part.exterior.coords))
+        for interior in part.interiors:
+            part_mask[part_mask] &= ~clip_utils.poly_clip(
+                                        points[part_mask],
+                                        sg.Polygon(interior.coords))
+        mask |= part_mask
+    return mask
+
+
+def _circumcenters(points, simplices):
+    """
+    Circumcenters and radii of triangles. The vertices are sorted first, such
+    that the result for a triangle does not depend on its orientation.
+    """
+    simplices = np.sort(simplices, axis=1)
+    a = points[simplices[:, 0]]
+    b = points[simplices[:, 1]] - a
+    c = points[simplices[:, 2]] - a
+    d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    b_sq = np.einsum('ij,ij->i', b, b)
+    c_sq = np.einsum('ij,ij->i', c, c)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ux = (c[:, 1] * b_sq - b[:, 1] * c_sq) / d
+        uy = (b[:, 0] * c_sq - c[:, 0] * b_sq) / d
+    return a + np.column_stack((ux, uy)), np.hypot(ux, uy)
+
+
+def _point_segment_dist(points, seg):
+    a = seg[:, 0:2]
+    ab = seg[:, 2:4] - a
+    ap = points - a
+    ab_sq = np.einsum('ij,ij->i', ab, ab)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(ab_sq > 0, np.einsum('ij,ij->i', ap, ab) / ab_sq, 0.)
+    d = ap - np.clip(t, 0., 1.)[:, None] * ab
+    return np.hypot(d[:, 0], d[:, 1])
+
+
+def _window_ridges(points, spacing, poly, core, expanded):
+    """
+    Compute the centerline ridges with their midpoint in the core window,
+    using only the samples in the expanded window.
+
+    Returns
+    -------
+    A tuple (ridges, complete): an array (n, 4) with the ridge segments, and
+    whether all ridges are guaranteed to equal those of the full polygon.
+    """
+    in_window = ((points[:, 0] >= expanded[0]) & (points[:, 0] <= expanded[2])
+                 & (points[:, 1] >= expanded[1])
+                 & (points[:, 1] <= expanded[3]))
+    ids = np.flatnonzero(in_window)
+    if len(ids) < 3:
+        return np.empty((0, 4)), True
+    tri = Delaunay(points[ids])
+    # Global point ids, for a deterministic circumcenter computation.
+    simplices = ids[tri.simplices]
+    centers, radii = _circumcenters(points, simplices)
+
+    # A Voronoi ridge for each pair of adjacent triangles.
+    t0 = np.repeat(np.arange(len(simplices)), 3)
+    t1 = tri.neighbors.ravel()
+    opposite = np.tile(np.arange(3), len(simplices))
+    keep = t1 > t0
+    t0, t1, opposite = t0[keep], t1[keep], opposite[keep]
+    ridges = np.hstack((centers[t0], centers[t1]))
+    # The two points that generate the ridge.
+    generators = np.column_stack((simplices[t0, (opposite + 1) % 3],
+                                  simplices[t0, (opposite + 2) % 3]))
+
+    mid = (ridges[:, 0:2] + ridges[:, 2:4]) / 2
+    in_core = ((mid[:, 0] >= core[0]) & (mid[:, 0] < core[2])
+               & (mid[:, 1] >= core[1]) & (mid[:, 1] < core[3]))
+    valid = (in_core & np.isfinite(ridges).all(axis=1)
+             & ((ridges[:, 0:2] != ridges[:, 2:4]).any(axis=1)))
+    ridges, generators = ridges[valid], generators[valid]
+    t0, t1 = t0[valid], t1[valid]
+
+    # Prune ridges that come close to their generating points: these cross
+    # the boundary.
+    max_spacing = spacing[generators].max(axis=1)
+    valid = (_point_segment_dist(points[generators[:, 0]], ridges)
+             > 0.5 * max_spacing * (1 + 1e-6))
+    ridges, t0, t1 = ridges[valid], t0[valid], t1[valid]
+
+    # Keep the ridges within the polygon.
+    valid = (_inside(ridges[:, 0:2], poly) & _inside(ridges[:, 2:4], poly))
+    ridges, t0, t1 = ridges[valid], t0[valid], t1[valid]
+
+    # Triangles whose circumcircle lies within the expanded window are also
+    # triangles of the full Delaunay triangulation.
+    margin = np.minimum.reduce([centers[:, 0] - expanded[0],
+                                expanded[2] - centers[:, 0],
+                                centers[:, 1] - expanded[1],
+                                expanded[3] - centers[:, 1]])
+    exact = radii < margin
+    complete = bool(exact[t0].all() and exact[t1].all())
+    return ridges, complete
+
+
+def voronoi_centerline(poly, min_spacing=0.25, max_spacing=2.,
+                       width_ratio=0.25, window_points=200000,
+                       max_points=None):
+    """
+    Compute the centerline of a polygon as the Voronoi ridges of its
+    (densified) boundary that lie within the polygon.
+
+    Parameters
+    ----------
+    poly : Polygon or MultiPolygon
+    min_spacing : float (default: 0.25)
+        Minimum distance between boundary samples.
+    max_spacing : float (default: 2.)
+        Maximum distance between boundary samples.
+    width_ratio : float (default: 0.25)
+        Boundary sample spacing as a fraction of the local width.
+    window_points : int (default: 200000)
+        Polygons with more boundary samples are processed in overlapping
+        windows with about this many samples each.
+    max_points : int (optional)
+        Size budget: maximum number of boundary samples.
+
+    Returns
+    -------
+    A MultiLineString with the centerline segments.
+    """
+    if poly.is_empty:
+        return sg.MultiLineString()
+    (x_min, y_min, x_max, y_max) = poly.bounds
+    # Work in local coordinates for numerical precision.
+    origin = np.array([int(x_min), int(y_min)])
+    local_poly = translate(poly, xoff=-origin[0], yoff=-origin[1])
+    points, spacing = densify_boundary(local_poly, min_spacing, max_spacing,
+                                       width_ratio)
+    if max_points is not None and len(points) > max_points:
+        raise CenterlineBudgetError(
+                'too_large', f'{len(points)} boundary samples, '
+                + f'the budget is {max_points}.')
+
+    (x0, y0) = points.min(axis=0) if len(points) else (0., 0.)
+    (x1, y1) = points.max(axis=0) if len(points) else (0., 0.)
+    n_windows = max(1, int(np.ceil(len(points) / window_points)))
+    size = max(x1 - x0, y1 - y0) / np.sqrt(n_windows)
+    n_x = max(1, int(np.ceil((x1 - x0) / size))) if n_windows > 1 else 1
+    n_y = max(1, int(np.ceil((y1 - y0) / size))) if n_windows > 1 else 1
+    x_edges = np.linspace(x0, x1, n_x + 1)
+    y_edges = np.linspace(y0, y1, n_y + 1)
+    x_edges[-1] = y_edges[-1] = np.inf
+    x_edges[0] = y_edges[0] = -np.inf
+    overlap = 2 * max_spacing / width_ratio
+
+    all_ridges = []
+    for i in range(n_x):
+        for j in range(n_y):
+            core = (x_edges[i], y_edges[j], x_edges[i + 1], y_edges[j + 1])
+            window_overlap = overlap
+            while True:
+                expanded = (core[0] - window_overlap, core[1] - window_overlap,
+                            core[2] + window_overlap, core[3] + window_overlap)
+                ridges, complete = _window_ridges(points, spacing, local_poly,
+                                                  core, expanded)
+                if complete or window_overlap > max(x1 - x0, y1 - y0):
+                    break
+                window_overlap *= 2
+            all_ridges.append(ridges)
+
+    ridges = np.vstack(all_ridges) + np.tile(origin, 2)
+    # Remove duplicate ridges.
+    key = np.hstack((np.minimum(ridges[:, 0:2], ridges[:, 2:4]),
+                     np.maximum(ridges[:, 0:2], ridges[:, 2:4])))
+    ridges = ridges[np.unique(key, axis=0, return_index=True)[1]]
+    return sg.MultiLineString([((r[0], r[1]), (r[2], r[3]))
+                               for r in ridges])
+
+
+def library_centerline(poly, interpolation_distance=0.5, max_points=None):
+    """
+    Compute the centerline using the `centerline` library.
+
+    Parameters
+    ----------
+    poly : Polygon or MultiPolygon
+    interpolation_distance : float (default: 0.5)
+        Distance between boundary samples.
+    max_points : int (optional)
+        Size budget: maximum number of boundary samples.
+    """
+    if max_points is not None:
+        n_points = int(poly.boundary.length / interpolation_distance)
+        if n_points > max_points:
+            raise CenterlineBudgetError(
+                    'too_large', f'{n_points} boundary samples, '
+                    + f'the budget is {max_points}.')
+    centerline = Centerline(poly,
+                            interpolation_distance=interpolation_distance)
+    # With the pinned centerline 0.6.x (see requirements.txt) the result is
+    # a MultiLineString itself; from 1.0 on it is the `geometry` attribute.
+    centerline = getattr(centerline, 'geometry', centerline)
+    # A plain MultiLineString, such that the result can be pickled.
+    return sg.MultiLineString(list(centerline.geoms))
+
+
+CENTERLINE_ENGINES = {'centerline': library_centerline,
+                      'voronoi': voronoi_centerline}
+
+
+def _run_engine(engine, poly, kwargs):
+    """Run an engine and return a tuple (geometry, status, error)."""
+    try:
+        geometry = CENTERLINE_ENGINES[engine](poly, **kwargs)
+    except CenterlineBudgetError as e:
+        return None, e.status, str(e)
+    except Exception as e:
+        return None, 'failed', f'{type(e).__name__}: {e}'
+    if geometry.is_empty:
+        return None, 'empty', None
+    return geometry, 'ok', None
+
+
+def _engine_worker(conn):
+    """Run engines for the polygons received on `conn` until it is closed."""
+    while True:
+        try:
+            engine, poly, kwargs = conn.recv()
+        except EOFError:
+            break
+        conn.send(_run_engine(engine, poly, kwargs))
+
+
+class _EngineWorker:
+    """
+    Worker process that runs the engines under a time budget. The process is
+    started on first use and re-used for every polygon. It is terminated when
+    a polygon exceeds the budget, and started again for the next one.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.pid = None
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.conn, child_conn = multiprocessing.Pipe()
+        # A daemon, such that it does not keep the interpreter from exiting.
+        self.process = multiprocessing.Process(target=_engine_worker,
+                                               args=(child_conn,),
+                                               daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.process = None
+        self.conn = None
+
+    def run(self, engine, poly, kwargs, time_budget):
+        """Run an engine and return a tuple (geometry, status, error)."""
+        if self.pid != os.getpid():
+            # Inherited from the parent process by a fork, not ours to use.
+            self.process = self.conn = None
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self._start()
+        try:
+            self.conn.send((engine, poly, kwargs))
+            if not self.conn.poll(time_budget):
+                self.stop()
+                return (None, 'timeout',
+                        f'Time budget of {time_budget}s exceeded.')
+            return self.conn.recv()
+        except (EOFError, OSError):
+            # The worker died without a result, e.g. out of memory.
+            self.process.join(timeout=1)
+            exitcode = self.process.exitcode
+            self.stop()
+            return (None, 'failed',
+                    f'Worker process exited with code {exitcode}.')
+
+
+# The worker of the current process, see `_EngineWorker`.
+_engine_worker_process = _EngineWorker()
+
+
+def compute_centerline(poly, engine='centerline', time_budget=None,
+                       **kwargs):
+    """
+    Compute the centerline of a polygon with the given engine. Errors are
+    caught and reported in the result.
+
+    Parameters
+    ----------
+    poly : Polygon or MultiPolygon
+    engine : str (default: 'centerline')
+        One of CENTERLINE_ENGINES.
+    time_budget : float (optional)
+        Time budget in seconds. If given, the engine runs in a worker process
+        that is terminated when the budget is exceeded, for any engine. The
+        worker is re-used for the next polygon otherwise.
+    **kwargs
+        Passed to the engine, e.g. `max_points`.
+
+    Returns
+    -------
+    A CenterlineResult.
+    """
+    if engine not in CENTERLINE_ENGINES:
+        raise ValueError(f'Unknown engine: {engine}.')
+    start = time.perf_counter()
+    if time_budget is None:
+        geometry, status, error = _run_engine(engine, poly, kwargs)
+    else:
+        geometry, status, error = _engine_worker_process.run(
+                                        engine, poly, kwargs, time_budget)
+    n_segments = 0 if geometry is None else len(geometry.geoms)
+    return CenterlineResult(geometry, status, error, n_segments,
+                            time.perf_counter() - start)
+
+
+def compare_centerlines(reference, other, tolerance=0.25):
+    """
+    Compare two centerlines, e.g. computed with different engines.
+
+    Returns
+    -------
+    A dict with the length of both centerlines, the fraction of each that
+    lies within `tolerance` of the other, and the Hausdorff distance.
+    """
+    result = {'length_reference': reference.length,
+              'length_other': other.length}
+    if reference.is_empty or other.is_empty:
+        result.update({'reference_covered': 0., 'other_covered': 0.,
+                       'hausdorff': np.inf})
+        return result
+    ref_buffer = reference.buffer(tolerance)
+    other_buffer = other.buffer(tolerance)
+    result['reference_covered'] = (reference.intersection(other_buffer).length
+                                   / max(reference.length, 1e-12))
+    result['other_covered'] = (other.intersection(ref_buffer).length
+                               / max(other.length, 1e-12))
+    result['hausdorff'] = reference.hausdorff_distance(other)
+    return result
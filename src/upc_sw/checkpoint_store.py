@@ -0,0 +1,111 @@
+"""
+Append-only checkpoint store for per-tile (or per-batch) results.
+
+Each result is written once, as a separate GeoParquet shard, and made visible
+with an atomic rename. A crash can therefore never corrupt results that were
+already written, and checking whether a tile is done is a single file lookup.
+The shards are only merged into a single file when the final output is
+needed.
+"""
+
+import os
+
+import pandas as pd
+import geopandas as gpd
+
+import logging
+logger = logging.getLogger(__name__)
+
+SHARD_EXT = '.parquet'
+
+
+class ShardStore:
+    """
+    Store of GeoDataFrame shards, one GeoParquet file per key, e.g. per
+    tilecode. Requires pyarrow.
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which the shards are stored.
+    crs : str (optional)
+        CRS of the merged GeoDataFrame, used when there are no shards.
+    """
+
+    def __init__(self, folder, crs=None):
+        self.folder = folder
+        self.crs = crs
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        key = str(key)
+        if os.sep in key or key.startswith('.'):
+            raise ValueError(f'Invalid shard key: {key}.')
+        return os.path.join(self.folder, key + SHARD_EXT)
+
+    def keys(self):
+        """The keys of all shards in the store."""
+        return {name[:-len(SHARD_EXT)] for name in os.listdir(self.folder)
+                if name.endswith(SHARD_EXT) and not name.startswith('.')}
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def __len__(self):
+        return len(self.keys())
+
+    def write(self, key, gdf):
+        """
+        Write the result for a key. Empty results are stored as well, to
+        mark the key as done.
+        """
+        path = self._path(key)
+        # Hidden temporary file, such that it is never listed as a shard.
+        tmp_path = os.path.join(self.folder,
+                                f'.{key}.{os.getpid()}{SHARD_EXT}')
+        if self.crs is not None and gdf.crs is None:
+            gdf = gdf.set_crs(self.crs)
+        gdf.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def read_shard(self, key):
+        return gpd.read_parquet(self._path(key))
+
+    def iter_shards(self, keys=None):
+        """Yield (key, GeoDataFrame) for each shard, in sorted key order."""
+        for key in sorted(self.keys() if keys is None else keys):
+            yield key, self.read_shard(key)
+
+    def read(self, keys=None):
+        """Read and concatenate all shards (or those in `keys`)."""
+        shards = [gdf for _, gdf in self.iter_shards(keys) if len(gdf) > 0]
+        if len(shards) == 0:
+            return gpd.GeoDataFrame({'geometry': []}, geometry='geometry',
+                                    crs=self.crs)
+        return gpd.GeoDataFrame(pd.concat(shards, ignore_index=True),
+                                crs=shards[0].crs)
+
+    def merge(self, out_file, driver='GPKG'):
+        """
+        Merge all shards into a single file, written atomically.
+
+        Returns
+        -------
+        The number of rows written. No file is written if there are none.
+        """
+        gdf = self.read()
+        if len(gdf) == 0:
+            logger.info(f'No data in {self.folder} to merge.')
+            return 0
+        base, ext = os.path.splitext(out_file)
+        tmp_file = f'{base}.{os.getpid()}.tmp{ext}'
+        gdf.to_file(tmp_file, driver=driver)
+        os.replace(tmp_file, out_file)
+        logger.info(f'{len(gdf)} rows from {len(self)} shards '
+                    + f'written to {out_file}.')
+        return len(gdf)
+
+    def clear(self):
+        """Remove all shards."""
+        for key in self.keys():
+            os.remove(self._path(key))
@@ -1,74 +1,302 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
 from scipy.spatial import ConvexHull
 from shapely.geometry import Polygon, MultiPolygon
+from shapely.ops import unary_union
 
 from upcp.region_growing.label_connected_comp import LabelConnectedComp
 
-from upc_sw.alpha_shape import alpha_shape
+from upc_sw.alpha_shape import alpha_shape, alpha_shape_fast
+import upc_sw.occupancy_grid as occupancy_grid
+import upc_sw.instrumentation as instrumentation
+from upc_sw.point_cloud import LocalPointCloud
 
 import logging
 logger = logging.getLogger(__name__)
 
+ALPHA_ENGINES = {'polygonize': alpha_shape,
+                 'boundary': alpha_shape_fast}
+
+ENGINES = ('hull', 'grid')
+
+
+def group_clusters(point_components):
+    """
+    Group point indices by cluster label using a single sort.
+
+    Parameters
+    ----------
+    point_components : array of shape (n_points,)
+        Cluster label for each point, -1 for noise.
+
+    Returns
+    -------
+    A tuple (labels, order, splits): the sorted unique labels, the point
+    indices sorted by label (noise excluded), and the offsets in `order` at
+    which each next cluster starts.
+    """
+    ids = np.flatnonzero(point_components != -1)
+    order = ids[np.argsort(point_components[ids], kind='stable')]
+    sorted_labels = point_components[order]
+    if len(order) == 0:
+        return sorted_labels, order, np.array([], dtype=int)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_labels)) + 1))
+    return sorted_labels[starts], order, starts[1:]
+
+
+def cluster_to_polygons(cc_points, use_concave=False, concave_min_area=1.,
+                        alpha=0.5, alpha_engine='polygonize'):
+    """Convert the 2D points of a single cluster to a list of polygons."""
+    # Set qhull_options to QJ to prevent errors for near-empty shapes.
+    convex_poly = Polygon(cc_points[ConvexHull(
+                            cc_points, qhull_options='QJ').vertices])
+    if (not use_concave) or convex_poly.area < concave_min_area:
+        if use_concave:
+            instrumentation.count('concave_fallbacks')
+        return [convex_poly]
+    instrumentation.count('concave_hulls')
+    hull, _ = ALPHA_ENGINES[alpha_engine](cc_points, alpha=alpha)
+    if isinstance(hull, MultiPolygon):
+        return list(hull.geoms)
+    return [hull]
+
+
+def _cluster_to_polygons_star(args):
+    return cluster_to_polygons(*args)
+
 
 class Cluster2Polygon:
     """
-    TODO
+    Convert clusters of (obstacle) points to 2D polygons.
+
+    Parameters
+    ----------
+    grid_size : float (default: 0.05)
+        Grid size used for connected component labelling.
+    min_component_size : int (default: 100)
+        Minimum number of points in a cluster.
+    use_concave : bool (default: False)
+        Use a concave hull (alpha shape) for large clusters.
+    concave_min_area : float (default: 1.)
+        Minimum area of the convex hull for the concave hull to be used.
+    alpha : float (default: 0.5)
+        Alpha value for the concave hull.
+    alpha_engine : str (default: 'polygonize')
+        Alpha shape implementation, either 'polygonize' (`alpha_shape`) or
+        'boundary' (`alpha_shape_fast`). Both give the same polygons.
+    n_jobs : int (default: 1)
+        Number of workers used to compute the hulls.
+    executor : str (default: 'thread')
+        Type of pool to use when n_jobs > 1, either 'thread' or 'process'.
+        The pool is created on first use and kept until `close()`.
+    engine : str (default: 'hull')
+        Either 'hull', a convex or concave hull of the points of each
+        cluster, or 'grid', the outline of each component of the occupancy
+        grid (see `occupancy_grid`). The hull options above do not apply to
+        the 'grid' engine.
+    closing : int (default: 0)
+        Iterations of morphological closing of the occupancy grid ('grid'
+        engine only), to fill gaps between occupied cells.
+    opening : int (default: 0)
+        Iterations of morphological opening of the occupancy grid ('grid'
+        engine only), to remove thin protrusions.
+    simplify_tolerance : float (optional)
+        Tolerance to simplify the grid outlines with ('grid' engine only).
+        Defaults to `grid_size`.
+    grid_inset : float (default: 0)
+        Distance to inset the grid outlines by ('grid' engine only), e.g.
+        `grid_size / 2`, see `occupancy_grid.grid_polygons`.
     """
 
     def __init__(self, grid_size=0.05, min_component_size=100,
-                 use_concave=False, concave_min_area=1., alpha=0.5):
+                 use_concave=False, concave_min_area=1., alpha=0.5,
+                 alpha_engine='polygonize', n_jobs=1, executor='thread',
+                 engine='hull', closing=0, opening=0,
+                 simplify_tolerance=None, grid_inset=0.):
         self.grid_size = grid_size
         self.min_component_size = min_component_size
         self.use_concave = use_concave
         self.concave_min_area = concave_min_area
         self.alpha = alpha
+        if alpha_engine not in ALPHA_ENGINES:
+            raise ValueError(f'Unknown alpha_engine: {alpha_engine}.')
+        self.alpha_engine = alpha_engine
+        self.n_jobs = n_jobs
+        self.executor = executor
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine: {engine}.')
+        self.engine = engine
+        self.closing = closing
+        self.opening = opening
+        self.simplify_tolerance = (grid_size if simplify_tolerance is None
+                                   else simplify_tolerance)
+        self.grid_inset = grid_inset
         self.lcc = LabelConnectedComp(
                                 grid_size=self.grid_size,
                                 min_component_size=self.min_component_size)
+        self.timing = {}
+        self._pool = None
+
+    def __getstate__(self):
+        # Worker pools cannot be pickled.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
 
-    def get_obstacle_polygons(self, points):
+    def _get_pool(self):
+        """The worker pool, created on first use and re-used for each call."""
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+        return self._pool
+
+    def close(self):
+        """Shut down the worker pool, if any."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def get_obstacle_polygons(self, points, tilecode=None):
         """
         Returns 2D polygons for each cluster in the given set of points.
 
         Parameters
         ----------
-        points : array of shape (n_points, 3)
-            The point cloud <x, y, z>.
+        points : array of shape (n_points, 3) or LocalPointCloud
+            The point cloud <x, y, z>. A LocalPointCloud is processed in
+            float32 relative to its origin, see `LocalPointCloud.local_xy`.
+        tilecode : str (optional)
+            Used to report the timing for this tile.
 
         Returns
         -------
-        A list of Shapely Polygons.
+        A list of Shapely Polygons, and a list with their types.
         """
-        point_components = self.lcc.get_components(points[:, :2])
-        cc_labels = np.unique(point_components)
-        cc_labels = set(cc_labels).difference((-1,))
+        start = time.perf_counter()
+        local_cloud = None
+        if isinstance(points, LocalPointCloud):
+            # Only x and y are needed: work in float32 relative to the local
+            # origin, and translate the polygons back at the end.
+            local_cloud = points
+            points = points.local_xy(dtype=np.float32)
+        if self.engine == 'grid':
+            labels, origin, n_clusters = self._grid_components(points)
+            t_components = t_grouping = time.perf_counter()
+            cluster_polygons = occupancy_grid.grid_polygons(
+                                        labels, origin, self.grid_size,
+                                        self.simplify_tolerance,
+                                        self.grid_inset)
+        else:
+            point_components = self.lcc.get_components(points[:, :2])
+            t_components = time.perf_counter()
+            cluster_polygons, n_clusters, t_grouping = self._hull_polygons(
+                                                    points, point_components)
 
-        # Convert clusters to polygons.
         obstacle_polygons = []
         obstacle_types = []
-        for cc in cc_labels:
-            # select points that belong to the cluster
-            cc_mask = (point_components == cc)
-            cc_points = points[cc_mask, :2]
+        for polygons in cluster_polygons:
             # TODO: use labels to determine obstacle type.
             obstacle_type = 'obstacle'
-            # Set qhull_options to QJ to prevent errors for near-empty shapes.
-            convex_poly = Polygon(cc_points[ConvexHull(
-                                    cc_points, qhull_options='QJ').vertices])
-            if ((not self.use_concave)
-                    or convex_poly.area < self.concave_min_area):
-                obstacle_polygons.append(convex_poly)
-                obstacle_types.append(obstacle_type)
-            else:
-                hull, _ = alpha_shape(cc_points, alpha=self.alpha)
-                if type(hull) == MultiPolygon:
-                    for part in hull.geoms:
-                        obstacle_polygons.append(part)
-                        obstacle_types.append(obstacle_type)
-                else:
-                    obstacle_polygons.append(hull)
-                    obstacle_types.append(obstacle_type)
+            obstacle_polygons.extend(polygons)
+            obstacle_types.extend([obstacle_type] * len(polygons))
+        if local_cloud is not None:
+            obstacle_polygons = [local_cloud.to_global(poly)
+                                 for poly in obstacle_polygons]
+        end = time.perf_counter()
 
-        logger.debug(f'{len(obstacle_polygons)} obstacles polygons extracted.')
+        self.timing = {'tilecode': tilecode,
+                       'n_points': len(points),
+                       'n_clusters': n_clusters,
+                       'components': t_components - start,
+                       'grouping': t_grouping - t_components,
+                       'hulls': end - t_grouping,
+                       'total': end - start}
+        for stage in ('components', 'grouping', 'hulls'):
+            instrumentation.add_time(stage, self.timing[stage])
+        instrumentation.count('clusters', n_clusters)
+        instrumentation.count('obstacle_polygons', len(obstacle_polygons))
+        logger.info(f'{len(obstacle_polygons)} obstacles polygons extracted'
+                    + (f' for tile {tilecode}' if tilecode else '')
+                    + f' in {self.timing["total"]:.2f}s '
+                    + f'({n_clusters} clusters).')
 
         return obstacle_polygons, obstacle_types
+
+    def _hull_polygons(self, points, point_components):
+        """
+        Compute the hulls of the clusters. Returns the polygons of each
+        cluster, in order of increasing cluster label, the number of
+        clusters, and the time at which the clusters were grouped.
+        """
+        # Group the points per cluster: a single gather, then views. The
+        # clusters are sorted by label, as np.unique(labels[labels != -1]).
+        cc_labels, order, splits = group_clusters(point_components)
+        clusters = np.split(points[order, :2], splits) if len(order) else []
+        t_grouping = time.perf_counter()
+
+        # Convert clusters to polygons.
+        args = [(cc_points, self.use_concave, self.concave_min_area,
+                 self.alpha, self.alpha_engine) for cc_points in clusters]
+        if self.n_jobs > 1 and len(args) > 1:
+            cluster_polygons = list(self._get_pool().map(
+                                    _cluster_to_polygons_star, args,
+                                    chunksize=max(1, len(args)
+                                                  // (4 * self.n_jobs))))
+        else:
+            cluster_polygons = [cluster_to_polygons(*arg) for arg in args]
+        return cluster_polygons, len(cc_labels), t_grouping
+
+    def _grid_components(self, points):
+        """
+        Label the components of the occupancy grid. Returns the labelled
+        grid, its origin and the number of components.
+        """
+        if len(points) == 0:
+            return np.zeros((0, 0), dtype=int), np.zeros((2,)), 0
+        counts, origin = occupancy_grid.rasterize(
+                                points[:, :2], self.grid_size,
+                                pad=1 + self.closing)
+        labels, n_components = occupancy_grid.label_grid(
+                            counts, self.min_component_size, self.closing,
+                            self.opening)
+        return labels, origin, n_components
+
+
+def compare_polygons(polygons, reference):
+    """
+    Compare obstacle polygons to reference polygons, e.g. those of another
+    engine, by their total area and intersection over union.
+
+    Returns
+    -------
+    A dict with 'area', 'reference_area', 'area_ratio' and 'iou'.
+    """
+    geom = unary_union(polygons)
+    ref = unary_union(reference)
+    union = geom.union(ref).area
+    return {'area': geom.area,
+            'reference_area': ref.area,
+            'area_ratio': geom.area / ref.area if ref.area > 0 else np.nan,
+            'iou': geom.intersection(ref).area / union if union > 0
+            else np.nan}
+
+
+def compare_engines(points, engine='grid', reference_engine='hull',
+                    **kwargs):
+    """
+    Compute the obstacle polygons with two engines and compare them with
+    `compare_polygons`. Further arguments are passed to both
+    Cluster2Polygon instances.
+    """
+    polygons, _ = Cluster2Polygon(engine=engine,
+                                  **kwargs).get_obstacle_polygons(points)
+    reference, _ = Cluster2Polygon(engine=reference_engine,
+                                   **kwargs).get_obstacle_polygons(points)
+    result = compare_polygons(polygons, reference)
+    result.update({'n_polygons': len(polygons),
+                   'reference_n_polygons': len(reference)})
+    return result
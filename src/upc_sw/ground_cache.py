@@ -0,0 +1,248 @@
+"""
+In-memory cache of AHN surface grids, shared by all stages that need the
+ground elevation of a tile.
+
+`GroundSurfaceCache` can be used in place of the upcp `NPZReader`: it has the
+same `filter_tile` and `interpolate` methods, but keeps the decoded grids of
+the most recently used tiles in memory, up to a memory budget. When a
+`cache_folder` is given, the grids are also stored as .npy files that are
+memory-mapped on later loads, such that runs, worker processes and
+subsequent sessions share a single decoded copy.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import upc_sw.instrumentation as instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Names of the surfaces in the pre-processed AHN .npz files.
+NPZ_SURFACES = {'ground_surface': 'ground', 'building_surface': 'building'}
+
+
+def height_band_mask(z, ground_z, max_height, min_height=0.):
+    """
+    Mask of points between `min_height` (exclusive) and `max_height`
+    (inclusive) above the ground. Points without ground elevation (NaN) are
+    never included.
+    """
+    with np.errstate(invalid='ignore'):
+        return (z > ground_z + min_height) & (z <= ground_z + max_height)
+
+
+def _axis_weights(coords, axis):
+    """
+    Cell index and interpolation weight of each coordinate along a grid
+    axis, which can be ascending or descending. Coordinates outside the axis
+    get index -1.
+    """
+    descending = axis[0] > axis[-1]
+    if descending:
+        axis = axis[::-1]
+    idx = np.searchsorted(axis, coords, side='right') - 1
+    # Coordinates on the last grid line belong to the last cell.
+    idx[coords == axis[-1]] = len(axis) - 2
+    outside = (idx < 0) | (idx > len(axis) - 2)
+    idx = np.clip(idx, 0, len(axis) - 2)
+    t = (coords - axis[idx]) / (axis[idx + 1] - axis[idx])
+    if descending:
+        idx = len(axis) - 2 - idx
+        t = 1 - t
+    idx[outside] = -1
+    return idx, t
+
+
+def interpolate_grid(x, y, grid, points):
+    """
+    Bilinear interpolation of a regular grid `grid[j, i]` at (x[i], y[j]) for
+    the given points. Points outside the grid, or next to a grid cell without
+    data, get NaN.
+    """
+    i, tx = _axis_weights(points[:, 0], x)
+    j, ty = _axis_weights(points[:, 1], y)
+    inside = (i >= 0) & (j >= 0)
+    z = np.full((len(points),), np.nan)
+    i, j, tx, ty = i[inside], j[inside], tx[inside], ty[inside]
+    z[inside] = ((1 - tx) * (1 - ty) * grid[j, i]
+                 + tx * (1 - ty) * grid[j, i + 1]
+                 + (1 - tx) * ty * grid[j + 1, i]
+                 + tx * ty * grid[j + 1, i + 1])
+    return z
+
+
+class GroundSurfaceCache:
+    """
+    Least recently used cache of decoded AHN surface grids, with the same
+    interface as the upcp `NPZReader`.
+
+    Parameters
+    ----------
+    data_folder : str
+        Folder with the pre-processed AHN .npz files.
+    cache_folder : str (optional)
+        Folder for decoded .npy grids. These are memory-mapped when loaded,
+        and can be shared between processes and sessions.
+    memory_budget : int (default: 1e9)
+        Maximum number of bytes of grids to keep in memory. The most recently
+        used tile is always kept.
+    stitch_neighbours : bool (default: False)
+        Extend each grid by one cell on every side with the data of the
+        neighbouring tiles, such that points near the tile edge can be
+        interpolated as well. Without this, these points get NaN, as with
+        the `NPZReader`.
+    dtype : data-type (optional)
+        Data type of the surface grids, e.g. np.float32 to halve their
+        memory. By default the grids keep the data type of the .npz files,
+        as with the `NPZReader`.
+    """
+
+    def __init__(self, data_folder, cache_folder=None, memory_budget=1e9,
+                 stitch_neighbours=False, dtype=None):
+        self.data_folder = data_folder
+        self.cache_folder = cache_folder
+        self.memory_budget = memory_budget
+        self.stitch_neighbours = stitch_neighbours
+        self.dtype = dtype
+        if cache_folder is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def stats(self):
+        """Dict with the number of cache hits, misses and evicted tiles."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted, 'tiles': len(self.tiles),
+                'nbytes': self.nbytes}
+
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+
+    def _npz_file(self, tilecode):
+        return os.path.join(self.data_folder, f'ahn_{tilecode}.npz')
+
+    def _npy_file(self, tilecode, key):
+        dtype = 'native' if self.dtype is None else np.dtype(self.dtype).name
+        return os.path.join(self.cache_folder,
+                            f'ahn_{tilecode}_{key}_{dtype}.npy')
+
+    def _load_raw(self, tilecode):
+        """Load the grids of a tile from disk, or None if there is no data."""
+        keys = ['x', 'y'] + list(NPZ_SURFACES.keys())
+        if (self.cache_folder is not None
+                and all(os.path.isfile(self._npy_file(tilecode, key))
+                        for key in keys)):
+            return {key: np.load(self._npy_file(tilecode, key),
+                                 mmap_mode='r')
+                    for key in keys}
+        npz_file = self._npz_file(tilecode)
+        if not os.path.isfile(npz_file):
+            return None
+        with np.load(npz_file) as data:
+            raw = {'x': data['x'], 'y': data['y']}
+            for surface, name in NPZ_SURFACES.items():
+                raw[surface] = (data[name] if self.dtype is None
+                                else data[name].astype(self.dtype))
+        if self.cache_folder is not None:
+            for key, values in raw.items():
+                path = self._npy_file(tilecode, key)
+                tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+                np.save(tmp_path, values)
+                os.replace(tmp_path, path)
+            return self._load_raw(tilecode)
+        return raw
+
+    def _stitch(self, tilecode, tile):
+        """Pad the grids of a tile with the edges of its neighbours."""
+        tile_x, tile_y = (int(c) for c in tilecode.split('_'))
+        x, y = np.asarray(tile['x']), np.asarray(tile['y'])
+        stitched = {'x': np.concatenate(([2 * x[0] - x[1]], x,
+                                         [2 * x[-1] - x[-2]])),
+                    'y': np.concatenate(([2 * y[0] - y[1]], y,
+                                         [2 * y[-1] - y[-2]]))}
+        for surface in NPZ_SURFACES:
+            # A floating point type, for the cells without data (NaN).
+            dtype = np.result_type(tile[surface].dtype, np.float32)
+            grid = np.full((len(y) + 2, len(x) + 2), np.nan, dtype=dtype)
+            grid[1:-1, 1:-1] = tile[surface]
+            stitched[surface] = grid
+        # Slices (source, destination) for a neighbour offset. The y-axis of
+        # the grid is descending, i.e. the northern neighbour is on top.
+        col_slices = {-1: (-1, 0), 0: (slice(None), slice(1, -1)), 1: (0, -1)}
+        row_slices = {1: (-1, 0), 0: (slice(None), slice(1, -1)), -1: (0, -1)}
+        if y[0] < y[-1]:
+            row_slices[1], row_slices[-1] = row_slices[-1], row_slices[1]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if dx == 0 and dy == 0:
+                    continue
+                neighbour = self._load_raw(f'{tile_x + dx}_{tile_y + dy}')
+                if (neighbour is None
+                        or neighbour['ground_surface'].shape
+                        != tile['ground_surface'].shape):
+                    continue
+                src_col, dst_col = col_slices[dx]
+                src_row, dst_row = row_slices[dy]
+                for surface in NPZ_SURFACES:
+                    stitched[surface][dst_row, dst_col] = (
+                                neighbour[surface][src_row, src_col])
+        return stitched
+
+    def _evict(self):
+        while self.nbytes > self.memory_budget and len(self.tiles) > 1:
+            _, tile = self.tiles.popitem(last=False)
+            self.nbytes -= sum(v.nbytes for v in tile.values())
+            self.evicted += 1
+
+    def filter_tile(self, tilecode):
+        """
+        Get the grids of a tile as a dict with keys 'x', 'y',
+        'ground_surface' and 'building_surface', or None if there is no AHN
+        data for the tile.
+        """
+        if tilecode in self.tiles:
+            self.hits += 1
+            instrumentation.count('ground_cache_hits')
+            self.tiles.move_to_end(tilecode)
+            return self.tiles[tilecode]
+        self.misses += 1
+        instrumentation.count('ground_cache_misses')
+        with instrumentation.timer('ground_cache_load'):
+            tile = self._load_raw(tilecode)
+            if tile is None:
+                logger.error(f'No AHN data found for tile {tilecode}.')
+                return None
+            if self.stitch_neighbours:
+                tile = self._stitch(tilecode, tile)
+        self.tiles[tilecode] = tile
+        self.nbytes += sum(v.nbytes for v in tile.values())
+        self._evict()
+        return tile
+
+    def interpolate(self, tilecode, points=None, mask=None,
+                    surface='ground_surface'):
+        """
+        Bilinear interpolation of a surface at the given points, for points
+        in `mask` if given. Returns NaN where there is no elevation data.
+        """
+        if points is None:
+            raise ValueError('Please provide points to interpolate.')
+        if surface not in NPZ_SURFACES:
+            raise ValueError(f'Unknown surface: {surface}.')
+        if mask is not None:
+            points = points[mask]
+        tile = self.filter_tile(tilecode)
+        if tile is None:
+            return np.full((len(points),), np.nan)
+        return interpolate_grid(tile['x'], tile['y'], tile[surface], points)
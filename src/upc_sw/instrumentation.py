@@ -0,0 +1,200 @@
+"""
+Lightweight instrumentation for the upc_sw stages: timers, counters and
+memory samples, collected per scope (e.g. a tile or a polygon) and written as
+one JSON line per scope.
+
+Instrumentation is disabled by default, in which case all hooks return
+immediately. Enable it with `enable()`:
+
+    instrumentation.enable('stats.jsonl', profile_ids={'2386_9702'},
+                           profile_dir='profiles/')
+    with instrumentation.scope('tile', tilecode):
+        with instrumentation.timer('clip'):
+            ...
+        instrumentation.count('points_clipped', n)
+
+State is kept per process. Counts made in worker processes (e.g. when hulls
+are computed in a process pool) are only recorded if instrumentation is
+enabled in those processes as well.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The active recorder, None when disabled.
+_recorder = None
+_null = contextlib.nullcontext()
+
+
+class _Scope:
+    def __init__(self, kind, scope_id):
+        self.kind = kind
+        self.scope_id = scope_id
+        self.timers = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+
+class Recorder:
+    """
+    Collects the timers and counters of nested scopes and writes a JSON line
+    for each scope when it ends. Use `enable()` rather than creating a
+    Recorder directly.
+
+    Parameters
+    ----------
+    path : str (optional)
+        JSON lines file the records are appended to. If not given, records
+        are logged at INFO level.
+    trace_memory : bool (default: False)
+        Record the peak memory allocated by Python and NumPy in each scope,
+        using tracemalloc. This slows down pure Python code.
+    profile_ids : set (optional)
+        Scope ids (e.g. tilecodes) to run under cProfile.
+    profile_dir : str (optional)
+        Folder for the cProfile stats, one `<kind>_<id>.prof` file per
+        profiled scope.
+    """
+
+    def __init__(self, path=None, trace_memory=False, profile_ids=None,
+                 profile_dir=None):
+        self.path = path
+        self.trace_memory = trace_memory
+        self.profile_ids = set(profile_ids or ())
+        self.profile_dir = profile_dir
+        self.stack = []
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        if self.profile_ids and profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            if self.stack:
+                timers = self.stack[-1].timers
+                timers[stage] = timers.get(stage, 0.) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + n
+            if self.stack:
+                counters = self.stack[-1].counters
+                counters[name] = counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def scope(self, kind, scope_id):
+        scope = _Scope(kind, scope_id)
+        profiler = None
+        if scope_id in self.profile_ids:
+            profiler = cProfile.Profile()
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.stack.append(scope)
+        status = 'ok'
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield scope
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._dump_profile(profiler, kind, scope_id)
+            self.stack.pop()
+            self._emit(scope, status)
+
+    def _dump_profile(self, profiler, kind, scope_id):
+        folder = self.profile_dir or '.'
+        path = os.path.join(folder, f'{kind}_{scope_id}.prof')
+        profiler.dump_stats(path)
+        logger.info(f'Profile for {kind} {scope_id} written to {path}.')
+
+    def _emit(self, scope, status):
+        record = {'scope': scope.kind, 'id': scope.scope_id,
+                  'status': status, 'pid': os.getpid(),
+                  'duration': time.perf_counter() - scope.start,
+                  'timers': scope.timers, 'counters': scope.counters,
+                  # Peak resident memory of the process, in kilobytes.
+                  'max_rss': resource.getrusage(
+                                    resource.RUSAGE_SELF).ru_maxrss}
+        if self.trace_memory:
+            record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        line = json.dumps(record, default=str)
+        if self.path is None:
+            logger.info(line)
+            return
+        # A single write per line, such that processes can share the file.
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+def enable(path=None, trace_memory=False, profile_ids=None, profile_dir=None):
+    """Enable instrumentation in this process. See `Recorder`."""
+    global _recorder
+    _recorder = Recorder(path, trace_memory, profile_ids, profile_dir)
+    return _recorder
+
+
+def disable():
+    """Disable instrumentation in this process."""
+    global _recorder
+    if _recorder is not None and _recorder.started_tracing:
+        tracemalloc.stop()
+    _recorder = None
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def totals():
+    """Counter totals over all scopes since instrumentation was enabled."""
+    return {} if _recorder is None else dict(_recorder.totals)
+
+
+def scope(kind, scope_id):
+    """Context manager for a scope, e.g. scope('tile', tilecode)."""
+    if _recorder is None:
+        return _null
+    return _recorder.scope(kind, scope_id)
+
+
+def timer(stage):
+    """Context manager that adds the elapsed time to a stage timer."""
+    if _recorder is None:
+        return _null
+    return _recorder.timer(stage)
+
+
+def add_time(stage, seconds):
+    """Add an already measured duration to a stage timer."""
+    if _recorder is not None:
+        _recorder.add_time(stage, seconds)
+
+
+def count(name, n=1):
+    """Increase a counter in the current scope."""
+    if _recorder is not None:
+        _recorder.count(name, n)
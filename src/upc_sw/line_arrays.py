@@ -0,0 +1,244 @@
+"""
+Coordinate-array (ragged array) versions of the line operations in
+`poly_utils`.
+
+Lines are stored as a flat array of coordinates of shape (n_vertices, 2) with
+an array of offsets of shape (n_parts + 1,), such that part `i` consists of
+the vertices `coords[offsets[i]:offsets[i+1]]`. Straight segments are stored
+as arrays of start and end points. Shapely geometries are only created at the
+output, by `to_linestrings` and `to_multipoint`.
+"""
+
+import numpy as np
+import shapely.geometry as sg
+
+
+def from_lines(lines):
+    """
+    Ragged coordinate arrays of the LineString parts of (Multi)LineStrings.
+    Empty parts and other geometry types are skipped.
+
+    Parameters
+    ----------
+    lines : (Multi)LineString or sequence of (Multi)LineStrings
+
+    Returns
+    -------
+    A tuple (coords, offsets, line_offsets), where `line_offsets` of shape
+    (n_lines + 1,) gives the parts of each input line.
+    """
+    if isinstance(lines, sg.base.BaseGeometry):
+        lines = [lines]
+    parts = []
+    n_parts = []
+    for line in lines:
+        if line is None or not hasattr(line, 'type'):
+            line_parts = []
+        elif line.type == 'MultiLineString':
+            line_parts = list(line.geoms)
+        elif line.type == 'LineString':
+            line_parts = [line]
+        else:
+            line_parts = []
+        line_parts = [np.asarray(part.coords)[:, :2] for part in line_parts
+                      if not part.is_empty]
+        parts.extend(line_parts)
+        n_parts.append(len(line_parts))
+    return from_coords(parts) + (_offsets(n_parts),)
+
+
+def from_coords(parts):
+    """
+    Ragged coordinate arrays from a list of coordinate arrays.
+
+    Returns
+    -------
+    A tuple (coords, offsets).
+    """
+    if len(parts) == 0:
+        return np.empty((0, 2)), np.zeros((1,), dtype=int)
+    coords = np.vstack([np.asarray(part, dtype=float)[:, :2]
+                        for part in parts])
+    return coords, _offsets([len(part) for part in parts])
+
+
+def _offsets(counts):
+    return np.concatenate(([0], np.cumsum(counts, dtype=int)))
+
+
+def segments(coords, offsets):
+    """
+    The straight segments between consecutive vertices of each part, as in
+    `poly_utils.get_segments`.
+
+    Returns
+    -------
+    A tuple (starts, ends, part_ids) with arrays of shape (n_segments, 2)
+    and the part of each segment.
+    """
+    part_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    ids = np.flatnonzero(part_of[:-1] == part_of[1:])
+    return coords[ids], coords[ids + 1], part_of[ids]
+
+
+def cut_segments(starts, ends, max_length, tolerance=0.001):
+    """
+    Cut straight segments into pieces of `max_length`, the last piece of each
+    segment being shorter. This is the same as splitting each segment at the
+    points of `poly_utils.get_points_on_line`, where a cut point within
+    `tolerance` of the end of the segment is ignored.
+
+    Returns
+    -------
+    A tuple (piece_starts, piece_ends, offsets), where `offsets` of shape
+    (n_segments + 1,) gives the pieces of each segment.
+    """
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    lengths = np.hypot(*(ends - starts).T)
+    n_pieces = np.maximum(np.ceil(lengths / max_length), 1).astype(int)
+    last_cut = (n_pieces - 1) * max_length
+    n_pieces[(n_pieces > 1) & (lengths - last_cut <= tolerance)] -= 1
+
+    # Cumulative distance of the start of each piece along its segment.
+    offsets = _offsets(n_pieces)
+    seg_ids = np.repeat(np.arange(len(starts)), n_pieces)
+    piece_nr = np.arange(len(seg_ids)) - offsets[seg_ids]
+    dist = piece_nr * max_length
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(lengths[seg_ids] > 0, dist / lengths[seg_ids], 0.)
+    vec = ends[seg_ids] - starts[seg_ids]
+    piece_starts = starts[seg_ids] + frac[:, None] * vec
+    piece_starts[piece_nr == 0] = starts
+    # Each piece ends where the next one starts, the last one at the end of
+    # its segment.
+    piece_ends = np.empty_like(piece_starts)
+    piece_ends[:-1] = piece_starts[1:]
+    piece_ends[offsets[1:] - 1] = ends
+    return piece_starts, piece_ends, offsets
+
+
+def segment_coords(starts, ends):
+    """Ragged coordinate arrays with a two-vertex part per segment."""
+    coords = np.empty((2 * len(starts), 2))
+    coords[0::2] = starts
+    coords[1::2] = ends
+    return coords, np.arange(0, len(coords) + 1, 2)
+
+
+def part_lengths(coords, offsets):
+    """The length of each part."""
+    seg_len = np.zeros((len(coords),))
+    if len(coords) > 1:
+        seg_len[:-1] = np.hypot(*np.diff(coords, axis=0).T)
+    # Steps between parts do not count.
+    seg_len[offsets[1:-1] - 1] = 0
+    lengths = np.zeros((len(offsets) - 1,))
+    nonempty = np.diff(offsets) > 0
+    if nonempty.any():
+        lengths[nonempty] = np.add.reduceat(seg_len, offsets[:-1][nonempty])
+    return seg_len, lengths
+
+
+def locate(coords, offsets, dist):
+    """
+    The part and the distance along that part for distances measured along
+    all parts in sequence, as for a MultiLineString in Shapely.
+
+    Returns
+    -------
+    A tuple (part_ids, part_dist).
+    """
+    _, lengths = part_lengths(coords, offsets)
+    cum_len = np.concatenate(([0.], np.cumsum(lengths)))
+    part_ids = np.clip(np.searchsorted(cum_len, dist, side='right') - 1,
+                       0, max(len(lengths) - 1, 0))
+    return part_ids, dist - cum_len[part_ids]
+
+
+def points_at_distance(coords, offsets, part_ids, dist):
+    """
+    Points at distances along the parts, as by Shapely's `interpolate`.
+    The distances are clamped to the parts.
+
+    Parameters
+    ----------
+    coords, offsets : ragged coordinate arrays
+    part_ids : array of int
+        The part of each point.
+    dist : array of float
+        The distance of each point from the start of its part.
+
+    Returns
+    -------
+    An array of shape (n_points, 2).
+    """
+    part_ids = np.asarray(part_ids, dtype=int)
+    dist = np.asarray(dist, dtype=float)
+    if len(dist) == 0:
+        return np.empty((0, 2))
+    seg_len, lengths = part_lengths(coords, offsets)
+    dist = np.clip(dist, 0, lengths[part_ids])
+    cum_len = np.concatenate(([0.], np.cumsum(seg_len)))
+    first = offsets[:-1][part_ids]
+    last_seg = np.maximum(offsets[1:][part_ids] - 2, first)
+    idx = np.searchsorted(cum_len, cum_len[first] + dist, side='right') - 1
+    idx = np.minimum(np.maximum(idx, first), last_seg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(seg_len[idx] > 0,
+                        (dist - (cum_len[idx] - cum_len[first]))
+                        / seg_len[idx], 0.)
+    nxt = np.minimum(idx + 1, len(coords) - 1)
+    return coords[idx] + frac[:, None] * (coords[nxt] - coords[idx])
+
+
+def sample_points(coords, offsets, resolution=1):
+    """
+    Sample points along each part, using the scheme of
+    `poly_utils.interpolate_by_distance`: points every `resolution` meters
+    starting at the first vertex (the last one clamped to the end of the
+    part), or the midpoint for very short parts.
+
+    Returns
+    -------
+    A tuple (points, point_offsets), where `point_offsets` of shape
+    (n_parts + 1,) gives the points of each part.
+    """
+    _, lengths = part_lengths(coords, offsets)
+    counts = np.round(lengths / resolution).astype(int) + 1
+    point_offsets = _offsets(counts)
+    part_ids = np.repeat(np.arange(len(lengths)), counts)
+    point_nr = np.arange(len(part_ids)) - point_offsets[part_ids]
+    dist = np.where(counts[part_ids] == 1, lengths[part_ids] / 2,
+                    np.minimum(resolution * point_nr, lengths[part_ids]))
+    return (points_at_distance(coords, offsets, part_ids, dist),
+            point_offsets)
+
+
+def equidistant_points(coords, offsets, distance_delta):
+    """
+    Points every `distance_delta` meters along each part, starting at the
+    first vertex and excluding the end, as `poly_utils.get_points_on_line`.
+
+    Returns
+    -------
+    A tuple (points, point_offsets).
+    """
+    _, lengths = part_lengths(coords, offsets)
+    counts = np.ceil(lengths / distance_delta).astype(int)
+    point_offsets = _offsets(counts)
+    part_ids = np.repeat(np.arange(len(lengths)), counts)
+    dist = (np.arange(len(part_ids)) - point_offsets[part_ids]) \
+        * distance_delta
+    return (points_at_distance(coords, offsets, part_ids, dist),
+            point_offsets)
+
+
+def to_linestrings(starts, ends):
+    """Create a LineString for each segment."""
+    return [sg.LineString([tuple(s), tuple(e)])
+            for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+def to_multipoint(points):
+    return sg.MultiPoint([tuple(p) for p in np.asarray(points).tolist()])
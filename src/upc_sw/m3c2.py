@@ -0,0 +1,362 @@
+"""
+Native M3C2 change detection between two point clouds of the same area.
+
+The distances follow the M3C2 algorithm of Lague et al. (2013) as implemented
+by the CloudCompare plugin, using the same parameter file (see
+`datasets/m3c2_params.txt`). Core points are all points of the first cloud.
+For each core point a normal is estimated from the first cloud, after which
+the points of both clouds in a cylinder along this normal are projected on
+it. The M3C2 distance is the difference between the mean (or median)
+position of the second and the first cloud.
+
+Supported parameters:
+    NormalMode (0: single scale, 2: multi scale, 3: vertical),
+    NormalScale, NormalMinScale, NormalStep, NormalMaxScale,
+    NormalPreferedOri (0-5: +X, -X, +Y, -Y, +Z, -Z),
+    SearchScale, SearchDepth, PositiveSearchOnly, UseSinglePass4Depth,
+    UseMedian, UseMinPoints4Stat, MinPoints4Stat, MaxThreadCount.
+Other parameters (sub-sampling, precision maps, registration error) are
+ignored.
+"""
+
+import configparser
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import upc_sw.instrumentation as instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+NORMAL_MODES = {0: 'single', 2: 'multi', 3: 'vertical'}
+
+ORIENTATIONS = {0: (1, 0, 0), 1: (-1, 0, 0), 2: (0, 1, 0), 3: (0, -1, 0),
+                4: (0, 0, 1), 5: (0, 0, -1)}
+
+# Parameters that change the result but are not supported.
+_UNSUPPORTED = {'SubsampleEnabled': False, 'UsePrecisionMaps': False,
+                'RegistrationErrorEnabled': False}
+
+# State of the worker processes, set by `_init_worker`.
+_worker_m3c2 = None
+
+
+def _parse_value(value):
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_m3c2_params(param_file):
+    """
+    Read a CloudCompare M3C2 parameter file into a dict. Booleans and
+    numbers are converted, placeholders such as '{cpu_count}' are kept as
+    strings.
+    """
+    parser = configparser.ConfigParser()
+    # Keep the case of the parameter names.
+    parser.optionxform = str
+    if not parser.read(param_file):
+        raise FileNotFoundError('M3C2 parameter file not found: '
+                                + f'{param_file}')
+    section = (parser['General'] if parser.has_section('General')
+               else parser[parser.default_section])
+    return {key: _parse_value(value) for key, value in section.items()}
+
+
+def _ball_pairs(tree, centers, radius):
+    """
+    Flattened result of a ball query: for each neighbour the index of the
+    center it belongs to, and its index in the tree.
+    """
+    neighbours = tree.query_ball_point(centers, radius, return_sorted=False)
+    counts = np.fromiter(map(len, neighbours), dtype=np.int64,
+                         count=len(neighbours))
+    owner = np.repeat(np.arange(len(centers)), counts)
+    idx = np.fromiter(itertools.chain.from_iterable(neighbours),
+                      dtype=np.int64, count=counts.sum())
+    return owner, idx
+
+
+def pca_normals(points, tree, core_points, radius):
+    """
+    Normals of the neighbourhoods of the core points, computed for all core
+    points at once.
+
+    Returns
+    -------
+    The (unoriented) normals, and the surface variation (smallest eigenvalue
+    divided by the sum of the eigenvalues) of each neighbourhood. Both are
+    NaN for core points with less than 3 neighbours.
+    """
+    owner, idx = _ball_pairs(tree, core_points, radius)
+    n_core = len(core_points)
+    counts = np.bincount(owner, minlength=n_core)
+    # Coordinates relative to the core point, for numerical stability.
+    d = points[idx] - core_points[owner]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.stack([np.bincount(owner, d[:, k], n_core)
+                         for k in range(3)], axis=1) / counts[:, None]
+        cov = np.empty((n_core, 3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                cov[:, i, j] = (np.bincount(owner, d[:, i] * d[:, j], n_core)
+                                / counts - mean[:, i] * mean[:, j])
+                cov[:, j, i] = cov[:, i, j]
+    valid = counts >= 3
+    normals = np.full((n_core, 3), np.nan)
+    variation = np.full((n_core,), np.nan)
+    if np.any(valid):
+        eig_values, eig_vectors = np.linalg.eigh(cov[valid])
+        normals[valid] = eig_vectors[:, :, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variation[valid] = eig_values[:, 0] / eig_values.sum(axis=1)
+    return normals, variation
+
+
+def _central_values(owner, h, n_core, use_median):
+    """Count and mean (or median) of the projections `h` per core point."""
+    counts = np.bincount(owner, minlength=n_core)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if not use_median:
+            return counts, np.bincount(owner, h, n_core) / counts
+    center = np.full((n_core,), np.nan)
+    h_sorted = h[np.lexsort((h, owner))]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    has_points = counts > 0
+    lo = (starts + (counts - 1) // 2)[has_points]
+    hi = (starts + counts // 2)[has_points]
+    center[has_points] = (h_sorted[lo] + h_sorted[hi]) / 2
+    return counts, center
+
+
+class M3C2:
+    """
+    M3C2 distances between two point clouds, from the first to the second.
+
+    Parameters
+    ----------
+    param_file : str (optional)
+        CloudCompare M3C2 parameter file, e.g. `datasets/m3c2_params.txt`.
+    params : dict (optional)
+        Parameters, overriding those in the file.
+    n_workers : int (optional)
+        Number of worker processes. Defaults to MaxThreadCount, or the number
+        of CPUs if this is not a number. Use 1 to run in this process.
+    batch_size : int (default: 20000)
+        Number of core points processed at a time.
+    """
+
+    def __init__(self, param_file=None, params=None, n_workers=None,
+                 batch_size=20000):
+        self.params = {}
+        if param_file is not None:
+            self.params.update(read_m3c2_params(param_file))
+        self.params.update(params or {})
+        p = self.params
+
+        mode = p.get('NormalMode', 0)
+        if mode not in NORMAL_MODES:
+            raise ValueError(f'Unsupported NormalMode: {mode}.')
+        self.normal_mode = NORMAL_MODES[mode]
+        orientation = p.get('NormalPreferedOri', 4)
+        if orientation not in ORIENTATIONS:
+            raise ValueError(f'Unsupported NormalPreferedOri: {orientation}.')
+        self.orientation = np.array(ORIENTATIONS[orientation], dtype=float)
+        # Scales in the parameter file are diameters.
+        if self.normal_mode == 'multi':
+            self.normal_radii = np.arange(
+                                p['NormalMinScale'],
+                                p['NormalMaxScale'] + p['NormalStep'] / 2,
+                                p['NormalStep']) / 2
+        else:
+            self.normal_radii = np.array([p.get('NormalScale', 1.)]) / 2
+        self.search_radius = p.get('SearchScale', 1.) / 2
+        self.max_half_length = p.get('SearchDepth', 1.) / 2
+        self.positive_only = p.get('PositiveSearchOnly', False)
+        self.progressive = not p.get('UseSinglePass4Depth', False)
+        self.use_median = p.get('UseMedian', False)
+        self.min_points = (p.get('MinPoints4Stat', 5)
+                           if p.get('UseMinPoints4Stat', False) else 1)
+        for key, default in _UNSUPPORTED.items():
+            if p.get(key, default) != default:
+                logger.warning(f'M3C2 parameter {key} is not supported '
+                               + 'and will be ignored.')
+
+        if n_workers is None:
+            n_workers = p.get('MaxThreadCount')
+            if not isinstance(n_workers, int):
+                n_workers = os.cpu_count()
+        self.n_workers = max(1, n_workers)
+        self.batch_size = batch_size
+        self.trees = None
+
+    def __getstate__(self):
+        # The trees are rebuilt in the worker processes.
+        state = self.__dict__.copy()
+        state['trees'] = None
+        return state
+
+    def set_clouds(self, cloud1, cloud2):
+        """Set the point clouds, shifted to a local origin."""
+        self.origin = np.floor(cloud1.min(axis=0)) if len(cloud1) else 0.
+        self.clouds = (np.asarray(cloud1, dtype=float) - self.origin,
+                       np.asarray(cloud2, dtype=float) - self.origin)
+        self.trees = None
+
+    def _get_trees(self):
+        if self.trees is None:
+            self.trees = tuple(cKDTree(cloud) for cloud in self.clouds)
+        return self.trees
+
+    def normals(self, core_points):
+        """Oriented normals of the core points, based on the first cloud."""
+        normals, best = None, None
+        if self.normal_mode == 'vertical':
+            normals = np.tile([0., 0., 1.], (len(core_points), 1))
+            radii = []
+        else:
+            tree = self._get_trees()[0]
+            radii = self.normal_radii
+        for radius in radii:
+            scale_normals, variation = pca_normals(
+                                self.clouds[0], tree, core_points, radius)
+            if normals is None:
+                normals, best = scale_normals, variation
+                continue
+            # Multi scale: keep the most planar neighbourhood.
+            better = (variation < best) | (np.isnan(best)
+                                           & ~np.isnan(variation))
+            normals[better] = scale_normals[better]
+            best[better] = variation[better]
+        flip = normals @ self.orientation < 0
+        normals[flip] *= -1
+        return normals
+
+    def _cylinder_stats(self, cloud, tree, core_points, normals):
+        """
+        Count and central position of the points in the cylinder of each
+        core point.
+
+        The cylinder is searched in depth levels of one radius at a time,
+        each covered by a ball around its part of the axis. With progressive
+        search, only core points with less than `min_points` points so far
+        continue to the next level.
+        """
+        n_core = len(core_points)
+        r = self.search_radius
+        max_h = self.max_half_length
+        n_levels = max(1, int(np.ceil(max_h / r)))
+        counts = np.zeros((n_core,), dtype=np.int64)
+        active = np.arange(n_core)
+        owners, hs = [], []
+        for level in range(n_levels):
+            h_lo, h_hi = level * r, min((level + 1) * r, max_h)
+            if level == 0:
+                # Both sides of the core point, |h| <= r.
+                sides = [(0., np.sqrt(2) * r)]
+            else:
+                sides = [(1., np.hypot(r, (h_hi - h_lo) / 2))]
+                if not self.positive_only:
+                    sides.append((-1., sides[0][1]))
+            for side, ball_radius in sides:
+                offset = side * (h_lo + h_hi) / 2 if level > 0 else 0.
+                centers = (core_points[active]
+                           + normals[active] * offset)
+                owner, idx = _ball_pairs(tree, centers, ball_radius)
+                owner = active[owner]
+                d = cloud[idx] - core_points[owner]
+                h = np.einsum('ij,ij->i', d, normals[owner])
+                radial2 = np.einsum('ij,ij->i', d, d) - h ** 2
+                keep = radial2 <= r ** 2
+                if level == 0:
+                    keep &= np.abs(h) <= h_hi
+                    if self.positive_only:
+                        keep &= h >= 0
+                else:
+                    keep &= (side * h > h_lo) & (side * h <= h_hi)
+                owners.append(owner[keep])
+                hs.append(h[keep])
+                counts += np.bincount(owner[keep], minlength=n_core)
+            if self.progressive:
+                active = active[counts[active] < self.min_points]
+                if len(active) == 0:
+                    break
+        return _central_values(np.concatenate(owners), np.concatenate(hs),
+                               n_core, self.use_median)
+
+    def distances(self, core_ids):
+        """M3C2 distances for the points of the first cloud with these ids."""
+        trees = self._get_trees()
+        core_points = self.clouds[0][core_ids]
+        normals = self.normals(core_points)
+        valid = ~np.isnan(normals[:, 0])
+        dist = np.full((len(core_points),), np.nan)
+        if not np.any(valid):
+            return dist
+        core_points, normals = core_points[valid], normals[valid]
+        n1, c1 = self._cylinder_stats(self.clouds[0], trees[0],
+                                      core_points, normals)
+        n2, c2 = self._cylinder_stats(self.clouds[1], trees[1],
+                                      core_points, normals)
+        enough = (n1 >= self.min_points) & (n2 >= self.min_points)
+        dist[np.flatnonzero(valid)[enough]] = (c2 - c1)[enough]
+        return dist
+
+    def compute(self, cloud1, cloud2):
+        """
+        Compute the M3C2 distance for each point of `cloud1`.
+
+        Parameters
+        ----------
+        cloud1, cloud2 : arrays of shape (n_points, 3)
+            The point clouds <x, y, z> of the two runs.
+
+        Returns
+        -------
+        An array with the M3C2 distance for each point of `cloud1`, NaN
+        where it could not be computed.
+        """
+        if len(cloud1) == 0 or len(cloud2) == 0:
+            return np.full((len(cloud1),), np.nan)
+        with instrumentation.timer('m3c2'):
+            self.set_clouds(cloud1, cloud2)
+            batches = [np.arange(i, min(i + self.batch_size, len(cloud1)))
+                       for i in range(0, len(cloud1), self.batch_size)]
+            if self.n_workers > 1 and len(batches) > 1:
+                with ProcessPoolExecutor(max_workers=self.n_workers,
+                                         initializer=_init_worker,
+                                         initargs=(self,)) as pool:
+                    results = list(pool.map(_worker_distances, batches))
+            else:
+                results = [self.distances(batch) for batch in batches]
+            self.trees = None
+        dist = np.concatenate(results)
+        instrumentation.count('m3c2_points', len(dist))
+        instrumentation.count('m3c2_no_distance',
+                              np.count_nonzero(np.isnan(dist)))
+        return dist
+
+
+def _init_worker(m3c2):
+    global _worker_m3c2
+    _worker_m3c2 = m3c2
+
+
+def _worker_distances(core_ids):
+    return _worker_m3c2.distances(core_ids)
+
+
+def static_mask(distances, threshold):
+    """Mask of points with an M3C2 distance below the threshold."""
+    with np.errstate(invalid='ignore'):
+        return np.abs(distances) < threshold
@@ -0,0 +1,129 @@
+"""
+Subtract obstacles from the sidewalk polygons.
+
+Sidewalks are paired with the obstacles that intersect them using a single
+bulk spatial index query, each obstacle is buffered only once, and the
+differences are computed per sidewalk in parallel chunks.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely.ops as so
+from tqdm import tqdm
+
+import upc_sw.poly_utils as poly_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def merge_obstacles(sw_poly, obstacles, bgt_obstacles, sw_buffer=0.01):
+    """
+    Subtract the obstacles from a single sidewalk polygon. The interiors of
+    the sidewalk polygon are kept as obstacles.
+
+    Parameters
+    ----------
+    sw_poly : Polygon
+        The sidewalk polygon.
+    obstacles : list of Polygons
+        The (buffered) static obstacles that intersect the sidewalk.
+    bgt_obstacles : list of Polygons
+        The BGT / terras obstacles that intersect the sidewalk.
+    sw_buffer : float (default: 0.01)
+        Buffer around the sidewalk to preserve its shape.
+
+    Returns
+    -------
+    The sidewalk polygon with the obstacles removed.
+    """
+    sw_ext, sw_int = poly_utils.extract_interior(sw_poly)
+    merged = [so.unary_union(polys) for polys in (obstacles, bgt_obstacles)
+              if len(polys) > 0]
+    merged_poly = so.unary_union(merged + [sw_int])
+    return sw_ext.buffer(sw_buffer) - sw_ext.intersection(merged_poly)
+
+
+def _merge_obstacles_chunk(args):
+    tasks, sw_buffer = args
+    return [merge_obstacles(*task, sw_buffer=sw_buffer) for task in tasks]
+
+
+def _intersecting(sw_ext, gdf):
+    """For each sidewalk, the positions in `gdf` of intersecting shapes."""
+    if len(gdf) == 0:
+        return [np.array([], dtype=int) for _ in sw_ext]
+    sw_ids, obst_ids = gdf.sindex.query_bulk(sw_ext, predicate='intersects')
+    order = np.lexsort((obst_ids, sw_ids))
+    sw_ids, obst_ids = sw_ids[order], obst_ids[order]
+    splits = np.searchsorted(sw_ids, np.arange(1, len(sw_ext)))
+    return np.split(obst_ids, splits)
+
+
+def sidewalks_with_obstacles(sidewalk_gdf, static_obstacles_gdf, bgt_obst_gdf,
+                             obstacle_padding=0.05, sw_buffer=0.01,
+                             n_workers=1, chunk_size=100):
+    """
+    Subtract all obstacles that intersect each sidewalk polygon.
+
+    The result is the same as subtracting, for each sidewalk separately, the
+    union of the static obstacles (buffered with `obstacle_padding`) and BGT
+    obstacles that intersect its exterior.
+
+    Parameters
+    ----------
+    sidewalk_gdf : GeoDataFrame
+        The sidewalk polygons.
+    static_obstacles_gdf : GeoDataFrame
+        The static obstacle polygons.
+    bgt_obst_gdf : GeoDataFrame
+        The BGT / terras obstacle polygons.
+    obstacle_padding : float (default: 0.05)
+        Padding around the static obstacles.
+    sw_buffer : float (default: 0.01)
+        Buffer around the sidewalk to preserve its shape.
+    n_workers : int (default: 1)
+        Number of worker processes.
+    chunk_size : int (default: 100)
+        Number of sidewalks processed per task.
+
+    Returns
+    -------
+    A copy of `sidewalk_gdf` with the obstacles removed from the geometry.
+    """
+    sw_merged_gdf = sidewalk_gdf.copy()
+    if len(sidewalk_gdf) == 0:
+        return sw_merged_gdf
+
+    sw_polys = sidewalk_gdf.geometry.values
+    sw_ext = [poly_utils.extract_interior(poly)[0] for poly in sw_polys]
+
+    static_ids = _intersecting(sw_ext, static_obstacles_gdf)
+    bgt_ids = _intersecting(sw_ext, bgt_obst_gdf)
+
+    # Buffer each static obstacle that overlaps a sidewalk only once.
+    used_ids = np.unique(np.concatenate(static_ids))
+    buffered = dict(zip(used_ids,
+                        static_obstacles_gdf.geometry.values[used_ids]
+                        .buffer(obstacle_padding)))
+    bgt_geoms = bgt_obst_gdf.geometry.values
+
+    tasks = [(poly, [buffered[i] for i in s_ids], list(bgt_geoms[b_ids]))
+             for poly, s_ids, b_ids in zip(sw_polys, static_ids, bgt_ids)]
+    chunks = [(tasks[i:i + chunk_size], sw_buffer)
+              for i in range(0, len(tasks), chunk_size)]
+    logger.info(f'Merging {len(used_ids)} static and '
+                + f'{len(np.unique(np.concatenate(bgt_ids)))} BGT '
+                + f'obstacles with {len(tasks)} sidewalks.')
+
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(tqdm(pool.map(_merge_obstacles_chunk, chunks),
+                                total=len(chunks), unit='chunk'))
+    else:
+        results = [_merge_obstacles_chunk(chunk)
+                   for chunk in tqdm(chunks, unit='chunk')]
+
+    sw_merged_gdf['geometry'] = [poly for chunk in results for poly in chunk]
+    return sw_merged_gdf
@@ -0,0 +1,166 @@
+"""
+Obstacle polygons from an occupancy grid.
+
+Points are rasterized into a grid with cells of `grid_size`, the occupied
+cells are labelled into 8-connected components, and the outline of each
+component is traced along the cell edges, holes included. The cost depends on
+the number of grid cells, not on the number of points per cluster.
+
+The outline along the cell edges lies on average half a cell outside the
+extreme points. It can be inset, e.g. by half a cell such that it passes
+through the centres of the boundary cells. The inset is only applied to
+outlines that keep their number of parts and holes, such that thin parts of a
+component are not split or removed.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from upc_sw.alpha_shape import rings_from_edges, polygons_from_rings
+
+# 8-connectivity, as used for the connected components.
+STRUCTURE = np.ones((3, 3), dtype=bool)
+
+# Cell edges with the cell to their left: (neighbour offset, start vertex,
+# end vertex), with vertex (0, 0) the corner <x_min, y_min> of the cell.
+_CELL_EDGES = (((0, -1), (0, 0), (1, 0)),
+               ((1, 0), (1, 0), (1, 1)),
+               ((0, 1), (1, 1), (0, 1)),
+               ((-1, 0), (0, 1), (0, 0)))
+
+
+def rasterize(points, grid_size, pad=1):
+    """
+    Count the points in each grid cell. The grid is aligned to multiples of
+    `grid_size` and has at least `pad` empty cells around the points.
+
+    Returns
+    -------
+    An array of shape (n_x, n_y) with point counts, and the coordinates of
+    the corner of cell (0, 0).
+    """
+    points = np.asarray(points)[:, :2]
+    origin = (np.floor(points.min(axis=0) / grid_size) - pad) * grid_size
+    ij = np.floor((points - origin) / grid_size).astype(int)
+    shape = tuple(ij.max(axis=0) + 1 + pad)
+    counts = np.bincount(np.ravel_multi_index(ij.T, shape),
+                         minlength=shape[0] * shape[1]).reshape(shape)
+    return counts, origin
+
+
+def label_grid(counts, min_component_size=100, closing=0, opening=0):
+    """
+    Label the connected components of the occupied cells, after an optional
+    morphological closing and opening. Components with fewer than
+    `min_component_size` points are removed.
+
+    Returns
+    -------
+    An array with the label of each cell (0 for empty cells), and the number
+    of components.
+    """
+    occupied = counts > 0
+    if closing > 0:
+        occupied = ndimage.binary_closing(occupied, STRUCTURE,
+                                          iterations=closing)
+    if opening > 0:
+        occupied = ndimage.binary_opening(occupied, STRUCTURE,
+                                          iterations=opening)
+    labels, n = ndimage.label(occupied, STRUCTURE)
+    sizes = np.bincount(labels.ravel(), weights=counts.ravel(),
+                        minlength=n + 1)
+    keep = sizes >= min_component_size
+    keep[0] = False
+    new_labels = np.where(keep, np.cumsum(keep), 0)
+    return new_labels[labels], int(keep.sum())
+
+
+def grid_edges(labels):
+    """
+    The directed cell edges on the outline of the labelled components, with
+    the component to their left.
+
+    Returns
+    -------
+    Arrays (src, dst) with the flat indices of the start and end vertex in
+    the vertex lattice of shape (n_x + 1, n_y + 1), and the component label
+    of each edge.
+    """
+    padded = np.pad(labels, 1)
+    n_x, n_y = labels.shape
+    src, dst, edge_labels = [], [], []
+    for (di, dj), (si, sj), (ei, ej) in _CELL_EDGES:
+        neighbour = padded[1 + di:1 + di + n_x, 1 + dj:1 + dj + n_y]
+        i, j = np.nonzero((labels > 0) & (neighbour != labels))
+        src.append(np.ravel_multi_index((i + si, j + sj), (n_x + 1, n_y + 1)))
+        dst.append(np.ravel_multi_index((i + ei, j + ej), (n_x + 1, n_y + 1)))
+        edge_labels.append(labels[i, j])
+    return (np.concatenate(src), np.concatenate(dst),
+            np.concatenate(edge_labels))
+
+
+def _topology(geom):
+    """The number of parts and the number of holes of a (Multi)Polygon."""
+    parts = [poly for poly in getattr(geom, 'geoms', [geom])
+             if poly.type == 'Polygon' and not poly.is_empty]
+    return len(parts), sum(len(poly.interiors) for poly in parts)
+
+
+def grid_polygons(labels, origin, grid_size, simplify_tolerance=0.,
+                  inset=0.):
+    """
+    Trace the outline of each labelled component into (Multi)Polygon
+    geometry, holes included, optionally inset it, and simplify it.
+
+    Parameters
+    ----------
+    labels : array of shape (n_x, n_y)
+        The labelled grid, see `label_grid`.
+    origin : array of shape (2,)
+        Coordinates of the corner of cell (0, 0).
+    grid_size : float
+    simplify_tolerance : float (default: 0)
+    inset : float (default: 0)
+        Distance to inset the outlines by, e.g. `grid_size / 2`. Outlines
+        whose number of parts or holes would change, e.g. components that
+        are too thin, are not inset. An inset of half a cell does remove
+        protrusions that are one cell wide.
+
+    Returns
+    -------
+    A list with for each component a list of Polygons.
+    """
+    n_components = labels.max() if labels.size else 0
+    if n_components == 0:
+        return []
+    src, dst, edge_labels = grid_edges(labels)
+    vertices, inverse = np.unique(np.concatenate((src, dst)),
+                                  return_inverse=True)
+    src, dst = inverse[:len(src)], inverse[len(src):]
+    lattice = np.column_stack(np.unravel_index(
+                    vertices, (labels.shape[0] + 1, labels.shape[1] + 1)))
+    coords = origin + lattice * grid_size
+    # Components do not touch, not even diagonally, so each vertex belongs
+    # to a single component.
+    vertex_labels = np.empty((len(vertices),), dtype=int)
+    vertex_labels[src] = edge_labels
+
+    # At pinch points (diagonal cells), the rings are split such that the
+    # polygons are valid.
+    rings = rings_from_edges(coords, src, dst, merge=False)
+    component_rings = [[] for _ in range(n_components)]
+    for ring in rings:
+        component_rings[vertex_labels[ring[0]] - 1].append(ring)
+
+    polygons = []
+    for comp_rings in component_rings:
+        geom = polygons_from_rings(coords, comp_rings, keep_holes=True)
+        if inset > 0:
+            inset_geom = geom.buffer(-inset, join_style=2)
+            if _topology(inset_geom) == _topology(geom):
+                geom = inset_geom
+        # Also removes the vertices on straight runs of cell edges.
+        geom = geom.simplify(simplify_tolerance, preserve_topology=True)
+        polygons.append([poly for poly in getattr(geom, 'geoms', [geom])
+                         if poly.type == 'Polygon' and not poly.is_empty])
+    return polygons
@@ -0,0 +1,205 @@
+"""
+Spatial partitioning of polygon stages on the tile grid, for city-scale runs.
+
+Polygons are assigned to square cells of `cell_tiles` x `cell_tiles` tiles
+(see `poly_utils.tilecode_to_poly`). Each cell is processed independently in
+a process pool, after which the results of polygons that cross cell edges
+are stitched: per block of 2 x 2 cells, then per block of 2 x 2 of those
+blocks, etc., with the blocks of each round in parallel.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import geopandas as gpd
+import shapely.ops as so
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import upc_sw.poly_utils as poly_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def tile_size():
+    """Size of a tile in the tile scheme of `poly_utils.tilecode_to_poly`."""
+    x_min, _, x_max, _ = poly_utils.tilecode_to_poly('0_0').bounds
+    return x_max - x_min
+
+
+def assign_cells(geoms, cell_tiles=4):
+    """
+    Cell label of each geometry, based on the center of its bounding box.
+
+    Returns
+    -------
+    An array of shape (n_geoms, 2) with the cell indices along x and y.
+    """
+    cell_size = cell_tiles * tile_size()
+    bounds = gpd.GeoSeries(geoms).bounds.values
+    centers = np.column_stack(((bounds[:, 0] + bounds[:, 2]) / 2,
+                               (bounds[:, 1] + bounds[:, 3]) / 2))
+    return np.floor(centers / cell_size).astype(np.int64)
+
+
+def group_by_cell(cells):
+    """Indices of the geometries in each cell, as a list of arrays."""
+    if len(cells) == 0:
+        return []
+    _, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.flatnonzero(np.diff(inverse[order])) + 1
+    return np.split(order, splits)
+
+
+def _polygon_parts(geom):
+    if geom.is_empty:
+        return []
+    if geom.type == 'Polygon':
+        return [geom]
+    return [part for part in geom.geoms if part.type == 'Polygon']
+
+
+def _union_parts(geoms):
+    return _polygon_parts(so.unary_union(geoms))
+
+
+def _map(func, tasks, n_workers):
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            return list(pool.map(func, tasks))
+    return [func(task) for task in tasks]
+
+
+def _merge_hierarchically(parts, part_cells, labels, n_workers=1):
+    """
+    Union the parts with the same label, in rounds. In each round the cells
+    are grouped into blocks of 2 x 2 cells, and the parts with the same label
+    in a block are merged, the blocks in parallel. A label that spans all
+    cells ends with a single union of at most four already merged pieces.
+
+    Returns
+    -------
+    A list of Polygons.
+    """
+    items = [[part] for part in parts]
+    labels = np.asarray(labels)
+    # Non-negative, such that halving the cell indices converges to 0.
+    cells = np.asarray(part_cells) - np.min(part_cells, axis=0)
+    n_rounds = 0
+    while len(np.unique(labels)) < len(labels):
+        cells = np.floor_divide(cells, 2)
+        groups = group_by_cell(np.column_stack((labels, cells)))
+        multi = [ids for ids in groups if len(ids) > 1]
+        merged = iter(_map(_union_parts,
+                           [[p for i in ids for p in items[i]]
+                            for ids in multi], n_workers))
+        items = [next(merged) if len(ids) > 1 else items[ids[0]]
+                 for ids in groups]
+        labels = np.array([labels[ids[0]] for ids in groups])
+        cells = np.array([cells[ids[0]] for ids in groups])
+        n_rounds += 1
+    logger.debug(f'Merged {len(parts)} parts in {n_rounds} rounds.')
+    return [part for item in items for part in item]
+
+
+def partitioned_union(geoms, cell_tiles=4, n_workers=1):
+    """
+    Union of polygons, computed per cell of the tile grid in parallel. The
+    result is equivalent to the parts of `unary_union(geoms)`, although the
+    order of the parts differs.
+
+    Each cell is merged independently. Parts that reach the edge of their
+    cell are then stitched with the parts of other cells they intersect,
+    merging blocks of 2 x 2 cells in parallel, see `_merge_hierarchically`.
+
+    Parameters
+    ----------
+    geoms : GeoSeries or list of (Multi)Polygons
+    cell_tiles : int (default: 4)
+        Size of the cells, in tiles.
+    n_workers : int (default: 1)
+        Number of worker processes.
+
+    Returns
+    -------
+    A list of Polygons.
+    """
+    geoms = gpd.GeoSeries(list(geoms))
+    geoms = geoms[~(geoms.isna() | geoms.is_empty)].reset_index(drop=True)
+    if len(geoms) == 0:
+        return []
+    cells = assign_cells(geoms, cell_tiles)
+    groups = group_by_cell(cells)
+    cell_parts = _map(_union_parts, [list(geoms.iloc[ids]) for ids in groups],
+                      n_workers)
+
+    parts = [part for group_parts in cell_parts for part in group_parts]
+    part_cells = np.repeat(np.array([cells[ids[0]] for ids in groups]),
+                           [len(group_parts) for group_parts in cell_parts],
+                           axis=0)
+
+    # Only parts that reach the edge of their own cell can touch parts of
+    # other cells.
+    cell_size = cell_tiles * tile_size()
+    parts = gpd.GeoSeries(parts)
+    bounds = parts.bounds.values
+    crossing = np.flatnonzero(
+                    np.any(bounds[:, :2] <= part_cells * cell_size, axis=1)
+                    | np.any(bounds[:, 2:] >= (part_cells + 1) * cell_size,
+                             axis=1))
+    if len(crossing) == 0:
+        return list(parts)
+    src, dst = parts.sindex.query_bulk(parts.iloc[crossing],
+                                       predicate='intersects')
+    src = crossing[src]
+    other_cell = np.any(part_cells[src] != part_cells[dst], axis=1)
+    src, dst = src[other_cell], dst[other_cell]
+    graph = coo_matrix((np.ones(len(src)), (src, dst)),
+                       shape=(len(parts), len(parts)))
+    _, labels = connected_components(graph, directed=False)
+
+    # Stitch the parts per connected component.
+    components = group_by_cell(labels[:, None])
+    stitched = [parts.iloc[ids[0]] for ids in components if len(ids) == 1]
+    multi = [ids for ids in components if len(ids) > 1]
+    n_stitched = len(multi)
+    if n_stitched > 0:
+        ids = np.concatenate(multi)
+        stitched.extend(_merge_hierarchically(
+                            list(parts.iloc[ids]), part_cells[ids],
+                            labels[ids], n_workers))
+    logger.info(f'{len(geoms)} polygons merged into {len(stitched)} in '
+                + f'{len(groups)} cells, {n_stitched} stitched across cells.')
+    return stitched
+
+
+def _apply_group(args):
+    func, geoms, kwargs = args
+    return [func(geom, **kwargs) for geom in geoms]
+
+
+def apply_partitioned(geoms, func, cell_tiles=4, n_workers=1, **kwargs):
+    """
+    Compute `func(geom, **kwargs)` for each geometry, with one task per cell
+    of the tile grid, such that each worker processes a spatial partition.
+    `func` and its results must be picklable.
+
+    Returns
+    -------
+    A list with the result for each geometry, in the order of `geoms`.
+    """
+    geoms = list(geoms)
+    if len(geoms) == 0:
+        return []
+    groups = group_by_cell(assign_cells(geoms, cell_tiles))
+    group_results = _map(_apply_group,
+                         [(func, [geoms[i] for i in ids], kwargs)
+                          for ids in groups], n_workers)
+    results = [None] * len(geoms)
+    for ids, group_result in zip(groups, group_results):
+        for i, result in zip(ids, group_result):
+            results[i] = result
+    return results
@@ -0,0 +1,158 @@
+"""
+Compact in-memory point cloud with 4-byte coordinates.
+
+RD coordinates need float64 only because of their large offset. Point clouds
+read from LAS/LAZ files keep the 32-bit integer coordinates of the file, with
+the scale and offset from its header, such that the absolute coordinates are
+exactly those of `sw_utils.read_las`. Other points are stored as float32
+relative to a local origin. Coordinates are stored as a structure of arrays,
+and subsets only store the indices of their points, such that masks can be
+applied without copying the coordinates.
+"""
+
+import numpy as np
+import shapely.affinity as sa
+
+import upc_sw.poly_utils as poly_utils
+
+
+def tile_origin(tilecode):
+    """The origin (x_min, y_min, 0) of a tile."""
+    x_min, y_min, _, _ = poly_utils.tilecode_to_poly(tilecode).bounds
+    return np.array([x_min, y_min, 0.])
+
+
+class LocalPointCloud:
+    """
+    Points with int32 or float32 coordinates, such that the absolute
+    coordinates are `local * scale + offset`, and extra dimensions (e.g.
+    labels) that can be loaded lazily.
+
+    Parameters
+    ----------
+    local : array of shape (3, n_points)
+        The stored coordinates, one row per axis.
+    offset : array of shape (3,)
+        Offset of the stored coordinates.
+    scale : array of shape (3,) (default: 1)
+        Scale of the stored coordinates.
+    origin : array of shape (3,) (optional)
+        The local origin, e.g. the corner of the tile, used by `local_xy`.
+        Defaults to `offset`.
+    extra : dict (optional)
+        Extra dimensions, each an array of length n_points or a callable
+        that returns it. Callables are called on first access only.
+    ids : array of int (optional)
+        Indices of the points in this (sub)set. Used by `subset`.
+    """
+
+    def __init__(self, local, offset, scale=1., origin=None, extra=None,
+                 ids=None):
+        self.local = local
+        self.offset = np.broadcast_to(np.asarray(offset, dtype=np.float64),
+                                      (3,))
+        self.scale = np.broadcast_to(np.asarray(scale, dtype=np.float64),
+                                     (3,))
+        self.origin = self.offset if origin is None else np.asarray(
+                                                origin, dtype=np.float64)
+        # Shared with all subsets, such that lazy dimensions load only once.
+        self.extra = {} if extra is None else extra
+        self.ids = ids
+
+    @classmethod
+    def from_points(cls, points, origin=None, **extra):
+        """
+        Create from an array of absolute coordinates, stored as float32
+        relative to `origin`. The origin defaults to the rounded down minimum
+        of the points.
+        """
+        points = np.asarray(points)
+        if origin is None:
+            origin = (np.floor(points.min(axis=0)) if len(points)
+                      else np.zeros((3,)))
+        local = np.empty((3, len(points)), dtype=np.float32)
+        for axis in range(3):
+            local[axis] = points[:, axis] - origin[axis]
+        return cls(local, origin, extra=extra)
+
+    def __len__(self):
+        return self.local.shape[1] if self.ids is None else len(self.ids)
+
+    @property
+    def nbytes(self):
+        """Memory used by the coordinates and loaded extra dimensions."""
+        return (self.local.nbytes
+                + sum(v.nbytes for v in self.extra.values()
+                      if isinstance(v, np.ndarray))
+                + (0 if self.ids is None else self.ids.nbytes))
+
+    def subset(self, mask):
+        """
+        The points in a boolean mask or index array. The coordinates are not
+        copied, only the indices are stored.
+        """
+        mask = np.asarray(mask)
+        ids = np.flatnonzero(mask) if mask.dtype == bool else mask
+        if self.ids is not None:
+            ids = self.ids[ids]
+        return LocalPointCloud(self.local, self.offset, self.scale,
+                               self.origin, self.extra, ids)
+
+    def _axis(self, axis, chunk=slice(None)):
+        values = self.local[axis]
+        values = (values[chunk] if self.ids is None
+                  else values[self.ids[chunk]])
+        # Computed in float64: with a float64 scalar, NumPy would otherwise
+        # keep float32 values as float32.
+        return values.astype(np.float64)
+
+    def coordinate(self, axis):
+        """Absolute coordinates along an axis (0, 1 or 2), as float64."""
+        return self._axis(axis) * self.scale[axis] + self.offset[axis]
+
+    def z(self):
+        """Absolute z coordinates as float64."""
+        return self.coordinate(2)
+
+    def xyz(self):
+        """Absolute coordinates as float64, an array of shape (n_points, 3)."""
+        xyz = np.empty((len(self), 3))
+        for axis in range(3):
+            xyz[:, axis] = self.coordinate(axis)
+        return xyz
+
+    def local_xy(self, dtype=np.float64, chunk_size=1000000):
+        """
+        Coordinates relative to `origin`, an array of shape (n_points, 2).
+        With `dtype=np.float32` the array is half the size, but coordinates
+        are rounded to about 4e-6 m at 50 m from the origin, so points within
+        that distance of a polygon edge can be clipped differently. The
+        float64 intermediate values are computed per chunk of `chunk_size`
+        points.
+        """
+        xy = np.empty((len(self), 2), dtype=dtype)
+        for start in range(0, len(self), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            for axis in range(2):
+                xy[chunk, axis] = (self._axis(axis, chunk) * self.scale[axis]
+                                   + (self.offset[axis] - self.origin[axis]))
+        return xy
+
+    def has_dim(self, name):
+        return name in self.extra
+
+    def get(self, name):
+        """An extra dimension, loaded on first access."""
+        values = self.extra[name]
+        if callable(values):
+            values = values()
+            self.extra[name] = values
+        return values if self.ids is None else values[self.ids]
+
+    def to_local(self, geom):
+        """Translate a Shapely geometry to the coordinates of `local_xy`."""
+        return sa.translate(geom, -self.origin[0], -self.origin[1])
+
+    def to_global(self, geom):
+        """Translate a Shapely geometry from local to absolute coordinates."""
+        return sa.translate(geom, self.origin[0], self.origin[1])
@@ -1,13 +1,21 @@
 import shapely.geometry as sg
 import shapely.ops as so
-from centerline.geometry import Centerline
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from geopandas import GeoDataFrame
+from geopandas.array import from_shapely
 
 from upcp.utils import las_utils
 
+import upc_sw.width_utils as width_utils
+import upc_sw.line_arrays as line_arrays
+import upc_sw.centerline_utils as centerline_utils
+import upc_sw.instrumentation as instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
 
 def tilecode_to_poly(tilecode):
     ((x1, y2), (x2, y1)) = las_utils.get_bbox_from_tile_code(
@@ -33,85 +41,193 @@ def extract_interior(poly):
         return poly, sg.MultiPolygon()
 
 
-def get_centerlines(polygon):
-    ''' Save a NaN value when centerline calculation fails. '''
-    try:
-        x = Centerline(polygon)
-    except Exception as e:
-        print(e)  # TODO also print rows.name[0] ??
-        x = np.nan
-    return x
-
-
-def remove_short_lines(line, min_se_length=5):
+def get_centerline_result(polygon, engine='centerline', **kwargs):
+    '''
+    Compute the centerline with `centerline_utils.compute_centerline`, which
+    gets the engine and its arguments, and log failures. Returns the
+    CenterlineResult, with the status of the calculation; its geometry is
+    None when the calculation fails.
+    '''
+    result = centerline_utils.compute_centerline(polygon, engine, **kwargs)
+    instrumentation.add_time('centerline', result.duration)
+    if result.status != 'ok':
+        instrumentation.count('centerline_failures')
+        instrumentation.count(f'centerline_{result.status}')
+        logger.warning(f'No centerline ({result.status}): {result.error}')
+    return result
+
+
+def get_centerlines(polygon, engine='centerline', **kwargs):
+    '''
+    Save a NaN value when centerline calculation fails. Use
+    `get_centerline_result` to also get the reason of the failure.
+    '''
+    result = get_centerline_result(polygon, engine, **kwargs)
+    return np.nan if result.geometry is None else result.geometry
+
+
+def _dead_end_mask(parts, candidates, precision=None):
+    """
+    Determine for the candidate parts whether they are dead-ends, i.e.,
+    whether one of their endpoints does not touch any other part.
+
+    Endpoints are matched by hashing their (optionally rounded) coordinates.
+    Endpoints without a match are checked exactly against nearby parts, to
+    also find endpoints that touch another part in its interior.
+    """
+    coords, offsets, _ = line_arrays.from_lines(parts)
+    # The start and end point of part i are endpoints 2i and 2i + 1.
+    endpoints = np.column_stack((coords[offsets[:-1]],
+                                 coords[offsets[1:] - 1])).reshape(-1, 2)
+    rounded = (endpoints if precision is None
+               else np.round(endpoints, precision))
+    # Node degree: the number of part endpoints at each location.
+    keys = [tuple(p) for p in rounded.tolist()]
+    degree = {}
+    for key in keys:
+        degree[key] = degree.get(key, 0) + 1
+
+    # Endpoints of the candidates without a matching endpoint of another
+    # part.
+    unmatched = []
+    for i in candidates:
+        own = 2 if keys[2 * i] == keys[2 * i + 1] else 1
+        unmatched.extend(e for e in (2 * i, 2 * i + 1)
+                         if degree[keys[e]] - own == 0)
+
+    is_deadend = np.zeros((len(parts),), dtype=bool)
+    if len(unmatched) == 0:
+        return is_deadend
+    unmatched = np.array(unmatched)
+    part_ids = unmatched // 2
+    if precision is not None:
+        is_deadend[part_ids] = True
+        return is_deadend
+    # Exact test against the other parts near these endpoints.
+    points = from_shapely([sg.Point(p) for p in endpoints[unmatched].tolist()])
+    point_ids, other_ids = from_shapely(parts).sindex.query_bulk(
+                                            points, predicate='intersects')
+    touches_other = np.zeros((len(unmatched),), dtype=bool)
+    touches_other[point_ids[other_ids != part_ids[point_ids]]] = True
+    is_deadend[part_ids[~touches_other]] = True
+    return is_deadend
+
+
+def remove_short_lines(line, min_se_length=5, iterate=False,
+                       precision=None):
+    """
+    Remove dead-end parts of a MultiLineString that are not longer than
+    `min_se_length`.
+
+    Parameters
+    ----------
+    line : LineString or MultiLineString
+    min_se_length : float (default: 5)
+        Minimum length for dead-ends, shorter ones are removed.
+    iterate : bool (default: False)
+        Repeat the pruning until no more parts are removed.
+    precision : int (optional)
+        When given, endpoints are matched after rounding their coordinates
+        to this number of decimals. By default they must touch exactly.
+    """
     if line.type == 'MultiLineString':
-        passing_lines = []
-
-        for i, linestring in enumerate(line.geoms):
-            other_lines = sg.MultiLineString(
-                            [x for j, x in enumerate(line.geoms) if j != i])
-
-            p0 = sg.Point(linestring.coords[0])
-            p1 = sg.Point(linestring.coords[-1])
-
-            is_deadend = False
-
-            if p0.disjoint(other_lines):
-                is_deadend = True
-            if p1.disjoint(other_lines):
-                is_deadend = True
-
-            if not is_deadend or linestring.length > min_se_length:
-                passing_lines.append(linestring)
-
-        return sg.MultiLineString(passing_lines)
+        parts = list(line.geoms)
+        while len(parts) > 0:
+            lengths = np.array([part.length for part in parts])
+            candidates = np.flatnonzero(lengths <= min_se_length)
+            if len(candidates) == 0:
+                break
+            is_deadend = _dead_end_mask(parts, candidates, precision)
+            if not is_deadend.any():
+                break
+            parts = [part for part, dead in zip(parts, is_deadend)
+                     if not dead]
+            if not iterate:
+                break
+
+        return sg.MultiLineString(parts)
 
     if line.type == 'LineString':
         return line
 
 
 def linestring_to_segments(linestring):
-    return [sg.LineString([linestring.coords[i], linestring.coords[i+1]])
-            for i in range(len(linestring.coords) - 1)]
+    return get_segments(linestring)
 
 
 def get_segments(line):
-    line_segments = []
-
-    if line.type == 'MultiLineString':
-        for linestring in line.geoms:
-            line_segments.extend(linestring_to_segments(linestring))
-
-    if line.type == 'LineString':
-        line_segments.extend(linestring_to_segments(line))
-
-    return line_segments
+    starts, ends, _ = line_arrays.segments(*line_arrays.from_lines(line)[:2])
+    return line_arrays.to_linestrings(starts, ends)
+
+
+def get_points_on_line(line, distance_delta):
+    # Generate equidistant points
+    coords, offsets, _ = line_arrays.from_lines(line)
+    distances = np.arange(0, line.length, distance_delta)
+    part_ids, part_dist = line_arrays.locate(coords, offsets, distances)
+    points = line_arrays.points_at_distance(coords, offsets, part_ids,
+                                            part_dist)
+    return line_arrays.to_multipoint(points)
+
+
+def get_segments_width_cut(poly, max_seg_length=2, min_se_length=5,
+                           simplify_tolerance=0.2, resolution=1, precision=2,
+                           centerline_engine='centerline'):
+    """
+    Compute the centerline segments of a sidewalk polygon, cut to at most
+    `max_seg_length`, and the average and minimum width for each of them.
+
+    Returns
+    -------
+    A dict with 'segments_long', 'segments', 'avg_width', 'min_width' and
+    'status', the status of the centerline calculation. Without centerline,
+    the segments and widths are empty.
+    """
+    # Get centerlines.
+    result = get_centerline_result(poly, engine=centerline_engine)
+    if result.status != 'ok':
+        return empty_segments(result.status)
+    # Merge linestrings.
+    cl = so.linemerge(result.geometry)
+    # Remove short line ends and dead-ends.
+    cl = remove_short_lines(cl, min_se_length)
+    # Simplify lines.
+    cl = cl.simplify(simplify_tolerance, preserve_topology=True)
+    # Segment lines
+    coords, offsets, _ = line_arrays.from_lines(cl)
+    starts, ends, _ = line_arrays.segments(coords, offsets)
+    # Cut segments (with maximum segment length)
+    with instrumentation.timer('cut_segments'):
+        cut_starts, cut_ends, _ = line_arrays.cut_segments(starts, ends,
+                                                           max_seg_length)
+    instrumentation.count('segments', len(cut_starts))
+    # Compute avg and min width per cut segment
+    with instrumentation.timer('width'):
+        avg_width, min_width = width_utils.straight_segment_widths(
+                            poly, cut_starts, cut_ends, resolution, precision)
+    segments_long = line_arrays.to_linestrings(starts, ends)
+    segments = line_arrays.to_linestrings(cut_starts, cut_ends)
+    return {'segments_long': segments_long, 'segments': segments,
+            'avg_width': avg_width, 'min_width': min_width, 'status': 'ok'}
+
+
+def empty_segments(status):
+    """Result of `get_segments_width_cut` for a polygon without segments."""
+    return {'segments_long': [], 'segments': [], 'avg_width': np.empty((0,)),
+            'min_width': np.empty((0,)), 'status': status}
 
 
 def interpolate_by_distance(linestring, resolution=1):
-    all_points = []
-    count = round(linestring.length / resolution) + 1
-
-    if count == 1:
-        all_points.append(linestring.interpolate(linestring.length / 2))
-    else:
-        for i in range(count):
-            all_points.append(linestring.interpolate(resolution * i))
-
-    return all_points
+    points, _ = line_arrays.sample_points(
+                    *line_arrays.from_lines(linestring)[:2], resolution)
+    return [sg.Point(p) for p in points.tolist()]
 
 
 def interpolate(line, resolution=1):
-    if line.type == 'MultiLineString':
-        all_points = []
-
-        for linestring in line:
-            all_points.extend(interpolate_by_distance(linestring, resolution))
-
-        return sg.MultiPoint(all_points)
-
-    if line.type == 'LineString':
-        return sg.MultiPoint(interpolate_by_distance(line, resolution))
+    if line.type in ('MultiLineString', 'LineString'):
+        points, _ = line_arrays.sample_points(
+                        *line_arrays.from_lines(line)[:2], resolution)
+        return line_arrays.to_multipoint(points)
 
 
 def polygon_to_multilinestring(polygon):
@@ -120,42 +236,19 @@ def polygon_to_multilinestring(polygon):
 
 
 def get_avg_width(poly, segments, resolution=1, precision=2):
-    avg_width = []
-    min_width = []
-
-    sidewalk_lines = polygon_to_multilinestring(poly)
-
-    for segment in segments:
-        points = interpolate(segment, resolution)
-
-        distances = []
-
-        for point in points.geoms:
-            p1, p2 = so.nearest_points(sidewalk_lines, point)
-            distances.append(p1.distance(p2))
-
-        avg_width.append(sum(distances) / len(distances) * 2)
-        min_width.append(min(distances) * 2)
-
-    return np.round(avg_width, precision), np.round(min_width, precision)
+    segment_coords = [[np.asarray(part.coords)
+                       for part in width_utils.line_parts(segment)]
+                      for segment in segments]
+    return width_utils.segment_widths(poly, segment_coords,
+                                      resolution, precision)
 
 
 def get_avg_width_cl(poly, segments, resolution=1, precision=2):
-
-    sidewalk_lines = polygon_to_multilinestring(poly)
-
-    points = interpolate(segments, resolution)
-
-    distances = []
-
-    for point in points.geoms:
-        p1, p2 = so.nearest_points(sidewalk_lines, point)
-        distances.append(p1.distance(p2))
-
-    avg_width = sum(distances) / len(distances) * 2
-    min_width = min(distances) * 2
-
-    return pd.Series([np.round(avg_width, precision), np.round(min_width, precision)])
+    segment_coords = [[np.asarray(part.coords)
+                       for part in width_utils.line_parts(segments)]]
+    avg_width, min_width = width_utils.segment_widths(
+                            poly, segment_coords, resolution, precision)
+    return pd.Series([avg_width[0], min_width[0]])
 
 
 def get_route_color(route_weight):
@@ -218,30 +311,66 @@ def cut(line, distance):
 
         
 def shorten_linestrings(centerline_df, max_ls_length):
-       
-    # Check if we have a linestring that is too long
-    while centerline_df['length'].max() > max_ls_length:
-
-        # Select longest linestring
-        id_longest_ls = centerline_df['length'].idxmax()
-        longest_ls = centerline_df.iloc[[id_longest_ls]]['centerlines'].values[0]
-        
-        # Cut linestring
-        cut_ls = cut(longest_ls, max_ls_length-0.01)
-
-        # Create dataframe from cut linestrings, including length
-        cut_ls_df = gpd.GeoDataFrame(cut_ls, columns=['centerlines']).set_geometry('centerlines')
-        cut_ls_df['length'] = cut_ls_df['centerlines'].length  
-        
-        # Add index back
-        cut_ls_df['index'] = centerline_df['index'][id_longest_ls]
-
-        # Remove long linestring that was cut from original dataframe
-        centerline_df = centerline_df.drop(index=id_longest_ls)
-
-        # Add dataframe with cut linestrings to original dataframe
-        centerline_df = centerline_df.append(cut_ls_df).reset_index(drop=True)
-    return centerline_df
+    """
+    Split all linestrings longer than `max_ls_length` into pieces in a
+    single pass. Each long linestring is cut into pieces of length
+    `max_ls_length - 0.01` and a shorter remainder, using substrings at the
+    cumulative offsets. Pieces keep the columns (including the 'index'
+    back-reference) of the linestring they were cut from.
+
+    The order of the rows is the same as for the former iterative
+    implementation, which repeatedly cut the longest linestring and appended
+    the pieces: first the linestrings that were not cut, then the pieces in
+    the order in which they were cut.
+    """
+    piece_length = max_ls_length - 0.01
+    lengths = centerline_df['length'].to_numpy()
+    long_ids = np.flatnonzero(lengths > max_ls_length)
+    if len(long_ids) == 0:
+        return centerline_df
+
+    # Number of cuts needed for each long linestring.
+    n_cuts = np.ceil((lengths[long_ids] - max_ls_length)
+                     / piece_length).astype(int)
+
+    # One cut event per piece of length piece_length. The longest remaining
+    # linestring was cut first.
+    event_line = np.repeat(np.arange(len(long_ids)), n_cuts)
+    event_nr = (np.arange(len(event_line))
+                - np.repeat(np.cumsum(n_cuts) - n_cuts, n_cuts))
+    remaining = lengths[long_ids][event_line] - event_nr * piece_length
+    event_order = np.lexsort((long_ids[event_line], event_nr > 0,
+                              -remaining))
+
+    # Each event yields one piece; the last event of a line also yields the
+    # remainder.
+    piece_line = []
+    piece_nr = []
+    for e in event_order:
+        piece_line.append(event_line[e])
+        piece_nr.append(event_nr[e])
+        if event_nr[e] == n_cuts[event_line[e]] - 1:
+            piece_line.append(event_line[e])
+            piece_nr.append(event_nr[e] + 1)
+    piece_line = np.array(piece_line)
+    piece_nr = np.array(piece_nr)
+
+    start = piece_nr * piece_length
+    end = np.where(piece_nr < n_cuts[piece_line],
+                   start + piece_length, lengths[long_ids][piece_line])
+    lines = centerline_df['centerlines'].to_numpy()[long_ids][piece_line]
+    pieces = [so.substring(line, s, e)
+              for line, s, e in zip(lines, start, end)]
+
+    pieces_df = centerline_df.iloc[long_ids[piece_line]].reset_index(
+                                                                drop=True)
+    pieces_df['centerlines'] = gpd.GeoSeries(
+                                    pieces, crs=getattr(centerline_df,
+                                                        'crs', None))
+    pieces_df['length'] = pieces_df['centerlines'].length
+
+    short_df = centerline_df.drop(index=centerline_df.index[long_ids])
+    return pd.concat([short_df, pieces_df]).reset_index(drop=True)
 
 
 def remove_interiors(polygon, eps):
@@ -0,0 +1,221 @@
+"""
+On-disk cache for per-polygon results, such as the centerline segments and
+widths of a sidewalk polygon.
+
+Results are keyed by a hash of the normalized WKB of the polygon, the
+parameters of the computation and a version tag. When the sidewalk polygons
+are updated, e.g. after a new obstacle run, only polygons that changed or are
+new need to be recomputed.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import pickle
+
+from tqdm import tqdm
+
+import upc_sw.instrumentation as instrumentation
+import upc_sw.partition_utils as partition_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Part of every cache key. Increase it when the cached computations change,
+# e.g. the centerline or width algorithms, such that older results are
+# recomputed instead of reused.
+CACHE_VERSION = 1
+
+# Returned by `PolygonResultCache.get` for keys that are not in the cache, as
+# opposed to a cached result of None.
+_MISSING = object()
+
+
+def polygon_key(poly, params=None, version=CACHE_VERSION):
+    """
+    Hash of a polygon, the parameters of a computation and a version tag. The
+    polygon is normalized first, such that the key does not depend on the
+    order of its rings and vertices.
+    """
+    h = hashlib.sha1(poly.normalize().wkb)
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    h.update(json.dumps(version, default=str).encode())
+    return h.hexdigest()
+
+
+def _func_version(func, version=None):
+    """Version tag of a function: CACHE_VERSION, its name and `version`."""
+    name = getattr(func, '__qualname__', type(func).__name__)
+    return [CACHE_VERSION, f'{getattr(func, "__module__", "")}.{name}',
+            version]
+
+
+def _call(func, poly, **params):
+    """
+    Call `func(poly, **params)`. Returns a tuple (result, error), with the
+    error message instead of raising.
+    """
+    try:
+        return func(poly, **params), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+class PolygonResultCache:
+    """
+    Content-addressed on-disk cache of per-polygon results. Each entry is
+    stored as a separate pickle file in `folder`. The counters in `stats`
+    are cumulative over all calls, until `reset_stats` is called.
+
+    Parameters
+    ----------
+    folder : str
+        Folder in which the results are stored.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def stats(self):
+        """Dict with the number of cache hits, misses and evicted entries."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted}
+
+    def _path(self, key):
+        return os.path.join(self.folder, f'{key}.pkl')
+
+    def keys(self):
+        """The keys of all entries in the cache."""
+        return {name[:-4] for name in os.listdir(self.folder)
+                if name.endswith('.pkl')}
+
+    def get(self, key, default=None):
+        """
+        Get the result for a key, or `default` if it is not in the cache. A
+        cached result can itself be None, pass another `default` to tell
+        the two apart.
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return default
+
+    def put(self, key, result):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, path)
+
+    def evict(self, keep_keys):
+        """Remove all entries except those in `keep_keys`."""
+        n_evicted = 0
+        for key in self.keys().difference(keep_keys):
+            try:
+                os.remove(self._path(key))
+                n_evicted += 1
+            except OSError:
+                pass
+        self.evicted += n_evicted
+        return n_evicted
+
+    def apply(self, polys, func, params=None, evict=True, progress=True,
+              n_workers=1, cell_tiles=4, version=None, default=None):
+        """
+        Compute `func(poly, **params)` for each polygon, using the cached
+        result when available. An exception for one polygon is logged and
+        does not stop the others.
+
+        Parameters
+        ----------
+        polys : iterable of (Multi)Polygons
+        func : callable
+            Function of a polygon and the keyword arguments in `params`. The
+            result must be picklable.
+        params : dict (optional)
+            Parameters for `func`, also part of the cache key.
+        evict : bool (default: True)
+            Remove entries for polygons (or parameters) not in this call.
+        progress : bool (default: True)
+            Show a progress bar.
+        n_workers : int (default: 1)
+            Number of worker processes for the polygons that are not in the
+            cache. Each worker computes a partition of the tile grid, see
+            `partition_utils.apply_partitioned`. `func` must be picklable.
+        cell_tiles : int (default: 4)
+            Size of the partitions, in tiles.
+        version : str or int (optional)
+            Version tag of `func`, part of the cache key together with
+            CACHE_VERSION and the name of `func`. Change it when `func`
+            changes.
+        default : object (optional)
+            Result for the polygons for which `func` raises an exception.
+            These are not cached, such that they are retried in the next
+            call. Results of None that `func` returns are cached.
+
+        Returns
+        -------
+        A list with the result for each polygon.
+        """
+        params = params or {}
+        polys = list(polys)
+        func_version = _func_version(func, version)
+        keys = [polygon_key(poly, params, func_version) for poly in polys]
+        call = functools.partial(_call, func)
+        results = []
+        missing = []
+        errors = 0
+        hits, misses = self.hits, self.misses
+        for i, (poly, key) in enumerate(zip(tqdm(polys,
+                                                 disable=not progress),
+                                            keys)):
+            result = self.get(key, _MISSING)
+            if result is _MISSING:
+                self.misses += 1
+                instrumentation.count('cache_misses')
+                if n_workers > 1:
+                    missing.append(i)
+                else:
+                    with instrumentation.scope('polygon', key):
+                        result, error = call(poly, **params)
+                    if error is None:
+                        self.put(key, result)
+                    else:
+                        errors += 1
+                        result = self._failed(key, error, default)
+            else:
+                self.hits += 1
+                instrumentation.count('cache_hits')
+            results.append(result)
+        if len(missing) > 0:
+            computed = partition_utils.apply_partitioned(
+                                [polys[i] for i in missing], call,
+                                cell_tiles=cell_tiles, n_workers=n_workers,
+                                **params)
+            for i, (result, error) in zip(missing, computed):
+                if error is None:
+                    self.put(keys[i], result)
+                else:
+                    errors += 1
+                    result = self._failed(keys[i], error, default)
+                results[i] = result
+        n_evicted = self.evict(set(keys)) if evict else 0
+        logger.info(f'Cache {self.folder}: {self.hits - hits} hits, '
+                    + f'{self.misses - misses} misses ({errors} failed), '
+                    + f'{n_evicted} evicted.')
+        return results
+
+    def _failed(self, key, error, default):
+        instrumentation.count('cache_errors')
+        logger.warning(f'Computation failed for polygon {key}: {error}')
+        return default
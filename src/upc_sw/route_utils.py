@@ -0,0 +1,229 @@
+"""
+Route weights over the network of sidewalk segments.
+
+For each centerline piece, the weight of the optimal route between its start
+and end point is computed in the graph of segments within the same sidewalk,
+with the segment weights (e.g. 'min_width_factor') as edge costs. Each
+sidewalk graph is built once, all endpoints are snapped to the graph nodes at
+once using a KD-tree, and a single-source Dijkstra is run for each distinct
+origin node.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Route weight for lines that are a ring (no start and end point).
+RING_WEIGHT = 0
+# Route weight when origin and destination are not connected.
+NO_PATH_WEIGHT = 1000000000000
+
+
+def line_endpoints(lines, keep_rings=False):
+    """
+    Get the start and end point of each line.
+
+    Parameters
+    ----------
+    lines : sequence of (Multi)LineStrings
+    keep_rings : bool (default: False)
+        Return the first and last vertex for closed LineStrings as well.
+
+    Returns
+    -------
+    An array of shape (n_lines, 2, 2) with <start, end> for each line, NaN
+    for lines without start and end point (rings, empty geometries).
+    """
+    endpoints = np.full((len(lines), 2, 2), np.nan)
+    for i, line in enumerate(lines):
+        if line is None or line.is_empty:
+            continue
+        if line.type == 'LineString':
+            if keep_rings or not line.is_closed:
+                endpoints[i, 0] = line.coords[0][:2]
+                endpoints[i, 1] = line.coords[-1][:2]
+            continue
+        boundary = line.boundary
+        if not boundary.is_empty:
+            points = list(getattr(boundary, 'geoms', [boundary]))
+            endpoints[i, 0] = points[0].coords[0][:2]
+            endpoints[i, 1] = points[-1].coords[0][:2]
+    return endpoints
+
+
+def segment_graph(segment_endpoints, weights):
+    """
+    Build the undirected graph of a set of segments, with the segment
+    endpoints as nodes. Of parallel segments, the lowest weight is used.
+
+    Parameters
+    ----------
+    segment_endpoints : array of shape (n_segments, 2, 2)
+        Start and end point of each segment.
+    weights : array of shape (n_segments,)
+        Weight of each segment.
+
+    Returns
+    -------
+    A tuple (nodes, graph): an array of shape (n_nodes, 2) with the node
+    coordinates and a sparse (n_nodes, n_nodes) matrix with the edge weights.
+    """
+    segment_endpoints = np.asarray(segment_endpoints, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    valid = ~np.isnan(segment_endpoints).any(axis=(1, 2))
+    segment_endpoints, weights = segment_endpoints[valid], weights[valid]
+    if len(segment_endpoints) == 0:
+        return np.empty((0, 2)), coo_matrix((0, 0)).tocsr()
+    nodes, inverse = np.unique(segment_endpoints.reshape(-1, 2), axis=0,
+                               return_inverse=True)
+    inverse = inverse.reshape(-1, 2)
+    u = inverse.min(axis=1)
+    v = inverse.max(axis=1)
+    # Self-loops never lie on a shortest path.
+    keep = u != v
+    u, v, w = u[keep], v[keep], weights[keep]
+    # Keep the cheapest of parallel edges.
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    first = np.ones((len(u),), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    graph = coo_matrix((w[first], (u[first], v[first])),
+                       shape=(len(nodes), len(nodes))).tocsr()
+    return nodes, graph
+
+
+def route_weights(nodes, graph, line_endpoints, max_dist=3):
+    """
+    Compute the route weight for each line in a single sidewalk graph.
+
+    Both endpoints of a line are snapped to the nearest graph node. The
+    weight is RING_WEIGHT for lines without endpoints, NO_PATH_WEIGHT when
+    the nodes are not connected, and NaN when a snapped node is `max_dist`
+    or further from the line endpoint, or when the graph has no nodes.
+
+    Parameters
+    ----------
+    nodes : array of shape (n_nodes, 2)
+    graph : sparse matrix of shape (n_nodes, n_nodes)
+        As returned by `segment_graph`.
+    line_endpoints : array of shape (n_lines, 2, 2)
+        As returned by `line_endpoints`.
+    max_dist : float (default: 3)
+        Maximum distance between a line endpoint and its graph node.
+
+    Returns
+    -------
+    An array of shape (n_lines,) with route weights.
+    """
+    weights = np.full((len(line_endpoints),), np.nan)
+    if len(line_endpoints) == 0 or len(nodes) == 0:
+        return weights
+
+    is_ring = np.isnan(line_endpoints).any(axis=(1, 2))
+    weights[is_ring] = RING_WEIGHT
+    line_ids = np.flatnonzero(~is_ring)
+    if len(line_ids) == 0:
+        return weights
+
+    dist, node_ids = cKDTree(nodes).query(
+                                line_endpoints[line_ids].reshape(-1, 2))
+    dist = dist.reshape(-1, 2)
+    node_ids = node_ids.reshape(-1, 2)
+
+    origins, origin_inv = np.unique(node_ids[:, 0], return_inverse=True)
+    cost = dijkstra(graph, directed=False, indices=origins)
+    route = cost[origin_inv, node_ids[:, 1]]
+
+    result = np.where(np.isinf(route), NO_PATH_WEIGHT, route)
+    too_far = ~np.isinf(route) & (dist >= max_dist).any(axis=1)
+    result[too_far] = np.nan
+    weights[line_ids] = result
+    return weights
+
+
+def _sidewalk_route_weights(args):
+    segment_endpoints, segment_weights, endpoints, max_dist = args
+    nodes, graph = segment_graph(segment_endpoints, segment_weights)
+    return route_weights(nodes, graph, endpoints, max_dist)
+
+
+def get_route_weights(sidewalks, segments, centerlines,
+                      sidewalk_col='sidewalk_id', line_col='geometry',
+                      weight_col='min_width_factor', max_dist=3, n_workers=1):
+    """
+    Compute the 'route_weight' for each centerline piece, to be used with
+    `poly_utils.get_route_color`.
+
+    The graph of a sidewalk consists of the segments that lie within its
+    polygon. Sidewalks are processed in parallel when n_workers > 1.
+
+    Parameters
+    ----------
+    sidewalks : GeoSeries
+        The sidewalk polygons, the position in the series is the sidewalk ID.
+    segments : GeoDataFrame
+        The sidewalk segments, with a column `weight_col`.
+    centerlines : DataFrame
+        The centerline pieces, with columns `sidewalk_col` and `line_col`.
+    sidewalk_col : str (default: 'sidewalk_id')
+    line_col : str (default: 'geometry')
+    weight_col : str (default: 'min_width_factor')
+    max_dist : float (default: 3)
+        Maximum distance between a line endpoint and its graph node.
+    n_workers : int (default: 1)
+        Number of worker processes.
+
+    Returns
+    -------
+    A Series with route weights, aligned with `centerlines`.
+    """
+    sw_ids, seg_ids = segments.sindex.query_bulk(
+                                sidewalks.values, predicate='contains')
+    seg_order = np.argsort(sw_ids, kind='stable')
+    sw_ids, seg_ids = sw_ids[seg_order], seg_ids[seg_order]
+    seg_splits = np.searchsorted(sw_ids, np.arange(len(sidewalks) + 1))
+
+    seg_endpoints = line_endpoints(segments.geometry.values, keep_rings=True)
+    seg_weights = segments[weight_col].to_numpy(dtype=float)
+    cl_endpoints = line_endpoints(centerlines[line_col].values)
+    cl_sidewalk = centerlines[sidewalk_col].to_numpy()
+    cl_order = np.argsort(cl_sidewalk, kind='stable')
+    cl_splits = np.searchsorted(cl_sidewalk[cl_order],
+                                np.arange(len(sidewalks) + 1))
+
+    tasks = []
+    task_lines = []
+    for i in range(len(sidewalks)):
+        lines = cl_order[cl_splits[i]:cl_splits[i + 1]]
+        if len(lines) == 0:
+            continue
+        seg = seg_ids[seg_splits[i]:seg_splits[i + 1]]
+        tasks.append((seg_endpoints[seg], seg_weights[seg],
+                      cl_endpoints[lines], max_dist))
+        task_lines.append(lines)
+
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(
+                        _sidewalk_route_weights, tasks,
+                        chunksize=max(1, len(tasks) // (4 * n_workers))))
+    else:
+        results = [_sidewalk_route_weights(task) for task in tasks]
+
+    weights = np.full((len(centerlines),), np.nan)
+    for lines, result in zip(task_lines, results):
+        weights[lines] = result
+
+    n_empty = sum(1 for task in tasks if len(task[0]) == 0)
+    logger.info(f'Route weights computed for {len(centerlines)} lines in '
+                + f'{len(tasks)} sidewalks ({n_empty} without network, '
+                + f'{np.count_nonzero(weights == NO_PATH_WEIGHT)} without '
+                + f'route, {np.count_nonzero(np.isnan(weights))} unknown).')
+    return pd.Series(weights, index=centerlines.index, name='route_weight')
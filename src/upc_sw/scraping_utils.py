@@ -1,6 +1,16 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from shapely.ops import unary_union
 from tqdm import tqdm
 
 import upcp.scrapers.ams_bgt_scraper as ams_bgt_scraper
@@ -10,48 +20,188 @@ import upc_sw.poly_utils as poly_utils
 
 CRS = 'epsg:28992'
 
+BGT_WFS_URL = 'https://map.data.amsterdam.nl/maps/bgtobjecten?'
 BGT_use_columns = ['geometry', 'identificatie_lokaalid', 'naam']
 BGT_namedict = {'BGT': 'bgt_functie',
                 'BGTPLUS': 'plus_type'}
 
 TERRAS_WFS_URL = 'https://api.data.amsterdam.nl/v1/wfs/horeca/?'
+TERRAS_LAYER = 'exploitatievergunning-terrasgeometrie'
 TERRAS_use_columns = ['geometry', 'zaaknummer', 'naam']
 
 
-def get_terras_data_for_bbox(bbox, layers=None):
-    """Scrape 'terras' data in a given bounding box."""
-    gdf = gpd.GeoDataFrame(columns=TERRAS_use_columns,
-                           geometry='geometry', crs=CRS)
-    gdf.index.name = 'id'
+def _bbox_string(bbox):
+    return (str(bbox[0][0]) + ',' + str(bbox[0][1]) + ','
+            + str(bbox[1][0]) + ',' + str(bbox[1][1]))
+
 
+def bgt_request_url(layer, bbox=None, base_url=BGT_WFS_URL):
+    """Build the WFS GetFeature request for a BGT layer."""
     params = 'REQUEST=GetFeature&' \
-             'SERVICE=WFS&' \
+             'SERVICE=wfs&' \
              'VERSION=2.0.0&' \
-             'TYPENAMES=exploitatievergunning-terrasgeometrie&'
-
+             'TYPENAME=' + layer + '&'
     if bbox is not None:
-        bbox_string = str(bbox[0][0]) + ',' + str(bbox[0][1]) + ',' \
-                      + str(bbox[1][0]) + ',' + str(bbox[1][1])
-        params = params + 'BBOX=' + bbox_string + '&'
+        params = params + 'BBOX=' + _bbox_string(bbox) + '&'
+    params = params + 'OUTPUTFORMAT=geojson'
+    return base_url + params
 
+
+def terras_request_url(bbox=None, base_url=TERRAS_WFS_URL):
+    """Build the WFS GetFeature request for the 'terras' layer."""
+    params = 'REQUEST=GetFeature&' \
+             'SERVICE=WFS&' \
+             'VERSION=2.0.0&' \
+             'TYPENAMES=' + TERRAS_LAYER + '&'
+    if bbox is not None:
+        params = params + 'BBOX=' + _bbox_string(bbox) + '&'
     params = params + 'OUTPUTFORMAT=geojson'
+    return base_url + params
 
-    response = requests.get(TERRAS_WFS_URL + params)
+
+class ResponseCache:
+    """
+    On-disk cache for WFS responses, keyed by (layer, bbox, url). Entries
+    older than `expiry` seconds are ignored.
+    """
+
+    def __init__(self, folder, expiry=7*24*3600):
+        self.folder = folder
+        self.expiry = expiry
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, layer, bbox, url):
+        key = hashlib.sha1(f'{layer}|{bbox}|{url}'.encode()).hexdigest()
+        return os.path.join(self.folder, f'{key}.json')
+
+    def get(self, layer, bbox, url):
+        path = self._path(layer, bbox, url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.expiry:
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, layer, bbox, url, content):
+        path = self._path(layer, bbox, url)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+
+
+# Response statuses for which a request is retried: rate limiting and
+# (temporary) server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class WFSClient:
+    """
+    HTTP client for the WFS services, with a pooled session, retries and an
+    optional on-disk response cache. The service URLs can be overridden,
+    e.g., to point to a local test server.
+
+    Parameters
+    ----------
+    max_connections : int (default: 8)
+        Size of the connection pool.
+    cache_folder : str (optional)
+        Folder for the response cache. No caching if not given.
+    expiry : int (default: one week)
+        Maximum age of cached responses in seconds.
+    timeout : float (default: 60)
+        Timeout for each request in seconds.
+    retries : int (default: 3)
+        Number of retries for failed GET requests, including responses with
+        status RETRY_STATUSES. After the last retry, the last response is
+        returned.
+    backoff_factor : float (default: 0.5)
+        Backoff between retries, see `urllib3.util.retry.Retry`.
+    """
+
+    def __init__(self, max_connections=8, cache_folder=None,
+                 expiry=7*24*3600, timeout=60, retries=3, backoff_factor=0.5,
+                 bgt_url=BGT_WFS_URL, terras_url=TERRAS_WFS_URL):
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset(['GET']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=max_connections,
+                              pool_maxsize=max_connections,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = (ResponseCache(cache_folder, expiry)
+                      if cache_folder is not None else None)
+        self.timeout = timeout
+        self.bgt_url = bgt_url
+        self.terras_url = terras_url
+
+    def get_json(self, url, layer, bbox):
+        """Get the JSON response for a request, from cache if possible."""
+        if self.cache is not None:
+            content = self.cache.get(layer, bbox, url)
+            if content is not None:
+                return content
+        response = self.session.get(url, timeout=self.timeout)
+        try:
+            content = response.json()
+        except ValueError:
+            return None
+        if self.cache is not None and response.ok:
+            self.cache.put(layer, bbox, url, content)
+        return content
+
+
+def parse_terras_json(json_content):
+    """Parse a 'terras' WFS response into a GeoDataFrame."""
+    gdf = gpd.GeoDataFrame(columns=TERRAS_use_columns,
+                           geometry='geometry', crs=CRS)
+    gdf.index.name = 'id'
     try:
-        json = response.json()
-        if json['numberReturned'] > 0:
+        if json_content['numberReturned'] > 0:
             gdf = gpd.GeoDataFrame.from_features(
-                                    response.json(), crs=CRS).set_index('id')
+                                    json_content, crs=CRS).set_index('id')
             gdf['naam'] = 'terras'
             gdf['geometry'] = gdf['geometry'].apply(poly_utils.fix_invalid)
             return gdf[TERRAS_use_columns]
         else:
             return gdf
-    except ValueError:
+    except (TypeError, KeyError, ValueError):
         return gdf
 
 
-def get_bgt_data_for_bbox(bbox, layers):
+def parse_bgt_json(json_content, layer):
+    """Parse a BGT WFS response for a layer into a GeoDataFrame, or None."""
+    layer_type = BGT_namedict[layer.split('_')[0]]
+    if json_content is not None and len(json_content['features']) > 0:
+        gdf = gpd.GeoDataFrame.from_features(
+                            json_content, crs=CRS).set_index('ogc_fid')
+        gdf = gdf[gdf['bgt_status'] == 'bestaand']
+        gdf['naam'] = gdf[layer_type]
+        return gdf[BGT_use_columns]
+    return None
+
+
+def get_terras_data_for_bbox(bbox, layers=None, client=None):
+    """Scrape 'terras' data in a given bounding box."""
+    if client is None:
+        response = requests.get(terras_request_url(bbox))
+        try:
+            json_content = response.json()
+        except ValueError:
+            json_content = None
+    else:
+        json_content = client.get_json(
+                                terras_request_url(bbox, client.terras_url),
+                                TERRAS_LAYER, bbox)
+    return parse_terras_json(json_content)
+
+
+def get_bgt_data_for_bbox(bbox, layers, client=None):
     """Scrape BGT data in a given bounding box."""
     gdf = gpd.GeoDataFrame(columns=BGT_use_columns,
                            geometry='geometry', crs=CRS)
@@ -60,45 +210,117 @@ def get_bgt_data_for_bbox(bbox, layers):
     content = []
     for layer in layers:
         # Scrape data from the Amsterdam WFS, this will return a json response.
-        json_content = ams_bgt_scraper.scrape_amsterdam_bgt(layer, bbox=bbox)
-
-        layer_type = BGT_namedict[layer.split('_')[0]]
+        if client is None:
+            json_content = ams_bgt_scraper.scrape_amsterdam_bgt(layer,
+                                                                bbox=bbox)
+        else:
+            json_content = client.get_json(
+                            bgt_request_url(layer, bbox, client.bgt_url),
+                            layer, bbox)
 
         # Parse the downloaded json response.
-        if json_content is not None and len(json_content['features']) > 0:
-            gdf = gpd.GeoDataFrame.from_features(
-                                json_content, crs=CRS).set_index('ogc_fid')
-            gdf = gdf[gdf['bgt_status'] == 'bestaand']
-            gdf['naam'] = gdf[layer_type]
-            content.append(gdf[BGT_use_columns])
+        layer_gdf = parse_bgt_json(json_content, layer)
+        if layer_gdf is not None:
+            content.append(layer_gdf)
 
     if len(content) > 0:
         gdf = pd.concat(content)
     return gdf
 
 
-def process_tiles(tiles, bgt_layers, scraper=get_bgt_data_for_bbox):
-    """This method scrapes data precisely for the needed area."""
-    bgt_data = []
+def coalesce_tiles(tiles, block_size=2):
+    """
+    Group tiles into blocks of block_size x block_size tiles on the tile
+    grid.
+
+    Returns
+    -------
+    A list of tuples (bbox, tilecodes), with bbox ((x_min, y_max), (x_max,
+    y_min)) covering all tiles in the block.
+    """
+    blocks = {}
+    for tilecode in tiles:
+        x, y = (int(c) for c in tilecode.split('_'))
+        blocks.setdefault((x // block_size, y // block_size),
+                          []).append(tilecode)
+
+    result = []
+    for block_tiles in blocks.values():
+        bboxes = np.array([np.ravel(las_utils.get_bbox_from_tile_code(
+                                tilecode, padding=0))
+                           for tilecode in block_tiles])
+        bbox = ((bboxes[:, 0].min(), bboxes[:, 1].max()),
+                (bboxes[:, 2].max(), bboxes[:, 3].min()))
+        result.append((bbox, block_tiles))
+    return result
+
+
+def process_tiles(tiles, bgt_layers, scraper=get_bgt_data_for_bbox,
+                  max_workers=1, client=None, block_size=1):
+    """
+    This method scrapes data precisely for the needed area.
+
+    With max_workers > 1, tiles and layers are fetched concurrently. With
+    block_size > 1, adjacent tiles are fetched in a single request per block
+    of block_size x block_size tiles; only features that intersect the
+    requested tiles are kept. A custom scraper must accept a `client`
+    keyword argument when max_workers > 1 or a client is given.
+    """
+    if max_workers > 1 and client is None:
+        client = WFSClient(max_connections=max_workers)
+
+    if block_size > 1:
+        blocks = coalesce_tiles(tiles, block_size)
+    else:
+        blocks = [(las_utils.get_bbox_from_tile_code(tilecode, padding=0),
+                   [tilecode]) for tilecode in tiles]
+
+    # One task per block and layer.
+    layers = [None] if bgt_layers is None else bgt_layers
+    tasks = [(bbox, layer) for bbox, _ in blocks for layer in layers]
+
+    def run_task(task):
+        bbox, layer = task
+        task_layers = None if layer is None else [layer]
+        if client is None:
+            return scraper(bbox, task_layers)
+        return scraper(bbox, task_layers, client=client)
 
-    tile_tqdm = tqdm(tiles, unit='tile', smoothing=0)
-    for tilecode in tile_tqdm:
-        tile_tqdm.set_postfix_str(tilecode)
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            bgt_data = list(tqdm(executor.map(run_task, tasks),
+                                 total=len(tasks), unit='request',
+                                 smoothing=0))
+    else:
+        bgt_data = [run_task(task)
+                    for task in tqdm(tasks, unit='request', smoothing=0)]
 
-        bbox = las_utils.get_bbox_from_tile_code(tilecode, padding=0)
-        bgt_data.append(scraper(bbox, bgt_layers))
+    if block_size > 1:
+        # Only keep features that intersect the requested tiles.
+        for i, (_, block_tiles) in enumerate(blocks):
+            for j in range(len(layers)):
+                gdf = bgt_data[i * len(layers) + j]
+                if len(gdf) > 0 and len(block_tiles) < block_size ** 2:
+                    area = unary_union(
+                        [poly_utils.tilecode_to_poly(tilecode)
+                         for tilecode in block_tiles])
+                    bgt_data[i * len(layers) + j] = gdf[gdf.intersects(area)]
 
+    # Features returned for multiple tiles or blocks are removed.
     bgt_gdf = pd.concat(bgt_data)
     return bgt_gdf[~bgt_gdf.duplicated()]
 
 
-def process_folder(folder, bgt_layers, scraper=get_bgt_data_for_bbox):
+def process_folder(folder, bgt_layers, scraper=get_bgt_data_for_bbox,
+                   client=None):
     """
     This method scrapes all data in an area defined as the bounding box for all
     point cloud tiles  in a given folder. This results in some unnecessary
     data, but is much faster if the folder  contains many files, and / or is
-    densily packed within the bounding box.
+    densily packed within the bounding box. If a `client` is given, it is
+    passed to the scraper.
     """
     bbox = las_utils.get_bbox_from_las_folder(folder, padding=0)
-    bgt_data = scraper(bbox, bgt_layers)
-    return bgt_data
+    if client is None:
+        return scraper(bbox, bgt_layers)
+    return scraper(bbox, bgt_layers, client=client)
@@ -3,51 +3,109 @@ import laspy
 
 from upcp.utils import clip_utils
 import upc_sw.poly_utils as poly_utils
+import upc_sw.ground_cache as ground_cache
+from upc_sw.point_cloud import LocalPointCloud
+import upc_sw.instrumentation as instrumentation
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def sidewalk_clip(points, tilecode, sw_poly_gdf,
-                  ahn_reader=None, max_height=2.0):
-    sw_mask = np.zeros((len(points),), dtype=bool)
+def get_tile_polygons(sw_poly_gdf, tilecode):
+    """Select the polygons that intersect a tile using the spatial index."""
+    ids = sw_poly_gdf.sindex.query(poly_utils.tilecode_to_poly(tilecode),
+                                   predicate='intersects')
+    return sw_poly_gdf.iloc[np.sort(ids)]
 
-    sw_polys = sw_poly_gdf[
-                sw_poly_gdf.intersects(poly_utils.tilecode_to_poly(tilecode))]
-    if len(sw_polys) == 0:
-        logging.info(f'No sidewalk polygons for tile {tilecode}.')
-        return sw_mask, len(sw_polys) > 0
 
-    for polygon in sw_polys.geometry:
-        clip_mask = clip_utils.poly_clip(points, polygon)
-        sw_mask = sw_mask | clip_mask
+def polygons_clip(points, polygons):
+    """
+    Create a mask for all points that lie inside any of the given polygons.
+
+    Points are sorted along the x-axis once, such that for each polygon the
+    points inside its bounding box can be found with a binary search. The
+    exact point-in-polygon test is only done for points in the bounding box
+    that are not already inside another polygon.
+    """
+    mask = np.zeros((len(points),), dtype=bool)
+    if len(points) == 0:
+        return mask
+
+    order = np.argsort(points[:, 0], kind='stable')
+    x_sorted = points[order, 0]
+    for polygon in polygons:
+        if polygon is None or polygon.is_empty:
+            continue
+        x_min, y_min, x_max, y_max = polygon.bounds
+        lo = np.searchsorted(x_sorted, x_min, side='left')
+        hi = np.searchsorted(x_sorted, x_max, side='right')
+        ids = order[lo:hi]
+        ids = ids[(points[ids, 1] >= y_min) & (points[ids, 1] <= y_max)
+                  & ~mask[ids]]
+        if len(ids) > 0:
+            mask[ids] = clip_utils.poly_clip(points[ids, :], polygon)
+    return mask
+
+
+def _sidewalk_mask(points, tilecode, polygons, ahn_reader=None,
+                   max_height=2.0):
+    """
+    Mask of `sidewalk_clip` for an array of shape (n, 3) or a
+    `LocalPointCloud`, with the polygons in the coordinates of `local_xy`.
+    """
+    with instrumentation.timer('polygon_clip'):
+        if isinstance(points, LocalPointCloud):
+            sw_mask = polygons_clip(points.local_xy(), polygons)
+        else:
+            sw_mask = polygons_clip(points, polygons)
+    instrumentation.count('points_in_polygons', np.count_nonzero(sw_mask))
 
     if ahn_reader is not None:
-        sw_ids = np.where(sw_mask)[0]
-        ahn_mask = np.zeros((len(sw_ids),), dtype=bool)
-        gnd_z = ahn_reader.interpolate(tilecode, points[sw_ids, :],
-                                       surface='ground_surface')
-        gnd_z_valid = np.isfinite(gnd_z)
-        gnd_z_val_ids = np.where(gnd_z_valid)[0]
-        # Every point between 0 and max_height above ground plane.
-        # First, check points with valid elevation data.
-        valid_mask = ((gnd_z[gnd_z_valid] < points[sw_ids[gnd_z_valid], 2])
-                      & (points[sw_ids[gnd_z_valid], 2]
-                         <= gnd_z[gnd_z_valid] + max_height))
-        ahn_mask[gnd_z_val_ids[valid_mask]] = True
+        sw_ids = np.flatnonzero(sw_mask)
+        if isinstance(points, LocalPointCloud):
+            sw_points = points.subset(sw_ids).xyz()
+        else:
+            sw_points = points[sw_ids, :]
+        with instrumentation.timer('ground_interpolation'):
+            gnd_z = ahn_reader.interpolate(tilecode, sw_points,
+                                           surface='ground_surface')
+        # Every point between 0 and max_height above ground plane. Points
+        # without elevation data are removed.
         # TODO: do something clever for points without AHN data.
-        # Next, check remaining points to lie between min and max elevation.
-        # if np.count_nonzero(gnd_z_valid) > 0:
-        #     gnd_min = np.min(gnd_z)
-        #     gnd_max = np.max(gnd_z)
-        #     inval_mask = ((gnd_min < points[sw_ids[~gnd_z_valid], 2])
-        #                   & (points[sw_ids[~gnd_z_valid], 2]
-        #                      <= gnd_max + max_height))
-        #     ahn_mask[~gnd_z_valid][inval_mask] = True
-        sw_mask[sw_ids] = ahn_mask
-
-    logging.info(f'{np.count_nonzero(sw_mask)} points clipped in '
-                 + f'{len(sw_polys)} sidewalk polygons.')
+        sw_mask[sw_ids] = ground_cache.height_band_mask(
+                                sw_points[:, 2], gnd_z, max_height)
+    return sw_mask
+
+
+def sidewalk_clip(points, tilecode, sw_poly_gdf,
+                  ahn_reader=None, max_height=2.0, chunk_size=1000000):
+    """
+    Create a mask for the points that lie inside the sidewalk polygons of a
+    tile and, if `ahn_reader` is given, at most `max_height` above the
+    ground. `points` can be an array of shape (n, 3) or a `LocalPointCloud`.
+    For a `LocalPointCloud` the float64 coordinates are created per chunk of
+    `chunk_size` points.
+    """
+    sw_polys = get_tile_polygons(sw_poly_gdf, tilecode)
+    if len(sw_polys) == 0:
+        logger.info(f'No sidewalk polygons for tile {tilecode}.')
+        return np.zeros((len(points),), dtype=bool), False
+
+    if isinstance(points, LocalPointCloud):
+        polygons = [points.to_local(poly) for poly in sw_polys.geometry]
+        sw_mask = np.zeros((len(points),), dtype=bool)
+        for start in range(0, len(points), chunk_size):
+            ids = np.arange(start, min(start + chunk_size, len(points)))
+            sw_mask[ids] = _sidewalk_mask(points.subset(ids), tilecode,
+                                          polygons, ahn_reader, max_height)
+    else:
+        sw_mask = _sidewalk_mask(points, tilecode, sw_polys.geometry,
+                                 ahn_reader, max_height)
+
+    n_clipped = np.count_nonzero(sw_mask)
+    instrumentation.count('points_clipped', n_clipped)
+    logger.info(f'{n_clipped} points clipped in '
+                + f'{len(sw_polys)} sidewalk polygons.')
 
     return sw_mask, len(sw_polys) > 0
 
@@ -55,8 +113,8 @@ def sidewalk_clip(points, tilecode, sw_poly_gdf,
 def create_label_mask(labels, target_labels=None, exclude_labels=None):
     """Create mask based on `target_labels` or `exclude_labels`."""
     if (target_labels is not None) and (exclude_labels is not None):
-        print('Please provide either target_labels or exclude_labels, '
-              + 'but not both.')
+        logger.error('Please provide either target_labels or exclude_labels, '
+                     + 'but not both.')
         return None
     elif target_labels is not None:
         mask = np.zeros((len(labels),), dtype=bool)
@@ -70,6 +128,26 @@ def create_label_mask(labels, target_labels=None, exclude_labels=None):
         return mask
 
 
+def fuser_label_mask(fuser, points, labels, tilecode, chunk_size=1000000):
+    """
+    Label mask of a data fuser, e.g. the AHN ground fuser, for an array of
+    shape (n, 3) or a `LocalPointCloud`. For a `LocalPointCloud` the float64
+    absolute coordinates are created per chunk of `chunk_size` points, so the
+    fuser must label each point on its own (for `AHNFuser`:
+    `refine_ground=False`).
+    """
+    if not isinstance(points, LocalPointCloud):
+        mask = np.ones((len(points),), dtype=bool)
+        return fuser.get_label_mask(points, labels, mask, tilecode)
+    label_mask = np.zeros((len(points),), dtype=bool)
+    for start in range(0, len(points), chunk_size):
+        ids = np.arange(start, min(start + chunk_size, len(points)))
+        label_mask[ids] = fuser.get_label_mask(
+                                points.subset(ids).xyz(), labels[ids],
+                                np.ones((len(ids),), dtype=bool), tilecode)
+    return label_mask
+
+
 def read_las(las_path, extra_val='label', extra_val_dtype='uint16'):
     pointcloud = laspy.read(las_path)
 
@@ -80,12 +158,15 @@ def read_las(las_path, extra_val='label', extra_val_dtype='uint16'):
         values = pointcloud[extra_val]
 
     points = np.vstack((pointcloud.x, pointcloud.y, pointcloud.z)).T
+    instrumentation.count('points_read', len(points))
 
     return points, values
 
 
 def write_las(points, las_path, extra_val='label', extra_val_dtype='uint16',
               extra_val_desc='Labels', values=None):
+    if isinstance(points, LocalPointCloud):
+        points = points.xyz()
     outfile = laspy.create(file_version="1.2", point_format=3)
     outfile.x = points[:, 0]
     outfile.y = points[:, 1]
@@ -96,3 +177,216 @@ def write_las(points, las_path, extra_val='label', extra_val_dtype='uint16',
                               description=extra_val_desc))
         outfile[extra_val] = values
     outfile.write(las_path)
+
+
+def _las_dim_loader(las_path, name, dtype, chunk_size):
+    """Function that reads a single dimension of a LAS/LAZ file."""
+    def load():
+        with laspy.open(las_path) as reader:
+            values = np.zeros((reader.header.point_count,), dtype=dtype)
+            if name not in list(reader.header.point_format.dimension_names):
+                return values
+            start = 0
+            for chunk in reader.chunk_iterator(chunk_size):
+                values[start:start + len(chunk)] = chunk[name]
+                start += len(chunk)
+        return values
+    return load
+
+
+def read_las_local(las_path, extra_val='label', extra_val_dtype='uint16',
+                   origin=None, chunk_size=1000000):
+    """
+    Read a LAS/LAZ file into a `LocalPointCloud`, keeping the 32-bit integer
+    coordinates of the file. The file is read in chunks, such that the
+    float64 coordinates are never in memory. The extra dimension is only read
+    when it is first accessed, with `point_cloud.get(extra_val)`.
+
+    Parameters
+    ----------
+    las_path : str
+        The file to read.
+    extra_val : str (default: 'label')
+        Name of the extra dimension.
+    extra_val_dtype : str (default: 'uint16')
+        Type of the extra dimension, used when it is not present in the file.
+    origin : array of shape (3,) (optional)
+        Local origin, e.g. `point_cloud.tile_origin(tilecode)`. Defaults to
+        the rounded down minimum of the file header.
+    chunk_size : int (default: 1000000)
+        Number of points read at a time.
+    """
+    with laspy.open(las_path) as reader:
+        header = reader.header
+        if origin is None:
+            origin = np.floor(header.mins)
+        local = np.empty((3, header.point_count), dtype=np.int32)
+        start = 0
+        for chunk in reader.chunk_iterator(chunk_size):
+            end = start + len(chunk)
+            for axis, values in enumerate((chunk.X, chunk.Y, chunk.Z)):
+                local[axis, start:end] = values
+            start = end
+    instrumentation.count('points_read', local.shape[1])
+    extra = {extra_val: _las_dim_loader(las_path, extra_val,
+                                        extra_val_dtype, chunk_size)}
+    return LocalPointCloud(local, header.offsets, header.scales, origin,
+                           extra)
+
+
+def _chunk_prefilter_mask(points, bbox=None, polygons=None):
+    mask = np.ones((len(points),), dtype=bool)
+    if bbox is not None:
+        x_min, y_min, x_max, y_max = bbox
+        mask = ((points[:, 0] >= x_min) & (points[:, 0] <= x_max)
+                & (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+    if polygons is not None:
+        ids = np.flatnonzero(mask)
+        mask[ids] = polygons_clip(points[ids], polygons)
+    return mask
+
+
+def iter_las_chunks(las_path, chunk_size=1000000, extra_val='label',
+                    extra_val_dtype='uint16', bbox=None, polygons=None):
+    """
+    Read a LAS/LAZ file in chunks, such that only one chunk is in memory at
+    a time.
+
+    Parameters
+    ----------
+    las_path : str
+        The file to read.
+    chunk_size : int (default: 1000000)
+        Maximum number of points per chunk.
+    extra_val : str (default: 'label')
+        Name of the extra dimension to read.
+    extra_val_dtype : str (default: 'uint16')
+        Type of the extra dimension, used when it is not present in the file.
+    bbox : tuple (x_min, y_min, x_max, y_max) (optional)
+        Only yield points inside this bounding box.
+    polygons : iterable of Polygons (optional)
+        Only yield points inside any of these polygons.
+
+    Yields
+    ------
+    Tuples (points, values) with points an array of shape (n, 3).
+    """
+    with laspy.open(las_path) as reader:
+        has_extra = extra_val in list(reader.header.point_format
+                                      .dimension_names)
+        for chunk in reader.chunk_iterator(chunk_size):
+            points = np.vstack((chunk.x, chunk.y, chunk.z)).T
+            instrumentation.count('points_read', len(points))
+            if has_extra:
+                values = np.asarray(chunk[extra_val])
+            else:
+                values = np.zeros((len(points),), dtype=extra_val_dtype)
+            if bbox is not None or polygons is not None:
+                mask = _chunk_prefilter_mask(points, bbox, polygons)
+                points, values = points[mask], values[mask]
+            yield points, values
+
+
+class LasChunkWriter:
+    """
+    Write a LAS/LAZ file incrementally, one chunk of points at a time. The
+    resulting file is the same as the one written by `write_las`, with the
+    difference that the header is fixed before the first chunk: with
+    `with_values=True` the extra dimension is always added, and is zero for
+    chunks written without values, whereas `write_las` only adds it when
+    values are given. Use `with_values=False` to write the points only.
+
+    Use as a context manager:
+
+        with LasChunkWriter(las_path) as writer:
+            for points, values in ...:
+                writer.write(points, values)
+    """
+
+    def __init__(self, las_path, extra_val='label', extra_val_dtype='uint16',
+                 extra_val_desc='Labels', with_values=True):
+        self.header = laspy.LasHeader(point_format=3, version='1.2')
+        self.extra_val = extra_val
+        self.with_values = with_values
+        if with_values:
+            self.header.add_extra_dim(laspy.ExtraBytesParams(
+                                            name=extra_val,
+                                            type=extra_val_dtype,
+                                            description=extra_val_desc))
+        self.las_path = las_path
+        self.writer = None
+        self.point_count = 0
+
+    def __enter__(self):
+        self.writer = laspy.open(self.las_path, mode='w', header=self.header)
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, points, values=None):
+        """Append a chunk of points (and extra values) to the file."""
+        if len(points) == 0:
+            return
+        if isinstance(points, LocalPointCloud):
+            points = points.xyz()
+        chunk = laspy.LasData(header=self.header)
+        chunk.x = points[:, 0]
+        chunk.y = points[:, 1]
+        chunk.z = points[:, 2]
+        if self.with_values and values is not None:
+            chunk[self.extra_val] = values
+        self.writer.write_points(chunk.points)
+        self.point_count += len(points)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def sidewalk_clip_las(in_file, out_file, tilecode, sw_poly_gdf,
+                      ahn_reader=None, max_height=2.0, ground_mask_fn=None,
+                      chunk_size=1000000):
+    """
+    Streaming version of the points-above-sidewalk stage: read a tile in
+    chunks, remove ground points, clip to the sidewalk polygons and append
+    the result to the output file. Only one chunk is in memory at a time.
+
+    Parameters
+    ----------
+    ground_mask_fn : callable (optional)
+        Function (points, labels) -> mask of ground points, which are
+        removed before clipping.
+
+    Returns
+    -------
+    The number of points written, and whether the tile has sidewalk
+    polygons. When it has none, no output file is written.
+    """
+    sw_polys = get_tile_polygons(sw_poly_gdf, tilecode)
+    if len(sw_polys) == 0:
+        logger.info(f'No sidewalk polygons for tile {tilecode}.')
+        return 0, False
+
+    # The polygons are selected once and re-used for every chunk. Only
+    # points inside their bounding box can be clipped.
+    polygons = list(sw_polys.geometry)
+    x_min, y_min, x_max, y_max = sw_polys.total_bounds
+    with LasChunkWriter(out_file) as writer:
+        for points, labels in iter_las_chunks(
+                                    in_file, chunk_size=chunk_size,
+                                    bbox=(x_min, y_min, x_max, y_max)):
+            if ground_mask_fn is not None:
+                with instrumentation.timer('ground_filter'):
+                    keep = ~ground_mask_fn(points, labels)
+                points, labels = points[keep], labels[keep]
+            sw_mask = _sidewalk_mask(points, tilecode, polygons,
+                                     ahn_reader=ahn_reader,
+                                     max_height=max_height)
+            instrumentation.count('points_clipped', np.count_nonzero(sw_mask))
+            writer.write(points[sw_mask], labels[sw_mask])
+
+    logger.info(f'{writer.point_count} points clipped in '
+                + f'{len(sw_polys)} sidewalk polygons.')
+    return writer.point_count, True
@@ -0,0 +1,402 @@
+"""
+Multi-process runner for the points-above-sidewalk stage.
+
+Tiles are processed in a process pool. Each worker loads the sidewalk
+polygons, AHN surface cache and ground fuser once, when it starts. The status,
+timing and errors of each tile are appended to a JSON lines manifest on disk,
+such that an interrupted run can be resumed exactly.
+"""
+
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import geopandas as gpd
+from tqdm import tqdm
+
+import upcp.fusion as fusion
+from upcp.labels import Labels
+
+import upc_sw.sw_utils as sw_utils
+from upc_sw.point_cloud import tile_origin
+from upc_sw.ground_cache import GroundSurfaceCache
+import upc_sw.instrumentation as instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Tile status values that will be skipped when resuming.
+DONE_STATES = ('done', 'no_sidewalk')
+
+
+class TileManifest:
+    """
+    Append-only manifest with per-tile status, timing and errors, stored as
+    JSON lines. Only the last record of each tile is taken into account.
+
+    Parameters
+    ----------
+    path : str
+        Location of the manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            lines = f.readlines()
+        if len(lines) > 0 and not lines[-1].endswith('\n'):
+            # Terminate an incomplete last line before appending.
+            with open(self.path, 'a') as f:
+                f.write('\n')
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Incomplete line from an interrupted write.
+                continue
+            self.records[record['tilecode']] = record
+
+    def record(self, tilecode, status, **info):
+        """Append a record for a tile and flush it to disk."""
+        record = {'tilecode': tilecode, 'status': status,
+                  'time': time.time(), **info}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[tilecode] = record
+
+    def status(self, tilecode):
+        """Get the last known status of a tile, or None."""
+        record = self.records.get(tilecode)
+        return None if record is None else record['status']
+
+    def done_tiles(self):
+        """Get the set of tiles that were successfully processed."""
+        return {tilecode for tilecode, record in self.records.items()
+                if record['status'] in DONE_STATES}
+
+    def failed_tiles(self):
+        """Get a dict {tilecode: error} of tiles that failed."""
+        return {tilecode: record.get('error')
+                for tilecode, record in self.records.items()
+                if record['status'] == 'failed'}
+
+
+class SidewalkTilePipeline:
+    """
+    Extract the points above the sidewalk for a tile, for each run:
+    `read_las` -> ground filter -> `sidewalk_clip` -> `write_las`.
+
+    The object itself only holds settings, so it is cheap to send to the
+    worker processes. Heavy resources are loaded by `setup()`, once per
+    process.
+
+    Parameters
+    ----------
+    pc_data_folder : str
+        Folder containing a sub-folder per run with the point clouds.
+    sidewalk_file : str
+        GeoPackage with the sidewalk polygons.
+    ahn_data_folder : str
+        Folder with the pre-processed AHN .npz files.
+    runs : list of str (default: ['run1', 'run2'])
+        Sub-folders to process for each tile.
+    pc_file_prefix : str (default: 'filtered')
+        Prefix of the input point cloud files.
+    use_existing_labels : bool (default: False)
+        Use ground labels found in the point cloud, if present.
+    ground_labels : list of int (optional)
+        Labels to use as ground when `use_existing_labels` is True.
+    max_height : float (default: 2.0)
+        Maximum height above ground for points to be kept.
+    chunk_size : int (optional)
+        When set, tiles are streamed in chunks of this many points, such that
+        only one chunk is in memory at a time.
+    ahn_cache_folder : str (optional)
+        Folder for decoded AHN grids, shared by the worker processes. See
+        `GroundSurfaceCache`.
+    ahn_memory_budget : int (default: 1e9)
+        Bytes of AHN grids each worker keeps in memory.
+    """
+
+    def __init__(self, pc_data_folder, sidewalk_file, ahn_data_folder,
+                 runs=('run1', 'run2'), pc_file_prefix='filtered',
+                 use_existing_labels=False, ground_labels=None,
+                 max_height=2.0, chunk_size=None, ahn_cache_folder=None,
+                 ahn_memory_budget=1e9):
+        self.pc_data_folder = pc_data_folder
+        self.sidewalk_file = sidewalk_file
+        self.ahn_data_folder = ahn_data_folder
+        self.runs = list(runs)
+        self.pc_file_prefix = pc_file_prefix
+        self.use_existing_labels = use_existing_labels
+        if ground_labels is None:
+            ground_labels = [Labels.GROUND, Labels.ROAD]
+        self.ground_labels = ground_labels
+        self.max_height = max_height
+        self.chunk_size = chunk_size
+        self.ahn_cache_folder = ahn_cache_folder
+        self.ahn_memory_budget = ahn_memory_budget
+        self.sw_gdf = None
+
+    def __getstate__(self):
+        # Never send loaded resources to the worker processes.
+        state = self.__dict__.copy()
+        for key in ('sw_gdf', 'ahn_reader', 'ground_fuser'):
+            state.pop(key, None)
+        state['sw_gdf'] = None
+        return state
+
+    def setup(self):
+        """Load the sidewalk polygons, AHN surface cache and ground fuser."""
+        if self.sw_gdf is not None:
+            return
+        self.sw_gdf = gpd.read_file(self.sidewalk_file).set_index('ogc_fid')
+        # Build the spatial index once, it is re-used for every tile.
+        self.sw_gdf.sindex
+        # The ground fuser and sidewalk clip share the decoded AHN grids.
+        self.ahn_reader = GroundSurfaceCache(
+                                self.ahn_data_folder,
+                                cache_folder=self.ahn_cache_folder,
+                                memory_budget=self.ahn_memory_budget)
+        self.ground_fuser = fusion.AHNFuser(
+                                Labels.GROUND, ahn_reader=self.ahn_reader,
+                                target='ground', epsilon=0.2,
+                                refine_ground=False)
+
+    def in_file(self, tilecode, run):
+        return (f'{self.pc_data_folder}{run}/'
+                + f'{self.pc_file_prefix}_{tilecode}.laz')
+
+    def out_file(self, tilecode, run):
+        return f'{self.pc_data_folder}obstacles_{run}/obst_{tilecode}.laz'
+
+    def make_folders(self):
+        for run in self.runs:
+            os.makedirs(f'{self.pc_data_folder}obstacles_{run}',
+                        exist_ok=True)
+
+    def _ground_mask(self, points, labels, tilecode):
+        if (self.use_existing_labels
+                and np.count_nonzero(labels) > 0):
+            return sw_utils.create_label_mask(
+                                labels, target_labels=self.ground_labels)
+        return sw_utils.fuser_label_mask(self.ground_fuser, points, labels,
+                                         tilecode)
+
+    def process_tile_chunked(self, tilecode):
+        """Process all runs for a single tile, streaming it in chunks."""
+        self.setup()
+        info = {}
+        has_polys = False
+        for run in self.runs:
+            n_clipped, has_polys = sw_utils.sidewalk_clip_las(
+                    self.in_file(tilecode, run), self.out_file(tilecode, run),
+                    tilecode, self.sw_gdf, ahn_reader=self.ahn_reader,
+                    max_height=self.max_height,
+                    ground_mask_fn=lambda points, labels: self._ground_mask(
+                                                points, labels, tilecode),
+                    chunk_size=self.chunk_size)
+            info[run] = {'n_clipped': int(n_clipped)}
+            if not has_polys:
+                break
+        return ('done' if has_polys else 'no_sidewalk'), info
+
+    def process_tile(self, tilecode):
+        """
+        Process all runs for a single tile.
+
+        Returns
+        -------
+        A tuple (status, info) with info a dict of statistics per run.
+        """
+        if self.chunk_size is not None:
+            return self.process_tile_chunked(tilecode)
+        self.setup()
+        info = {}
+        has_polys = False
+        for run in self.runs:
+            # Compact points with the int32 coordinates of the file.
+            points = sw_utils.read_las_local(self.in_file(tilecode, run),
+                                             extra_val='label',
+                                             origin=tile_origin(tilecode))
+            labels = points.get('label')
+            obstacle_mask = np.zeros((len(points),), dtype=bool)
+            ground_mask = self._ground_mask(points, labels, tilecode)
+
+            sw_mask, has_polys = sw_utils.sidewalk_clip(
+                                points.subset(~ground_mask), tilecode,
+                                sw_poly_gdf=self.sw_gdf,
+                                ahn_reader=self.ahn_reader,
+                                max_height=self.max_height)
+
+            if has_polys:
+                obstacle_mask[~ground_mask] = sw_mask
+                sw_utils.write_las(points.subset(obstacle_mask),
+                                   self.out_file(tilecode, run),
+                                   values=labels[obstacle_mask])
+            info[run] = {'n_points': int(len(points)),
+                         'n_clipped': int(np.count_nonzero(obstacle_mask))}
+            if not has_polys:
+                # Same polygons for all runs.
+                break
+        return ('done' if has_polys else 'no_sidewalk'), info
+
+
+# The pipeline of the current worker process.
+_worker_pipeline = None
+
+
+def _init_worker(pipeline, instrument_kwargs=None):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+    if instrument_kwargs is not None:
+        instrumentation.enable(**instrument_kwargs)
+    _worker_pipeline.setup()
+
+
+def _run_tile(tilecode):
+    start = time.perf_counter()
+    try:
+        with instrumentation.scope('tile', tilecode):
+            status, info = _worker_pipeline.process_tile(tilecode)
+        error = None
+    except Exception as e:
+        status, info = 'failed', {}
+        error = f'{type(e).__name__}: {e}\n{traceback.format_exc()}'
+    return {'status': status, 'duration': time.perf_counter() - start,
+            'pid': os.getpid(), 'error': error, 'runs': info}
+
+
+def run_tiles(pipeline, tiles, manifest_file, n_workers=None,
+              max_in_flight=None, resume=True, instrument_file=None,
+              profile_tiles=None, profile_dir=None):
+    """
+    Process tiles with a pool of worker processes.
+
+    Parameters
+    ----------
+    pipeline : SidewalkTilePipeline
+        The pipeline to run for each tile.
+    tiles : iterable of str
+        The tilecodes to process.
+    manifest_file : str
+        Location of the manifest, used to resume interrupted runs.
+    n_workers : int (optional)
+        Number of worker processes, defaults to the number of CPU cores.
+    max_in_flight : int (optional)
+        Maximum number of submitted but unfinished tiles, defaults to twice
+        the number of workers. This keeps the memory use bounded.
+    resume : bool (default: True)
+        Skip tiles that are marked as done in the manifest.
+    instrument_file : str (optional)
+        When given, timers and counters for each tile are appended to this
+        JSON lines file, see `upc_sw.instrumentation`.
+    profile_tiles : iterable of str (optional)
+        Tiles to run under cProfile, requires `instrument_file`.
+    profile_dir : str (optional)
+        Folder for the cProfile stats of `profile_tiles`.
+
+    Returns
+    -------
+    The TileManifest.
+    """
+    manifest = TileManifest(manifest_file)
+    tiles = sorted(set(tiles))
+    if resume:
+        done_tiles = manifest.done_tiles()
+        tiles = [tilecode for tilecode in tiles if tilecode not in done_tiles]
+    if len(tiles) == 0:
+        logger.info('No tiles to process.')
+        return manifest
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, len(tiles)))
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+
+    pipeline.make_folders()
+    tile_iter = iter(tiles)
+    tile_tqdm = tqdm(total=len(tiles), unit='tile', smoothing=0)
+
+    instrument_kwargs = None
+    if instrument_file is not None:
+        instrument_kwargs = {'path': instrument_file,
+                             'profile_ids': set(profile_tiles or ()),
+                             'profile_dir': profile_dir}
+
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=n_workers,
+                                   initializer=_init_worker,
+                                   initargs=(pipeline, instrument_kwargs))
+
+    # A worker process that dies (e.g., killed for running out of memory)
+    # breaks the whole pool: all its unfinished tiles fail, and it does not
+    # accept new tiles. The tiles are recorded as failed, such that they are
+    # retried when resuming, and the remaining tiles go to a new pool.
+    executor = new_executor()
+    generation = 0
+    pending = {}
+
+    def replace_executor():
+        nonlocal executor, generation
+        logger.warning('Worker pool broke, starting a new one.')
+        executor.shutdown(wait=True)
+        executor = new_executor()
+        generation += 1
+
+    def submit_next():
+        tilecode = next(tile_iter, None)
+        if tilecode is None:
+            return False
+        try:
+            future = executor.submit(_run_tile, tilecode)
+        except BrokenProcessPool:
+            replace_executor()
+            future = executor.submit(_run_tile, tilecode)
+        pending[future] = (tilecode, generation)
+        return True
+
+    try:
+        while len(pending) < max_in_flight and submit_next():
+            pass
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                tilecode, future_generation = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        broken |= (future_generation == generation)
+                    result = {'status': 'failed',
+                              'error': f'{type(e).__name__}: {e}'}
+                status = result.pop('status')
+                manifest.record(tilecode, status, **result)
+                if status == 'failed':
+                    logger.warning(f'Tile {tilecode} failed: '
+                                   + result['error'].splitlines()[0])
+                tile_tqdm.set_postfix_str(tilecode)
+                tile_tqdm.update(1)
+            if broken:
+                replace_executor()
+            while len(pending) < max_in_flight and submit_next():
+                pass
+    finally:
+        executor.shutdown(wait=True)
+
+    tile_tqdm.close()
+    return manifest
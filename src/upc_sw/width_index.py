@@ -0,0 +1,427 @@
+"""
+In-memory query index over sidewalk segments with widths, e.g. the output of
+notebook 5 (`sidewalk_segments.gpkg`) or notebook 6.
+
+The segments are loaded once into columnar NumPy arrays: the straight edges
+of all segments, the segment of each edge, and the attribute columns per
+segment ('avg_width', 'min_width', 'route_weight'). The edges are indexed by
+a packed STR-tree that is stored as arrays as well, such that queries are
+vectorized, can be batched, and the index can be saved to a folder of `.npy`
+files that are memory-mapped when loaded.
+
+Queries return the bottleneck width (the smallest 'min_width' of the matched
+segments) and the coverage (the fraction of the query that is matched to a
+segment with a known width).
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import geopandas as gpd
+
+import upc_sw.line_arrays as line_arrays
+import upc_sw.width_utils as width_utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+WIDTH_COLUMNS = ('avg_width', 'min_width', 'route_weight')
+
+WidthQueryResult = namedtuple('WidthQueryResult',
+                              ['bottleneck', 'avg_width', 'coverage',
+                               'route_weight', 'ids'])
+WidthQueryResult.__doc__ = """
+Result of a width query. For batched queries, the fields are arrays with one
+value per query and `ids` is a list of arrays.
+
+bottleneck : the smallest 'min_width' of the matched segments.
+avg_width : the mean 'avg_width' of the matched segments, weighted by length
+    (bbox) or by the number of matched route points (route).
+coverage : the fraction of the matched segment length (bbox) or of the
+    route points that has a known width.
+route_weight : the largest 'route_weight' of the matched segments.
+ids : the row numbers of the matched segments.
+"""
+
+_ARRAYS = ('edges', 'edge_bounds', 'edge_segment', 'node_bounds',
+           'level_offsets', 'segment_length')
+
+
+def str_order(bounds, node_capacity):
+    """
+    Sort-Tile-Recursive order of boxes: sorted by x into vertical slices of
+    whole nodes, and by y within each slice.
+    """
+    n = len(bounds)
+    if n == 0:
+        return np.empty((0,), dtype=int)
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+    n_nodes = int(np.ceil(n / node_capacity))
+    slice_size = int(np.ceil(np.sqrt(n_nodes))) * node_capacity
+    order = np.argsort(centers[:, 0], kind='stable')
+    slices = np.arange(n) // slice_size
+    return order[np.lexsort((centers[order, 1], slices))]
+
+
+def _reduce_bounds(bounds, node_capacity):
+    starts = np.arange(0, len(bounds), node_capacity)
+    return np.column_stack((np.minimum.reduceat(bounds[:, 0], starts),
+                            np.minimum.reduceat(bounds[:, 1], starts),
+                            np.maximum.reduceat(bounds[:, 2], starts),
+                            np.maximum.reduceat(bounds[:, 3], starts)))
+
+
+def _overlaps(a, b):
+    return ((a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0])
+            & (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1]))
+
+
+def _edge_crosses_box(edges, boxes):
+    """
+    Whether edges[i] intersects boxes[i], given that their bounding boxes
+    overlap: the corners of the box are not all on one side of the edge.
+    """
+    a = edges[:, 0:2]
+    ab = edges[:, 2:4] - a
+    sides = np.column_stack([
+                ab[:, 0] * (boxes[:, y] - a[:, 1])
+                - ab[:, 1] * (boxes[:, x] - a[:, 0])
+                for x, y in ((0, 1), (2, 1), (2, 3), (0, 3))])
+    return ~(np.all(sides > 0, axis=1) | np.all(sides < 0, axis=1))
+
+
+class WidthIndex:
+    """
+    Query index over sidewalk segments and their widths. Use `from_gdf`,
+    `from_file` or `load` to create one.
+
+    Parameters
+    ----------
+    edges : array of shape (n_edges, 4)
+        Straight edges <x0, y0, x1, y1> of all segments, in tree order.
+    edge_bounds : array of shape (n_edges, 4)
+        Bounds of the edges.
+    edge_segment : array of shape (n_edges,)
+        The segment (row number) of each edge.
+    node_bounds : array of shape (n_nodes, 4)
+        Bounds of the tree nodes, level by level starting at the leaves.
+    level_offsets : array of shape (n_levels + 1,)
+        The nodes of level `i` are `node_bounds[level_offsets[i]:
+        level_offsets[i+1]]`.
+    segment_length : array of shape (n_segments,)
+    columns : dict
+        Attribute arrays of shape (n_segments,), e.g. 'min_width'.
+    node_capacity : int
+        Number of children per node.
+    crs : str (optional)
+    """
+
+    def __init__(self, edges, edge_bounds, edge_segment, node_bounds,
+                 level_offsets, segment_length, columns, node_capacity,
+                 crs=None):
+        self.edges = edges
+        self.edge_bounds = edge_bounds
+        self.edge_segment = edge_segment
+        self.node_bounds = node_bounds
+        self.level_offsets = level_offsets
+        self.segment_length = segment_length
+        self.columns = columns
+        self.node_capacity = node_capacity
+        self.crs = crs
+        for name in WIDTH_COLUMNS:
+            if name not in self.columns:
+                self.columns[name] = np.full((len(segment_length),), np.nan)
+        # Nodes and number of children per level, top level first.
+        n_levels = len(level_offsets) - 1
+        self._levels = [(node_bounds[level_offsets[level]:
+                                     level_offsets[level + 1]],
+                         len(edges) if level == 0
+                         else level_offsets[level] - level_offsets[level - 1])
+                        for level in range(n_levels - 1, -1, -1)]
+
+    @classmethod
+    def from_gdf(cls, gdf, columns=WIDTH_COLUMNS, node_capacity=16):
+        """
+        Build the index for the (Multi)LineStrings of a GeoDataFrame. Missing
+        columns are set to NaN.
+        """
+        coords, offsets, line_offsets = line_arrays.from_lines(
+                                                        list(gdf.geometry))
+        starts, ends, part_ids = line_arrays.segments(coords, offsets)
+        part_segment = np.repeat(np.arange(len(gdf)),
+                                 np.diff(line_offsets))
+        edges = np.hstack((starts, ends))
+        edge_segment = part_segment[part_ids]
+        lengths = np.hypot(*(ends - starts).T)
+        segment_length = np.bincount(edge_segment, weights=lengths,
+                                     minlength=len(gdf))
+
+        cols = {}
+        for name in columns:
+            if name in gdf.columns:
+                cols[name] = gdf[name].to_numpy(dtype=float)
+            else:
+                logger.info(f'No column {name}, set to NaN.')
+
+        bounds = np.column_stack((np.minimum(starts, ends),
+                                  np.maximum(starts, ends)))
+        order = str_order(bounds, node_capacity)
+        edges, edge_segment, edge_bounds = (edges[order],
+                                            edge_segment[order],
+                                            bounds[order])
+        bounds = edge_bounds
+        levels = []
+        while len(bounds) > 0 and (len(levels) == 0 or len(bounds) > 1):
+            bounds = _reduce_bounds(bounds, node_capacity)
+            levels.append(bounds)
+        node_bounds = (np.vstack(levels) if len(levels) > 0
+                       else np.empty((0, 4)))
+        level_offsets = np.concatenate(
+                            ([0], np.cumsum([len(b) for b in levels])))
+        crs = gdf.crs.to_string() if gdf.crs is not None else None
+        return cls(edges, edge_bounds, edge_segment, node_bounds,
+                   level_offsets, segment_length, cols, node_capacity, crs)
+
+    @classmethod
+    def from_file(cls, path, layer=None, columns=WIDTH_COLUMNS,
+                  node_capacity=16):
+        """Build the index for a file, e.g. `sidewalk_segments.gpkg`."""
+        gdf = gpd.read_file(path, layer=layer)
+        return cls.from_gdf(gdf, columns, node_capacity)
+
+    def __len__(self):
+        return len(self.segment_length)
+
+    def save(self, folder):
+        """
+        Save the index as a folder of `.npy` files. The metadata is written
+        last, such that an incomplete index is never loaded.
+        """
+        os.makedirs(folder, exist_ok=True)
+        meta_file = os.path.join(folder, 'meta.json')
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        arrays = {name: getattr(self, name) for name in _ARRAYS}
+        arrays.update({f'col_{name}': values
+                       for name, values in self.columns.items()})
+        for name, values in arrays.items():
+            np.save(os.path.join(folder, f'{name}.npy'),
+                    np.ascontiguousarray(values))
+        meta = {'node_capacity': self.node_capacity, 'crs': self.crs,
+                'columns': list(self.columns.keys())}
+        tmp_file = os.path.join(folder, f'.meta.{os.getpid()}.json')
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, meta_file)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load an index saved with `save`. With `mmap`, the arrays are
+        memory-mapped instead of read.
+        """
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        # Plain ndarray views on the memory maps, which are faster to index.
+        arrays = {name: np.asarray(np.load(
+                            os.path.join(folder, f'{name}.npy'),
+                            mmap_mode=mmap_mode))
+                  for name in _ARRAYS}
+        columns = {name: np.asarray(np.load(
+                            os.path.join(folder, f'col_{name}.npy'),
+                            mmap_mode=mmap_mode))
+                   for name in meta['columns']}
+        return cls(columns=columns, node_capacity=meta['node_capacity'],
+                   crs=meta['crs'], **arrays)
+
+    def query_edges(self, boxes):
+        """
+        Find the edges whose bounding box overlaps each query box.
+
+        Parameters
+        ----------
+        boxes : array of shape (n_queries, 4)
+            Query boxes <x_min, y_min, x_max, y_max>.
+
+        Returns
+        -------
+        Two arrays (query_ids, edge_ids) with the matching pairs.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        if len(self._levels) == 0 or len(boxes) == 0:
+            return np.empty((0,), dtype=int), np.empty((0,), dtype=int)
+        cap = self.node_capacity
+        n_top = len(self._levels[0][0])
+        q = np.repeat(np.arange(len(boxes)), n_top)
+        nodes = np.tile(np.arange(n_top), len(boxes))
+        for level_bounds, n_children in self._levels:
+            keep = _overlaps(level_bounds[nodes], boxes[q])
+            q, nodes = q[keep], nodes[keep]
+            # Children in the level below, or the edges for the leaves.
+            q = np.repeat(q, cap)
+            nodes = (nodes[:, None] * cap + np.arange(cap)).ravel()
+            valid = nodes < n_children
+            q, nodes = q[valid], nodes[valid]
+        keep = _overlaps(self.edge_bounds[nodes], boxes[q])
+        return q[keep], nodes[keep]
+
+    def _nearest(self, points, max_distance):
+        """Nearest edge within `max_distance` of each point, or -1."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        q, e = self.query_edges(np.hstack((points - max_distance,
+                                           points + max_distance)))
+        dist = width_utils._point_segment_dist(points[q], self.edges[e])
+        within = dist <= max_distance
+        q, e, dist = q[within], e[within], dist[within]
+        order = np.lexsort((dist, q))
+        q, e, dist = q[order], e[order], dist[order]
+        first = np.ones((len(q),), dtype=bool)
+        first[1:] = q[1:] != q[:-1]
+        nearest = np.full((len(points),), -1)
+        distance = np.full((len(points),), np.nan)
+        nearest[q[first]] = e[first]
+        distance[q[first]] = dist[first]
+        return nearest, distance
+
+    def _aggregate(self, q, segments, weights, n_queries):
+        """Aggregate the widths of (query, segment) pairs per query."""
+        min_width = self.columns['min_width'][segments]
+        avg_width = self.columns['avg_width'][segments]
+        route_weight = self.columns['route_weight'][segments]
+        known = ~np.isnan(min_width)
+
+        bottleneck = np.full((n_queries,), np.inf)
+        np.minimum.at(bottleneck, q[known], min_width[known])
+        bottleneck[np.isinf(bottleneck)] = np.nan
+        max_weight = np.full((n_queries,), -np.inf)
+        has_weight = ~np.isnan(route_weight)
+        np.maximum.at(max_weight, q[has_weight], route_weight[has_weight])
+        max_weight[np.isinf(max_weight)] = np.nan
+
+        has_avg = ~np.isnan(avg_width)
+        avg_sum = np.bincount(q[has_avg], weights=(avg_width * weights)[
+                                has_avg], minlength=n_queries)
+        avg_weight = np.bincount(q[has_avg], weights=weights[has_avg],
+                                 minlength=n_queries)
+        total = np.bincount(q, weights=weights, minlength=n_queries)
+        covered = np.bincount(q[known], weights=weights[known],
+                              minlength=n_queries)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = avg_sum / avg_weight
+            coverage = np.where(total > 0, covered / total, 0.)
+        return bottleneck, avg, coverage, max_weight
+
+    def _unique_pairs(self, q, segments):
+        keys = np.unique(q * len(self) + segments)
+        return keys // len(self), keys % len(self)
+
+    def _ids(self, q, segments, n_queries, unique=False):
+        if not unique:
+            q, segments = self._unique_pairs(q, segments)
+        splits = np.searchsorted(q, np.arange(1, n_queries))
+        return np.split(segments, splits)
+
+    def query_bboxes(self, boxes):
+        """
+        Batched bbox query: the segments that intersect each box. The
+        coverage is the fraction of the length of these segments that has a
+        known width.
+
+        Parameters
+        ----------
+        boxes : array of shape (n_queries, 4)
+
+        Returns
+        -------
+        A WidthQueryResult with arrays.
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        q, e = self.query_edges(boxes)
+        hit = _edge_crosses_box(self.edges[e], boxes[q])
+        q, segments = self._unique_pairs(q[hit], self.edge_segment[e[hit]])
+        bottleneck, avg, coverage, weight = self._aggregate(
+                    q, segments, self.segment_length[segments], len(boxes))
+        return WidthQueryResult(bottleneck, avg, coverage, weight,
+                                self._ids(q, segments, len(boxes),
+                                          unique=True))
+
+    def query_points(self, points, max_distance=1.):
+        """
+        Batched point query: the nearest segment within `max_distance` of
+        each point. The coverage is 1 when it has a known width, else 0.
+
+        Parameters
+        ----------
+        points : array of shape (n_queries, 2)
+        max_distance : float (default: 1)
+
+        Returns
+        -------
+        A WidthQueryResult with arrays.
+        """
+        nearest, _ = self._nearest(points, max_distance)
+        q = np.flatnonzero(nearest >= 0)
+        segments = self.edge_segment[nearest[q]]
+        bottleneck, avg, coverage, weight = self._aggregate(
+                    q, segments, np.ones((len(q),)), len(nearest))
+        return WidthQueryResult(bottleneck, avg, coverage, weight,
+                                self._ids(q, segments, len(nearest)))
+
+    def query_routes(self, routes, max_distance=1., resolution=1.):
+        """
+        Batched route query. Each route is sampled every `resolution` meters
+        and each sample point is matched to the nearest segment within
+        `max_distance`. The bottleneck is the smallest width along the route
+        and the coverage is the fraction of sample points matched to a
+        segment with a known width.
+
+        Parameters
+        ----------
+        routes : sequence of (Multi)LineStrings
+        max_distance : float (default: 1)
+        resolution : float (default: 1)
+
+        Returns
+        -------
+        A WidthQueryResult with arrays.
+        """
+        coords, offsets, route_offsets = line_arrays.from_lines(routes)
+        points, point_offsets = line_arrays.sample_points(coords, offsets,
+                                                          resolution)
+        route_points = point_offsets[route_offsets]
+        n_routes = len(route_offsets) - 1
+        point_route = np.repeat(np.arange(n_routes), np.diff(route_points))
+
+        nearest, _ = self._nearest(points, max_distance)
+        matched = nearest >= 0
+        q = point_route[matched]
+        segments = self.edge_segment[nearest[matched]]
+        bottleneck, avg, _, weight = self._aggregate(
+                    q, segments, np.ones((len(q),)), n_routes)
+        known = ~np.isnan(self.columns['min_width'][segments])
+        n_points = np.diff(route_points)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coverage = np.where(
+                n_points > 0,
+                np.bincount(q[known], minlength=n_routes) / n_points, 0.)
+        return WidthQueryResult(bottleneck, avg, coverage, weight,
+                                self._ids(q, segments, n_routes))
+
+    def query_bbox(self, bbox):
+        """Query a single box <x_min, y_min, x_max, y_max>."""
+        return _first(self.query_bboxes([bbox]))
+
+    def query_point(self, x, y, max_distance=1.):
+        """Query a single point."""
+        return _first(self.query_points([[x, y]], max_distance))
+
+    def query_route(self, route, max_distance=1., resolution=1.):
+        """Query a single route (Multi)LineString."""
+        return _first(self.query_routes([route], max_distance, resolution))
+
+
+def _first(result):
+    return WidthQueryResult(*(values[0] for values in result))
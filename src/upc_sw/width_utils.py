@@ -0,0 +1,322 @@
+"""
+Batched, vectorized sidewalk width computation.
+
+The widths are computed as twice the distance from sample points on a
+centerline to the boundary of the sidewalk polygon, identical to
+`poly_utils.get_avg_width` and `poly_utils.get_avg_width_cl`. Instead of a
+`nearest_points` call per sample point, all distances for a polygon are
+computed at once using a KD-tree over (subdivided) boundary edges.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import upc_sw.line_arrays as line_arrays
+
+
+def line_parts(line):
+    """Return the LineString parts of a (Multi)LineString."""
+    if line.type == 'MultiLineString':
+        return list(line.geoms)
+    if line.type == 'LineString':
+        return [line]
+    return []
+
+
+def boundary_edges(poly):
+    """
+    Get the boundary edges of a (Multi)Polygon, including its interiors.
+
+    Returns
+    -------
+    An array of shape (n_edges, 4) with rows <x0, y0, x1, y1>.
+    """
+    if poly.type == 'MultiPolygon':
+        polys = list(poly.geoms)
+    else:
+        polys = [poly]
+    edges = []
+    for p in polys:
+        for ring in [p.exterior] + list(p.interiors):
+            coords = np.asarray(ring.coords)[:, :2]
+            if len(coords) > 1:
+                edges.append(np.hstack((coords[:-1], coords[1:])))
+    if len(edges) == 0:
+        return np.empty((0, 4))
+    return np.vstack(edges)
+
+
+def sample_line(coords, resolution=1):
+    """
+    Sample points along a line given as an array of coordinates, using the
+    same scheme as `poly_utils.interpolate_by_distance`: points every
+    `resolution` meters starting at the first vertex (the last one clamped to
+    the end of the line), or the midpoint for very short lines.
+    """
+    coords = np.asarray(coords, dtype=float)[:, :2]
+    return line_arrays.sample_points(coords, np.array([0, len(coords)]),
+                                     resolution)[0]
+
+
+def _point_segment_dist(points, seg):
+    """Euclidean distance between points[i] and seg[i]."""
+    a = seg[:, 0:2]
+    ab = seg[:, 2:4] - a
+    ap = points - a
+    ab_sq = np.einsum('ij,ij->i', ab, ab)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(ab_sq > 0, np.einsum('ij,ij->i', ap, ab) / ab_sq, 0.)
+    t = np.clip(t, 0., 1.)
+    d = ap - t[:, None] * ab
+    return np.hypot(d[:, 0], d[:, 1])
+
+
+class BoundaryIndex:
+    """
+    Spatial index over the boundary edges of a polygon, used to compute the
+    exact distance from many points to the boundary at once.
+
+    Long edges are subdivided into pieces of at most `max_edge_length` so that
+    a KD-tree over the edge midpoints can be used to find all candidate edges
+    for a point. This does not change the computed distances.
+
+    Parameters
+    ----------
+    poly : Polygon or MultiPolygon
+        The sidewalk polygon.
+    max_edge_length : float (default: 1.)
+        Maximum length of the (subdivided) edges in the index.
+    k : int (default: 8)
+        Number of nearest edges used to compute an initial distance bound.
+    """
+
+    def __init__(self, poly, max_edge_length=1., k=8):
+        edges = boundary_edges(poly)
+        lengths = np.hypot(edges[:, 2] - edges[:, 0],
+                           edges[:, 3] - edges[:, 1])
+        n_parts = np.maximum(np.ceil(lengths / max_edge_length), 1
+                             ).astype(int)
+        edge_ids = np.repeat(np.arange(len(edges)), n_parts)
+        part_nr = np.arange(len(edge_ids)) - np.repeat(
+                                    np.cumsum(n_parts) - n_parts, n_parts)
+        t0 = (part_nr / n_parts[edge_ids])[:, None]
+        t1 = ((part_nr + 1) / n_parts[edge_ids])[:, None]
+        start = edges[edge_ids, 0:2]
+        vec = edges[edge_ids, 2:4] - start
+        self.edges = np.hstack((start + t0 * vec, start + t1 * vec))
+        # Keep the original vertices exact.
+        self.edges[t0[:, 0] == 0, 0:2] = edges[edge_ids[t0[:, 0] == 0], 0:2]
+        self.edges[t1[:, 0] == 1, 2:4] = edges[edge_ids[t1[:, 0] == 1], 2:4]
+        self.half_length = (np.max(lengths / n_parts) / 2
+                            if len(edges) > 0 else 0.)
+        self.k = min(k, len(self.edges))
+        self.tree = (cKDTree((self.edges[:, 0:2] + self.edges[:, 2:4]) / 2)
+                     if len(self.edges) > 0 else None)
+
+    def distance(self, points):
+        """
+        Compute the distance from each point to the polygon boundary.
+
+        Parameters
+        ----------
+        points : array of shape (n_points, 2)
+
+        Returns
+        -------
+        An array of shape (n_points,) with distances.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.tree is None:
+            return np.full((len(points),), np.inf)
+        if len(points) == 0:
+            return np.empty((0,))
+
+        # Initial upper bound using the k nearest edge midpoints.
+        _, nn = self.tree.query(points, k=self.k)
+        nn = nn.reshape(len(points), -1)
+        bound = _point_segment_dist(
+                    np.repeat(points, nn.shape[1], axis=0),
+                    self.edges[nn.ravel()]).reshape(nn.shape).min(axis=1)
+
+        # Any edge closer than the bound has its midpoint within
+        # bound + half_length of the point.
+        candidates = self.tree.query_ball_point(
+                                    points, bound + self.half_length + 1e-9)
+        counts = np.fromiter((len(c) for c in candidates), dtype=int,
+                             count=len(points))
+        if counts.sum() == 0:
+            return bound
+        cand_ids = np.fromiter((i for c in candidates for i in c), dtype=int,
+                               count=counts.sum())
+        point_ids = np.repeat(np.arange(len(points)), counts)
+        dist = _point_segment_dist(points[point_ids], self.edges[cand_ids])
+        result = bound.copy()
+        np.minimum.at(result, point_ids, dist)
+        return result
+
+
+def sample_widths(index, points, offsets, precision=2):
+    """
+    Compute the average and minimum width for groups of sample points.
+
+    Parameters
+    ----------
+    index : BoundaryIndex
+        The index of the polygon boundary.
+    points : array of shape (n_points, 2)
+        The sample points.
+    offsets : array of shape (n_groups + 1,)
+        The points of group `i` are `points[offsets[i]:offsets[i+1]]`.
+    precision : int (default: 2)
+        Number of decimals to round the results to.
+
+    Returns
+    -------
+    Two arrays of shape (n_groups,) with the average and minimum widths.
+    """
+    counts = np.diff(offsets)
+    avg_width = np.full((len(counts),), np.nan)
+    min_width = np.full((len(counts),), np.nan)
+    valid = counts > 0
+    if not valid.any():
+        return avg_width, min_width
+    distances = index.distance(points)
+    starts = offsets[:-1][valid]
+    avg_width[valid] = (np.add.reduceat(distances, starts)
+                        / counts[valid] * 2)
+    min_width[valid] = np.minimum.reduceat(distances, starts) * 2
+
+    return np.round(avg_width, precision), np.round(min_width, precision)
+
+
+def segment_widths(poly, segment_coords, resolution=1, precision=2,
+                   index=None):
+    """
+    Compute the average and minimum width for a number of segments in a
+    polygon.
+
+    Parameters
+    ----------
+    poly : Polygon or MultiPolygon
+        The sidewalk polygon.
+    segment_coords : list of lists of arrays
+        For each segment, a list with the coordinate arrays of its parts.
+    resolution : float (default: 1)
+        Distance between sample points along the segments.
+    precision : int (default: 2)
+        Number of decimals to round the results to.
+    index : BoundaryIndex (optional)
+        A pre-built index for the polygon boundary.
+
+    Returns
+    -------
+    Two arrays of shape (n_segments,) with the average and minimum widths.
+    """
+    if len(segment_coords) == 0:
+        return np.array([]), np.array([])
+    if index is None:
+        index = BoundaryIndex(poly, max_edge_length=max(resolution, 0.5))
+
+    coords, offsets = line_arrays.from_coords(
+                        [c for parts in segment_coords for c in parts])
+    points, point_offsets = line_arrays.sample_points(coords, offsets,
+                                                      resolution)
+    part_offsets = np.concatenate(
+                    ([0], np.cumsum([len(parts) for parts in segment_coords])))
+    return sample_widths(index, points, point_offsets[part_offsets],
+                         precision)
+
+
+def straight_segment_widths(poly, starts, ends, resolution=1, precision=2,
+                            index=None):
+    """
+    Compute the average and minimum width for straight segments in a polygon,
+    given as arrays of start and end points (see `line_arrays`).
+
+    Returns
+    -------
+    Two arrays of shape (n_segments,) with the average and minimum widths.
+    """
+    if len(starts) == 0:
+        return np.array([]), np.array([])
+    if index is None:
+        index = BoundaryIndex(poly, max_edge_length=max(resolution, 0.5))
+    points, point_offsets = line_arrays.sample_points(
+                        *line_arrays.segment_coords(starts, ends), resolution)
+    return sample_widths(index, points, point_offsets, precision)
+
+
+def get_avg_width_batch(polys, segments, resolution=1, precision=2):
+    """
+    Batched version of `poly_utils.get_avg_width` for many polygons.
+
+    Parameters
+    ----------
+    polys : sequence of Polygons
+        The sidewalk polygons.
+    segments : sequence of lists of LineStrings
+        For each polygon, the segments for which to compute the width.
+
+    Returns
+    -------
+    A list with for each polygon a tuple (avg_width, min_width).
+    """
+    results = []
+    for poly, poly_segments in zip(polys, segments):
+        segment_coords = [[np.asarray(part.coords)
+                           for part in line_parts(segment)]
+                          for segment in poly_segments]
+        results.append(segment_widths(poly, segment_coords,
+                                      resolution, precision))
+    return results
+
+
+def get_avg_width_cl_batch(polys, lines, resolution=1, precision=2):
+    """
+    Batched version of `poly_utils.get_avg_width_cl`. The lines are grouped
+    by polygon, such that each polygon boundary is indexed only once.
+
+    Parameters
+    ----------
+    polys : sequence or GeoSeries of Polygons
+        The sidewalk polygon for each line (polygons may be repeated).
+    lines : sequence or GeoSeries of (Multi)LineStrings
+        The centerlines for which to compute the width.
+
+    Returns
+    -------
+    A DataFrame with columns 'avg_width' and 'min_width', aligned with the
+    input.
+    """
+    polys = list(polys)
+    lines = list(lines)
+    avg_width = np.full((len(lines),), np.nan)
+    min_width = np.full((len(lines),), np.nan)
+
+    groups = {}
+    for i, poly in enumerate(polys):
+        groups.setdefault(poly.wkb, []).append(i)
+
+    for line_ids in groups.values():
+        poly = polys[line_ids[0]]
+        segment_coords = [[np.asarray(part.coords)
+                           for part in line_parts(lines[i])]
+                          for i in line_ids]
+        avg_width[line_ids], min_width[line_ids] = segment_widths(
+                                poly, segment_coords, resolution, precision)
+
+    return pd.DataFrame({'avg_width': avg_width, 'min_width': min_width})
+
+
+def get_avg_width_cl_gdf(gdf, poly_col='geometry', line_col='centerlines',
+                         resolution=1, precision=2):
+    """
+    Compute 'avg_width' and 'min_width' for each row of a GeoDataFrame in
+    one call, replacing a row-wise `progress_apply` of
+    `poly_utils.get_avg_width_cl`.
+    """
+    widths = get_avg_width_cl_batch(gdf[poly_col], gdf[line_col],
+                                    resolution, precision)
+    widths.index = gdf.index
+    return widths
@@ -0,0 +1,14 @@
+"""
+Tests for the upc_sw package.
+
+Run from the repository root:
+    python -m unittest
+"""
+
+import os
+import sys
+
+# Make the upc_sw package importable without installing it.
+_src = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+if _src not in sys.path:
+    sys.path.append(_src)
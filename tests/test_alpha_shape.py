@@ -0,0 +1,65 @@
+"""Tests for `upc_sw.alpha_shape`: both engines must give the same shape."""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+from shapely.ops import unary_union
+
+from upc_sw.alpha_shape import (alpha_shape, alpha_shape_fast,
+                                _alpha_triangles)
+
+
+def grid_points(poly, spacing=0.25, seed=0):
+    """Jittered grid points inside a polygon."""
+    rng = np.random.default_rng(seed)
+    x_min, y_min, x_max, y_max = poly.bounds
+    xy = np.mgrid[x_min:x_max:spacing, y_min:y_max:spacing].reshape(2, -1).T
+    xy = xy + rng.uniform(-0.05, 0.05, xy.shape)
+    return np.array([p for p in xy if poly.contains(sg.Point(p))])
+
+
+SHAPES = {
+    'annulus': sg.Point(0, 0).buffer(5).difference(sg.Point(0, 0).buffer(2)),
+    'two_parts': sg.box(0, 0, 3, 3).union(sg.box(6, 0, 9, 4)),
+    'l_shape': sg.box(0, 0, 8, 2).union(sg.box(0, 0, 2, 6)),
+    # Two squares that only touch at a corner.
+    'bow_tie': sg.box(0, 0, 3, 3).union(sg.box(3, 3, 6, 6)),
+}
+
+
+class AlphaShapeTest(unittest.TestCase):
+
+    def assert_same_shape(self, geom, reference):
+        self.assertAlmostEqual(geom.area, reference.area, places=9)
+        self.assertLess(geom.symmetric_difference(reference).area, 1e-9)
+
+    def test_fast_equals_polygonize(self):
+        for name, poly in SHAPES.items():
+            points = grid_points(poly)
+            for alpha in (0.3, 0.5, 2.):
+                with self.subTest(shape=name, alpha=alpha):
+                    fast, _ = alpha_shape_fast(points, alpha)
+                    reference, _ = alpha_shape(points, alpha)
+                    self.assert_same_shape(fast, reference)
+
+    def test_keep_holes(self):
+        points = grid_points(SHAPES['annulus'])
+        fast, _ = alpha_shape_fast(points, 0.5, keep_holes=True)
+        triangles = unary_union([sg.Polygon(t) for t in
+                                 points[_alpha_triangles(points, 0.5)]])
+        self.assert_same_shape(fast, triangles)
+        self.assertGreater(len(fast.interiors), 0)
+
+    def test_few_points(self):
+        points = np.array([[0., 0.], [1., 0.], [0., 1.]])
+        fast, _ = alpha_shape_fast(points, 0.5)
+        reference, _ = alpha_shape(points, 0.5)
+        self.assertTrue(fast.equals(reference))
+
+    def test_no_triangles(self):
+        points = grid_points(SHAPES['l_shape'], spacing=2.)
+        # All circumradii exceed 1 / alpha.
+        fast, _ = alpha_shape_fast(points, 10.)
+        reference, _ = alpha_shape(points, 10.)
+        self.assertTrue(fast.is_empty and reference.is_empty)
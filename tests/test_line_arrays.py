@@ -0,0 +1,86 @@
+"""
+Tests for `upc_sw.line_arrays`: the array operations must equal the Shapely
+operations they replace.
+"""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+import shapely.ops as so
+
+from upc_sw import line_arrays, poly_utils
+
+
+def random_lines(n_lines=20, seed=0):
+    """A MultiLineString with parts of 2 to 6 random vertices."""
+    rng = np.random.default_rng(seed)
+    parts = []
+    for _ in range(n_lines):
+        steps = rng.uniform(-6, 6, (rng.integers(2, 7), 2))
+        parts.append(np.cumsum(steps, axis=0) + rng.uniform(0, 100, 2))
+    return sg.MultiLineString([p.tolist() for p in parts])
+
+
+def coords_of(geoms):
+    return np.array([np.asarray(g.coords) for g in geoms])
+
+
+class LineArraysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = [random_lines(seed=s) for s in range(3)]
+
+    def test_segments(self):
+        for line in self.lines:
+            reference = [sg.LineString([ls.coords[i], ls.coords[i + 1]])
+                         for ls in line.geoms
+                         for i in range(len(ls.coords) - 1)]
+            starts, ends, _ = line_arrays.segments(
+                                    *line_arrays.from_lines(line)[:2])
+            np.testing.assert_array_equal(
+                np.stack((starts, ends), axis=1), coords_of(reference))
+
+    def test_cut_segments(self):
+        for line in self.lines:
+            for max_length in (0.7, 2., 5.):
+                reference = []
+                for seg in poly_utils.get_segments(line):
+                    points = sg.MultiPoint(
+                        [seg.interpolate(d)
+                         for d in np.arange(0, seg.length, max_length)])
+                    reference.extend(so.split(so.snap(seg, points, 0.001),
+                                              points).geoms)
+                starts, ends, _ = line_arrays.segments(
+                                    *line_arrays.from_lines(line)[:2])
+                cut_starts, cut_ends, _ = line_arrays.cut_segments(
+                                            starts, ends, max_length)
+                # Cut points within the snap tolerance of a segment end are
+                # not snapped to it.
+                np.testing.assert_allclose(
+                    np.stack((cut_starts, cut_ends), axis=1),
+                    coords_of(reference), atol=0.001)
+
+    def test_sample_points(self):
+        for line in self.lines:
+            for resolution in (0.5, 1., 4.):
+                reference = []
+                for ls in line.geoms:
+                    count = round(ls.length / resolution) + 1
+                    if count == 1:
+                        reference.append(ls.interpolate(ls.length / 2))
+                    else:
+                        reference.extend(ls.interpolate(resolution * i)
+                                         for i in range(count))
+                points, _ = line_arrays.sample_points(
+                                *line_arrays.from_lines(line)[:2], resolution)
+                np.testing.assert_allclose(
+                    points, coords_of(reference)[:, 0], atol=1e-9)
+
+    def test_points_on_line(self):
+        for line in self.lines:
+            reference = [line.interpolate(d)
+                         for d in np.arange(0, line.length, 3.)]
+            points = poly_utils.get_points_on_line(line, 3.)
+            np.testing.assert_allclose(coords_of(points.geoms),
+                                       coords_of(reference), atol=1e-9)
@@ -0,0 +1,81 @@
+"""
+Tests for `upc_sw.occupancy_grid`: the traced outlines must equal the union
+of the cells of each component.
+"""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+from shapely.ops import unary_union
+
+from upc_sw import occupancy_grid
+
+ORIGIN = np.array([121000.25, 487000.5])
+GRID_SIZE = 0.1
+
+
+def cell_union(labels, label, origin=ORIGIN, grid_size=GRID_SIZE):
+    """The union of the cell boxes of a component."""
+    x0, y0 = origin
+    return unary_union([sg.box(x0 + i * grid_size, y0 + j * grid_size,
+                               x0 + (i + 1) * grid_size,
+                               y0 + (j + 1) * grid_size)
+                        for i, j in zip(*np.nonzero(labels == label))])
+
+
+def random_labels(shape=(40, 30), fill=0.45, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = (rng.random(shape) < fill).astype(int)
+    return occupancy_grid.label_grid(counts, min_component_size=1)
+
+
+class GridPolygonsTest(unittest.TestCase):
+
+    def assert_same_area(self, geom, reference):
+        self.assertAlmostEqual(geom.area, reference.area, places=9)
+        self.assertLess(geom.symmetric_difference(reference).area, 1e-9)
+
+    def test_equals_cell_union(self):
+        for seed in range(3):
+            labels, n_components = random_labels(seed=seed)
+            polygons = occupancy_grid.grid_polygons(labels, ORIGIN,
+                                                    GRID_SIZE)
+            self.assertEqual(len(polygons), n_components)
+            for label, parts in enumerate(polygons, start=1):
+                self.assertTrue(all(part.is_valid for part in parts))
+                self.assert_same_area(sg.MultiPolygon(parts),
+                                      cell_union(labels, label))
+
+    def test_holes(self):
+        labels = np.zeros((7, 7), dtype=int)
+        labels[1:6, 1:6] = 1
+        # Two holes that touch at a vertex (a pinch point).
+        labels[2, 2] = labels[3, 3] = 0
+        (parts,) = occupancy_grid.grid_polygons(labels, ORIGIN, GRID_SIZE)
+        reference = cell_union(labels, 1)
+        self.assert_same_area(sg.MultiPolygon(parts), reference)
+        self.assertEqual(sum(len(p.interiors) for p in parts),
+                         len(reference.interiors))
+
+    def test_inset(self):
+        labels = np.zeros((12, 12), dtype=int)
+        labels[1:6, 1:6] = 1
+        # A component of one cell wide, which the inset would remove.
+        labels[8, 1:11] = 2
+        block, line = occupancy_grid.grid_polygons(labels, ORIGIN, GRID_SIZE,
+                                                   inset=GRID_SIZE / 2)
+        self.assert_same_area(block[0],
+                              cell_union(labels, 1).buffer(-GRID_SIZE / 2,
+                                                           join_style=2))
+        self.assert_same_area(line[0], cell_union(labels, 2))
+
+    def test_rasterize(self):
+        rng = np.random.default_rng(0)
+        points = ORIGIN + rng.uniform(0, 3, (500, 2))
+        counts, origin = occupancy_grid.rasterize(points, GRID_SIZE, pad=1)
+        self.assertEqual(counts.sum(), len(points))
+        self.assertTrue((counts[0] == 0).all() and (counts[:, -1] == 0).all())
+        # The grid is aligned to multiples of the grid size.
+        np.testing.assert_allclose(origin / GRID_SIZE,
+                                   np.round(origin / GRID_SIZE))
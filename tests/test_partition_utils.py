@@ -0,0 +1,80 @@
+"""
+Tests for `upc_sw.partition_utils`: the partitioned union must have the same
+parts as `unary_union`.
+"""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+from shapely.ops import unary_union
+
+from upc_sw import partition_utils
+
+
+def random_boxes(n, extent, seed, origin=(0., 0.)):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, extent, (n, 2)) + origin
+    size = rng.uniform(1, 15, (n, 2))
+    return [sg.box(x, y, x + w, y + h) for (x, y), (w, h) in zip(xy, size)]
+
+
+def polygon_parts(geom):
+    return list(geom.geoms) if geom.type == 'MultiPolygon' else [geom]
+
+
+class PartitionedUnionTest(unittest.TestCase):
+
+    def setUp(self):
+        size = partition_utils.tile_size()
+        # A street crossing many cells, a ring around a hole on the corner
+        # of four cells, polygons that only touch at a cell edge and
+        # polygons around the origin (negative cell indices).
+        street = [sg.box(i * 10, 3, i * 10 + 12, 8) for i in range(40)]
+        ring = sg.box(size - 20, size - 20, size + 20, size + 20).difference(
+                    sg.box(size - 5, size - 5, size + 5, size + 5))
+        ring_parts = [ring.intersection(sg.box(x, y, x + 30, y + 30))
+                      for x in (size - 25, size + 5)
+                      for y in (size - 25, size + 5)]
+        touching = [sg.box(2 * size - 10, 20, 2 * size, 30),
+                    sg.box(2 * size, 20, 2 * size + 10, 30)]
+        self.geoms = (street + ring_parts + touching
+                      + random_boxes(150, 4 * size, seed=0)
+                      + random_boxes(40, 60, seed=1, origin=(-30., -30.))
+                      + [None, sg.Polygon()])
+
+    def assert_same_parts(self, parts, reference):
+        reference = polygon_parts(reference)
+        self.assertEqual(len(parts), len(reference))
+        for ref in reference:
+            matches = [part for part in parts
+                       if part.symmetric_difference(ref).area < 1e-6]
+            self.assertEqual(len(matches), 1)
+            self.assertEqual(len(matches[0].interiors), len(ref.interiors))
+
+    def test_equals_unary_union(self):
+        reference = unary_union([g for g in self.geoms if g is not None])
+        for cell_tiles in (1, 2):
+            for n_workers in (1, 2):
+                with self.subTest(cell_tiles=cell_tiles, n_workers=n_workers):
+                    self.assert_same_parts(
+                        partition_utils.partitioned_union(
+                            self.geoms, cell_tiles=cell_tiles,
+                            n_workers=n_workers),
+                        reference)
+
+    def test_empty(self):
+        self.assertEqual(partition_utils.partitioned_union([]), [])
+        self.assertEqual(partition_utils.partitioned_union([None]), [])
+
+    def test_apply_partitioned_order(self):
+        geoms = [g for g in self.geoms if g is not None and not g.is_empty]
+        for n_workers in (1, 2):
+            self.assertEqual(
+                partition_utils.apply_partitioned(geoms, _area, cell_tiles=1,
+                                                  n_workers=n_workers),
+                [g.area for g in geoms])
+
+
+def _area(geom):
+    return geom.area
@@ -0,0 +1,84 @@
+"""Tests for `upc_sw.poly_utils`."""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+
+from upc_sw import poly_utils
+
+
+def reference_remove_short_lines(line, min_se_length=5):
+    """The original `remove_short_lines`, with a disjoint test per part."""
+    passing_lines = []
+    for i, linestring in enumerate(line.geoms):
+        other_lines = sg.MultiLineString(
+                        [x for j, x in enumerate(line.geoms) if j != i])
+        p0 = sg.Point(linestring.coords[0])
+        p1 = sg.Point(linestring.coords[-1])
+        is_deadend = p0.disjoint(other_lines) or p1.disjoint(other_lines)
+        if not is_deadend or linestring.length > min_se_length:
+            passing_lines.append(linestring)
+    return sg.MultiLineString(passing_lines)
+
+
+NETWORK = sg.MultiLineString([
+    # Main street, and a long dead-end that is kept.
+    [(0, 0), (20, 0)], [(20, 0), (40, 0)], [(40, 0), (40, 30)],
+    # Short spur ending in the interior of the main street.
+    [(10, 3), (10, 0)],
+    # Short spur ending at a vertex that is not an endpoint.
+    [(30, 0), (30, 2), (31, 3)],
+    # Short part connecting two parts, not a dead-end.
+    [(0, 0), (0, 4)], [(0, 4), (0, 20)], [(0, 20), (3, 20)],
+    [(3, 20), (40, 30)],
+    # Isolated short part and short closed loop.
+    [(50, 50), (52, 50)], [(60, 60), (61, 60), (61, 61), (60, 60)],
+    # Chain of short dead-end parts.
+    [(40, 30), (42, 30)], [(42, 30), (44, 30)],
+    # Exactly min_se_length long.
+    [(20, 0), (20, -5)],
+])
+
+
+def random_network(n_lines=60, seed=0):
+    """Lines between random lattice points, such that many of them touch."""
+    rng = np.random.default_rng(seed)
+    lines = []
+    for _ in range(n_lines):
+        start = rng.integers(0, 12, 2)
+        end = start + rng.integers(-4, 5, 2)
+        if (start != end).any():
+            lines.append([tuple(start), tuple(end)])
+    return sg.MultiLineString(lines)
+
+
+class RemoveShortLinesTest(unittest.TestCase):
+
+    def assert_same_parts(self, result, reference):
+        self.assertEqual([part.wkb for part in result.geoms],
+                         [part.wkb for part in reference.geoms])
+
+    def test_equals_reference(self):
+        for line in [NETWORK] + [random_network(seed=s) for s in range(5)]:
+            for min_se_length in (0, 3, 5, 10):
+                with self.subTest(min_se_length=min_se_length):
+                    self.assert_same_parts(
+                        poly_utils.remove_short_lines(line, min_se_length),
+                        reference_remove_short_lines(line, min_se_length))
+
+    def test_iterate(self):
+        reference = NETWORK
+        while True:
+            pruned = reference_remove_short_lines(reference)
+            if len(pruned.geoms) == len(reference.geoms):
+                break
+            reference = pruned
+        self.assert_same_parts(
+            poly_utils.remove_short_lines(NETWORK, iterate=True), reference)
+        self.assertLess(len(reference.geoms),
+                        len(reference_remove_short_lines(NETWORK).geoms))
+
+    def test_linestring(self):
+        line = sg.LineString([(0, 0), (1, 0)])
+        self.assertTrue(poly_utils.remove_short_lines(line).equals(line))
@@ -0,0 +1,55 @@
+"""Tests for `upc_sw.result_cache`."""
+
+import shutil
+import tempfile
+import unittest
+
+import shapely.geometry as sg
+
+from upc_sw.result_cache import PolygonResultCache
+
+POLYS = [sg.box(0, 0, 1, 1), sg.box(2, 0, 4, 1)]
+
+
+def area_or_none(poly):
+    """None for the small polygon, like a failed centerline."""
+    return None if poly.area < 2 else poly.area
+
+
+def fail_small(poly):
+    if poly.area < 2:
+        raise ValueError('too small')
+    return poly.area
+
+
+class PolygonResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = PolygonResultCache(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_none_result_is_cached(self):
+        first = self.cache.apply(POLYS, area_or_none, progress=False)
+        self.assertEqual(first, [None, 2.])
+        self.assertEqual(self.cache.stats['misses'], 2)
+        second = self.cache.apply(POLYS, area_or_none, progress=False)
+        self.assertEqual(second, first)
+        # Cumulative over both calls.
+        self.assertEqual(self.cache.stats, {'hits': 2, 'misses': 2,
+                                            'evicted': 0})
+
+    def test_get_missing_key(self):
+        self.assertIsNone(self.cache.get('unknown'))
+        self.assertEqual(self.cache.get('unknown', 'missing'), 'missing')
+
+    def test_failures_not_cached(self):
+        results = self.cache.apply(POLYS, fail_small, progress=False,
+                                   default=-1.)
+        self.assertEqual(results, [-1., 2.])
+        self.assertEqual(len(self.cache.keys()), 1)
+        self.cache.reset_stats()
+        self.cache.apply(POLYS, fail_small, progress=False, default=-1.)
+        self.assertEqual(self.cache.stats['misses'], 1)
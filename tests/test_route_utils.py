@@ -0,0 +1,139 @@
+"""
+Tests for `upc_sw.route_utils`: the route weights must equal those of a
+shortest path search per line, as previously done with networkx.
+"""
+
+import heapq
+import unittest
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.geometry as sg
+
+from upc_sw import route_utils
+
+
+def shortest_path_length(edges, origin, dest):
+    """Dijkstra on a dict {node: [(neighbour, weight), ...]}."""
+    queue = [(0., origin)]
+    done = set()
+    while queue:
+        cost, node = heapq.heappop(queue)
+        if node == dest:
+            return cost
+        if node in done:
+            continue
+        done.add(node)
+        for other, weight in edges.get(node, []):
+            if other not in done:
+                heapq.heappush(queue, (cost + weight, other))
+    return None
+
+
+def reference_route_weights(sidewalks, segments, centerlines, max_dist=3):
+    """The route weight of each line, one shortest path search per line."""
+    weights = []
+    for _, row in centerlines.iterrows():
+        sidewalk = sidewalks.iloc[row['sidewalk_id']]
+        edges = {}
+        for _, segment in segments[segments.within(sidewalk)].iterrows():
+            a, b = segment.geometry.coords[0], segment.geometry.coords[-1]
+            w = segment['min_width_factor']
+            edges.setdefault(a, []).append((b, w))
+            edges.setdefault(b, []).append((a, w))
+        line = row['geometry']
+        if len(edges) == 0:
+            weights.append(np.nan)
+            continue
+        if line.is_closed:
+            weights.append(route_utils.RING_WEIGHT)
+            continue
+        nodes = np.array(list(edges))
+        snapped = []
+        for point in (line.coords[0], line.coords[-1]):
+            dist = np.hypot(*(nodes - point).T)
+            snapped.append((tuple(nodes[dist.argmin()]), dist.min()))
+        (origin, d0), (dest, d1) = snapped
+        cost = shortest_path_length(edges, origin, dest)
+        if cost is None:
+            weights.append(route_utils.NO_PATH_WEIGHT)
+        elif d0 < max_dist and d1 < max_dist:
+            weights.append(cost)
+        else:
+            weights.append(np.nan)
+    return np.array(weights)
+
+
+def grid_segments(x0, y0, n, seed):
+    """Segments of an n x n lattice with spacing 2 and random weights."""
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(n):
+        for j in range(n):
+            p = (x0 + 2 * i, y0 + 2 * j)
+            if i + 1 < n:
+                lines.append(sg.LineString([p, (p[0] + 2, p[1])]))
+            if j + 1 < n:
+                lines.append(sg.LineString([p, (p[0], p[1] + 2)]))
+    # A parallel segment with a different weight.
+    lines.append(lines[0])
+    return lines, rng.uniform(1, 100, len(lines)).round(1)
+
+
+class RouteWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sidewalks = gpd.GeoSeries([sg.box(-1, -1, 11, 11),
+                                        sg.box(20, -1, 31, 5),
+                                        sg.box(40, 0, 45, 5)])
+        lines, weights = grid_segments(0, 0, 5, seed=0)
+        # Two disconnected parts in the second sidewalk, and a segment that
+        # lies in no sidewalk.
+        lines += [sg.LineString([(21, 0), (24, 0)]),
+                  sg.LineString([(27, 0), (30, 0)]),
+                  sg.LineString([(15, 0), (16, 0)])]
+        weights = np.concatenate((weights, [5., 7., 1.]))
+        self.segments = gpd.GeoDataFrame({'min_width_factor': weights},
+                                         geometry=lines)
+        rng = np.random.default_rng(1)
+        lines = []
+        for _ in range(25):
+            a, b = rng.integers(0, 5, (2, 2)) * 2 + rng.uniform(-.2, .2, 2)
+            lines.append(sg.LineString([a, b]))
+        lines += [
+            # A ring.
+            sg.LineString([(1, 1), (3, 1), (3, 3), (1, 1)]),
+            # Endpoint too far from any node.
+            sg.LineString([(2, 2), (10.5, 10.5 + 3)]),
+            # No path between the parts.
+            sg.LineString([(21.1, 0.1), (29.9, 0.1)]),
+            sg.LineString([(21.1, 0.1), (23.8, 0.2)]),
+            # A sidewalk without segments.
+            sg.LineString([(41, 1), (44, 4)])]
+        sidewalk_ids = [0] * 27 + [1, 1, 2]
+        self.centerlines = gpd.GeoDataFrame({'sidewalk_id': sidewalk_ids},
+                                            geometry=lines,
+                                            index=np.arange(30) * 10)
+
+    def test_equals_reference(self):
+        reference = reference_route_weights(self.sidewalks, self.segments,
+                                            self.centerlines)
+        for n_workers in (1, 2):
+            weights = route_utils.get_route_weights(
+                            self.sidewalks, self.segments, self.centerlines,
+                            n_workers=n_workers)
+            self.assertTrue(weights.index.equals(self.centerlines.index))
+            np.testing.assert_allclose(weights.to_numpy(), reference)
+        self.assertEqual(reference[25], route_utils.RING_WEIGHT)
+        self.assertTrue(np.isnan(reference[26]))
+        self.assertEqual(reference[27], route_utils.NO_PATH_WEIGHT)
+        self.assertTrue(np.isnan(reference[29]))
+
+    def test_line_endpoints(self):
+        lines = pd.Series([sg.LineString([(0, 0), (1, 1)]),
+                           sg.LineString([(0, 0), (1, 0), (0, 0)]),
+                           sg.LineString()])
+        endpoints = route_utils.line_endpoints(lines.values)
+        np.testing.assert_array_equal(endpoints[0], [[0, 0], [1, 1]])
+        self.assertTrue(np.isnan(endpoints[1:]).all())
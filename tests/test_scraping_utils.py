@@ -0,0 +1,172 @@
+"""
+Tests for `upc_sw.scraping_utils`: the WFS client on a local stub, and the
+grouping of tiles into requests.
+"""
+
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.geometry as sg
+
+from upc_sw import poly_utils, scraping_utils
+
+BBOX = ((121000., 487050.), (121050., 487000.))
+
+TERRAS_JSON = {
+    'type': 'FeatureCollection',
+    'numberReturned': 1,
+    'features': [{
+        'type': 'Feature',
+        'properties': {'id': 'terras.1', 'zaaknummer': 42},
+        'geometry': {'type': 'Polygon',
+                     'coordinates': [[[121010., 487010.], [121020., 487010.],
+                                      [121020., 487020.], [121010., 487010.]]]}
+    }]
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Responds with the statuses in `server.statuses`, then with JSON."""
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status = (self.server.statuses.pop(0) if self.server.statuses
+                  else 200)
+        body = (json.dumps(TERRAS_JSON) if status == 200
+                else 'Service unavailable').encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WFSClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.statuses = []
+        self.server.paths = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/wfs?'
+        self.cache_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_folder)
+
+    def client(self, **kwargs):
+        return scraping_utils.WFSClient(terras_url=self.url,
+                                        bgt_url=self.url, backoff_factor=0,
+                                        **kwargs)
+
+    def test_retries_server_errors(self):
+        self.server.statuses = [503, 502]
+        gdf = scraping_utils.get_terras_data_for_bbox(
+                                        BBOX, client=self.client(retries=3))
+        self.assertEqual(len(self.server.paths), 3)
+        self.assertEqual(list(gdf.index), ['terras.1'])
+        self.assertEqual(list(gdf['naam']), ['terras'])
+
+    def test_retries_exhausted(self):
+        self.server.statuses = [503, 503, 503]
+        client = self.client(retries=2, cache_folder=self.cache_folder)
+        url = scraping_utils.terras_request_url(BBOX, self.url)
+        self.assertIsNone(client.get_json(url, 'terras', BBOX))
+        self.assertEqual(len(self.server.paths), 3)
+        # Failed responses are not cached.
+        self.assertEqual(client.get_json(url, 'terras', BBOX), TERRAS_JSON)
+
+    def test_response_cache(self):
+        client = self.client(cache_folder=self.cache_folder)
+        url = scraping_utils.terras_request_url(BBOX, self.url)
+        first = client.get_json(url, 'terras', BBOX)
+        second = client.get_json(url, 'terras', BBOX)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_request_url(self):
+        client = self.client()
+        client.get_json(scraping_utils.terras_request_url(BBOX, self.url),
+                        'terras', BBOX)
+        path = self.server.paths[0]
+        self.assertIn('REQUEST=GetFeature', path)
+        self.assertIn(f'TYPENAMES={scraping_utils.TERRAS_LAYER}', path)
+        self.assertIn('BBOX=121000.0,487050.0,121050.0,487000.0', path)
+
+
+# Features of two layers, some of which span several tiles.
+FEATURES = gpd.GeoDataFrame(
+    {'layer': ['voetpad', 'voetpad', 'voetpad', 'wegdeel', 'wegdeel',
+               'voetpad'],
+     'naam': ['a', 'b', 'c', 'd', 'e', 'f']},
+    geometry=[sg.box(119310, 485110, 119330, 485120),
+              sg.box(119340, 485140, 119370, 485170),
+              sg.box(119420, 485100, 119440, 485190),
+              sg.box(119300, 485100, 119460, 485105),
+              sg.box(119510, 485110, 119520, 485120),
+              # Outside the requested tiles, but inside their blocks.
+              sg.box(119375, 485175, 119385, 485185)],
+    index=[f'id.{i}' for i in range(6)])
+
+TILES = ['2386_9702', '2386_9703', '2387_9702', '2388_9702', '2388_9703',
+         '2390_9702']
+
+
+def stub_scraper(bbox, layers, client=None):
+    """Features of the given layers that intersect the bounding box."""
+    ((x_min, y_max), (x_max, y_min)) = bbox
+    gdf = FEATURES[FEATURES.intersects(sg.box(x_min, y_min, x_max, y_max))]
+    if layers is not None:
+        gdf = gdf[gdf['layer'].isin(layers)]
+    return gdf
+
+
+class ProcessTilesTest(unittest.TestCase):
+
+    def test_coalesce_tiles(self):
+        blocks = scraping_utils.coalesce_tiles(TILES, block_size=2)
+        self.assertEqual(sorted(t for _, tiles in blocks for t in tiles),
+                         sorted(TILES))
+        for ((x_min, y_max), (x_max, y_min)), tiles in blocks:
+            polys = [poly_utils.tilecode_to_poly(t) for t in tiles]
+            bounds = np.array([p.bounds for p in polys])
+            self.assertEqual((x_min, y_min), tuple(bounds[:, :2].min(axis=0)))
+            self.assertEqual((x_max, y_max), tuple(bounds[:, 2:].max(axis=0)))
+            # Tiles in a block are adjacent on the tile grid.
+            codes = np.array([[int(c) for c in t.split('_')] for t in tiles])
+            self.assertTrue((np.ptp(codes, axis=0) < 2).all())
+
+    def test_equals_per_tile(self):
+        layers = ['voetpad', 'wegdeel']
+        # The original implementation: one request per tile for all layers.
+        reference = pd.concat([stub_scraper(
+                        scraping_utils.las_utils.get_bbox_from_tile_code(
+                                                        tilecode, padding=0),
+                        layers) for tilecode in TILES])
+        reference = reference[~reference.duplicated()].sort_index()
+        for block_size in (1, 2, 3):
+            for max_workers in (1, 3):
+                with self.subTest(block_size=block_size,
+                                  max_workers=max_workers):
+                    gdf = scraping_utils.process_tiles(
+                                TILES, layers, scraper=stub_scraper,
+                                max_workers=max_workers,
+                                block_size=block_size)
+                    pd.testing.assert_frame_equal(gdf.sort_index(),
+                                                  reference)
+
+
+if __name__ == '__main__':
+    unittest.main()
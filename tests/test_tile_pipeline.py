@@ -0,0 +1,68 @@
+"""Tests for the multi-process runner in `upc_sw.tile_pipeline`."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from upc_sw import tile_pipeline
+
+CRASH_TILE = '2386_9703'
+
+
+class CrashingPipeline:
+    """Stub pipeline whose worker process dies on `CRASH_TILE`."""
+
+    def __init__(self, crash_tiles=(CRASH_TILE,)):
+        self.crash_tiles = set(crash_tiles)
+
+    def setup(self):
+        pass
+
+    def make_folders(self):
+        pass
+
+    def process_tile(self, tilecode):
+        if tilecode in self.crash_tiles:
+            # Like a worker that is killed for running out of memory.
+            os._exit(1)
+        return 'done', {}
+
+
+class RunTilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.tmp_dir, 'manifest.jsonl')
+        self.tiles = [f'2386_97{i:02d}' for i in range(12)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_tiles_recorded(self):
+        manifest = tile_pipeline.run_tiles(
+                        CrashingPipeline(), self.tiles, self.manifest_file,
+                        n_workers=2, max_in_flight=4)
+        self.assertEqual(set(manifest.records), set(self.tiles))
+        self.assertEqual(manifest.status(CRASH_TILE), 'failed')
+        self.assertIn('BrokenProcessPool', manifest.failed_tiles()[CRASH_TILE])
+        # Tiles submitted after the crash go to a new pool.
+        self.assertEqual(manifest.status(self.tiles[-1]), 'done')
+
+        # The manifest on disk is complete as well.
+        reloaded = tile_pipeline.TileManifest(self.manifest_file)
+        self.assertEqual(set(reloaded.records), set(self.tiles))
+
+    def test_resume_retries_failed_tiles(self):
+        tile_pipeline.run_tiles(CrashingPipeline(), self.tiles,
+                                self.manifest_file, n_workers=2)
+        manifest = tile_pipeline.run_tiles(
+                        CrashingPipeline(crash_tiles=()), self.tiles,
+                        self.manifest_file, n_workers=2)
+        self.assertEqual(manifest.done_tiles(), set(self.tiles))
+
+    def test_every_worker_crashes(self):
+        manifest = tile_pipeline.run_tiles(
+                        CrashingPipeline(crash_tiles=self.tiles), self.tiles,
+                        self.manifest_file, n_workers=2, max_in_flight=2)
+        self.assertEqual(set(manifest.failed_tiles()), set(self.tiles))
@@ -0,0 +1,84 @@
+"""
+Tests for `upc_sw.width_utils`: the widths must equal those computed with a
+`nearest_points` call per sample point.
+"""
+
+import unittest
+
+import numpy as np
+import shapely.geometry as sg
+import shapely.ops as so
+
+from upc_sw import poly_utils, width_utils
+
+# A sidewalk with a hole and a diagonal edge.
+POLY = sg.Polygon([(0, 0), (40, 0), (40, 10), (30, 16), (0, 16)],
+                  [[(15, 4), (25, 4), (25, 8), (15, 8)]])
+
+SEGMENTS = [sg.LineString([(1, 2), (39, 2)]),
+            sg.LineString([(2, 12), (20, 12), (33, 7)]),
+            sg.MultiLineString([[(5, 1), (5, 15)], [(10.2, 1.5), (14.6, 6)]]),
+            # Shorter than half the resolution: only the midpoint is used.
+            sg.LineString([(30, 3), (30.3, 3.1)])]
+
+
+def reference_widths(poly, segments, resolution=1, precision=6):
+    """The widths of the original `get_avg_width`."""
+    boundary = sg.MultiLineString([poly.exterior] + list(poly.interiors))
+    avg_width, min_width = [], []
+    for segment in segments:
+        points = []
+        for line in width_utils.line_parts(segment):
+            count = round(line.length / resolution) + 1
+            if count == 1:
+                points.append(line.interpolate(line.length / 2))
+            else:
+                points.extend(line.interpolate(resolution * i)
+                              for i in range(count))
+        distances = [p1.distance(p2) for p1, p2 in
+                     (so.nearest_points(boundary, p) for p in points)]
+        avg_width.append(sum(distances) / len(distances) * 2)
+        min_width.append(min(distances) * 2)
+    return np.round(avg_width, precision), np.round(min_width, precision)
+
+
+class WidthTest(unittest.TestCase):
+
+    def assert_widths_equal(self, widths, reference):
+        for values, expected in zip(widths, reference):
+            np.testing.assert_allclose(values, expected, atol=1e-6)
+
+    def test_get_avg_width(self):
+        for resolution in (0.5, 1, 3):
+            self.assert_widths_equal(
+                poly_utils.get_avg_width(POLY, SEGMENTS, resolution,
+                                         precision=6),
+                reference_widths(POLY, SEGMENTS, resolution))
+
+    def test_get_avg_width_cl(self):
+        for segment in SEGMENTS:
+            widths = poly_utils.get_avg_width_cl(POLY, segment, precision=6)
+            self.assert_widths_equal(
+                ([widths[0]], [widths[1]]),
+                reference_widths(POLY, [segment]))
+
+    def test_get_avg_width_cl_batch(self):
+        other = sg.box(100, 0, 104, 30)
+        polys = [POLY, other, POLY]
+        lines = [SEGMENTS[0], sg.LineString([(102, 1), (102, 29)]),
+                 SEGMENTS[2]]
+        widths = width_utils.get_avg_width_cl_batch(polys, lines,
+                                                    precision=6)
+        for i, (poly, line) in enumerate(zip(polys, lines)):
+            self.assert_widths_equal(
+                ([widths['avg_width'][i]], [widths['min_width'][i]]),
+                reference_widths(poly, [line]))
+
+    def test_straight_segment_widths(self):
+        starts = np.array([[1., 2.], [2., 12.], [10.2, 1.5]])
+        ends = np.array([[39., 2.], [20., 12.], [14.6, 6.]])
+        segments = [sg.LineString([s, e]) for s, e in zip(starts, ends)]
+        self.assert_widths_equal(
+            width_utils.straight_segment_widths(POLY, starts, ends,
+                                                precision=6),
+            reference_widths(POLY, segments))